@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Simulates N concurrent workers claiming jobs via run_jobs.get_job_info against a local MariaDB.
+# Reports claim throughput, latency and checks that no job was claimed twice.
+#
+# python -m benchmarks.bench_claim --claimers 64 --experiments 2000 --db-passwd ...
+
+import argparse
+import collections
+import logging
+import multiprocessing
+import tempfile
+import time
+import coloredlogs
+from benchmarks import bench_utils
+
+
+logger = logging.getLogger(__name__)
+
+
+def claimer(idx, args, res_queue, start_evt):
+    from files import run_jobs
+    logging.getLogger('files.run_jobs').setLevel(logging.WARNING)
+    run_jobs.backend_data.id_key = idx + 1
+    run_jobs.cache_data_dir = tempfile.mkdtemp(prefix='rtt-bench-claim-')
+    if args.fallback:
+        run_jobs.skip_locked_supported = False
+
+    db = bench_utils.connect(args)
+    claimed, latencies, errors = [], [], 0
+    start_evt.wait()
+    while True:
+        tstart = time.time()
+        try:
+            job_info = run_jobs.get_job_info(db, num_workers=args.claimers)
+            latencies.append(time.time() - tstart)
+            claimed.append(job_info.id)
+
+        except SystemExit:
+            break
+
+        except Exception as e:
+            errors += 1
+            logger.warning("Claimer %s exception: %s" % (idx, e))
+            if errors > 100:
+                break
+
+    db.close()
+    res_queue.put((idx, claimed, latencies, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent job claim benchmark')
+    bench_utils.add_db_args(parser)
+    parser.add_argument('--claimers', dest='claimers', default=32, type=int,
+                        help='Number of concurrent claimer processes')
+    parser.add_argument('--experiments', dest='experiments', default=1000, type=int,
+                        help='Number of experiments to seed')
+    parser.add_argument('--jobs-per-exp', dest='jobs_per_exp', default=7, type=int,
+                        help='Number of jobs per experiment')
+    parser.add_argument('--fallback', dest='fallback', action='store_const', const=True, default=False,
+                        help='Force the UPDATE ... LIMIT 1 claim path instead of SKIP LOCKED')
+    args = parser.parse_args()
+
+    if not args.no_schema:
+        bench_utils.create_schema(args)
+        db = bench_utils.connect(args)
+        bench_utils.seed_jobs(db, args.experiments, args.jobs_per_exp)
+        db.close()
+
+    res_queue = multiprocessing.Queue()
+    start_evt = multiprocessing.Event()
+    procs = [multiprocessing.Process(target=claimer, args=(i, args, res_queue, start_evt))
+             for i in range(args.claimers)]
+    for p in procs:
+        p.start()
+
+    time.sleep(1)
+    tstart = time.time()
+    start_evt.set()
+    results = [res_queue.get() for _ in procs]
+    tdelta = time.time() - tstart
+    for p in procs:
+        p.join()
+
+    claimed = [jid for r in results for jid in r[1]]
+    latencies = [x for r in results for x in r[2]]
+    errors = sum(r[3] for r in results)
+    dupes = [jid for jid, cnt in collections.Counter(claimed).items() if cnt > 1]
+
+    print("Claimers: %s, mode: %s" % (args.claimers, 'fallback' if args.fallback else 'auto'))
+    print("Claimed jobs: %s in %.2f s, %.2f claims/s" % (len(claimed), tdelta, len(claimed) / tdelta))
+    print("Claim latency: avg %.4f s, p50 %.4f s, p95 %.4f s, p99 %.4f s, max %.4f s"
+          % (sum(latencies) / max(1, len(latencies)), bench_utils.percentile(latencies, 50),
+             bench_utils.percentile(latencies, 95), bench_utils.percentile(latencies, 99),
+             max(latencies) if latencies else 0))
+    print("Errors: %s, duplicate claims: %s" % (errors, len(dupes)))
+
+
+if __name__ == "__main__":
+    coloredlogs.CHROOT_FILES = []
+    coloredlogs.install(level=logging.INFO, use_chroot=False)
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the job dispatcher on a scratch SQLite database, no MySQL needed.
+# Seeds experiments / jobs, starts the dispatcher HTTP server and N simulated workers
+# claiming jobs with DispatcherClient until the queue is empty. Workers report a few cached
+# experiments and half of the experiments are registered as cached in their location,
+# so the cache affinity tiers are exercised. Then checks long-poll wake up on new jobs.
+#
+# python -m benchmarks.bench_dispatcher --experiments 2000 --workers 64
+
+import argparse
+import collections
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import coloredlogs
+from common import rtt_dispatch
+
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(vals, pct):
+    if not vals:
+        return 0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(pct / 100.0 * (len(vals) - 1))))]
+
+
+def seed(db_path, experiments, jobs_per_exp):
+    db = sqlite3.connect(db_path)
+    db.executescript(rtt_dispatch.SQLITE_SCHEMA)
+    db.executemany("INSERT INTO experiments(id, status) VALUES (?, 'pending')",
+                   [(eid,) for eid in range(1, experiments + 1)])
+    db.executemany("INSERT INTO jobs(battery, experiment_id) VALUES (?, ?)",
+                   [('battery_%s' % j, eid) for eid in range(1, experiments + 1) for j in range(jobs_per_exp)])
+    db.executemany("INSERT INTO cache_registry(cache_id, experiment_id, location) VALUES (?, ?, 'bench')",
+                   [('node-%s' % (eid % 8), eid) for eid in range(1, experiments + 1, 2)])
+    db.commit()
+    db.close()
+
+
+def worker(idx, url, experiments, stats, latencies, claimed):
+    client = rtt_dispatch.DispatcherClient(url)
+    cached = random.sample(range(1, experiments + 1), min(experiments, 4))
+    while True:
+        tstart = time.time()
+        try:
+            job = client.claim(idx, os.getpid(), cached, location='bench')
+        except Exception as e:
+            logger.error("Claim failed: %s" % (e,))
+            stats['errors'] += 1
+            continue
+
+        latencies.append(time.time() - tstart)
+        if not job:
+            return
+        claimed.append(job.id)
+        stats['claims'] += 1
+        stats['cached'] += int(job.experiment_id in cached)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Job dispatcher benchmark on SQLite')
+    parser.add_argument('--experiments', dest='experiments', default=2000, type=int,
+                        help='Number of experiments to seed')
+    parser.add_argument('--jobs-per-exp', dest='jobs_per_exp', default=7, type=int,
+                        help='Number of jobs per experiment')
+    parser.add_argument('--workers', dest='workers', default=64, type=int,
+                        help='Number of simulated workers')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='rtt-bench-dispatch-')
+    db_path = os.path.join(tmpdir, 'rtt.sqlite')
+    seed(db_path, args.experiments, args.jobs_per_exp)
+
+    store = rtt_dispatch.DispatchStore(lambda: sqlite3.connect(db_path, check_same_thread=False), paramstyle='qmark')
+    dispatcher = rtt_dispatch.Dispatcher(store, refresh_interval=1).start()
+    server = rtt_dispatch.create_server(dispatcher, host='127.0.0.1', port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s' % server.server_address[1]
+
+    stats, latencies, claimed = collections.Counter(), [], []
+    threads = [threading.Thread(target=worker, args=(idx, url, args.experiments, stats, latencies, claimed))
+               for idx in range(args.workers)]
+    time_start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    time_total = time.time() - time_start
+
+    db = sqlite3.connect(db_path)
+    running = db.execute("SELECT COUNT(*) FROM jobs WHERE status='running'").fetchone()[0]
+    print("Workers: %s, time: %.2f s, claims: %s (%.2f claims/s), cached claims: %s, errors: %s"
+          % (args.workers, time_total, stats['claims'], stats['claims'] / time_total, stats['cached'], stats['errors']))
+    print("Claim latency: avg %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.2f ms"
+          % (1000 * sum(latencies) / max(1, len(latencies)), 1000 * percentile(latencies, 50),
+             1000 * percentile(latencies, 99), 1000 * max(latencies or [0])))
+    print("Jobs claimed twice: %s, running in DB: %s / %s"
+          % (len(claimed) - len(set(claimed)), running, args.experiments * args.jobs_per_exp))
+
+    # Long-poll: a waiting worker gets the job inserted meanwhile
+    def add_job():
+        cdb = sqlite3.connect(db_path)
+        cdb.execute("INSERT INTO jobs(battery, experiment_id) VALUES ('late', 1)")
+        cdb.commit()
+        cdb.close()
+
+    client = rtt_dispatch.DispatcherClient(url)
+    threading.Timer(0.5, add_job).start()
+    tstart = time.time()
+    job = client.claim(0, os.getpid(), wait=10)
+    print("Long-poll: got job %s after %.2f s" % (job.id if job else None, time.time() - tstart))
+    print("Dispatcher stats: %s" % client.stats())
+
+    server.shutdown()
+    dispatcher.shutdown()
+
+
+if __name__ == "__main__":
+    coloredlogs.CHROOT_FILES = []
+    coloredlogs.install(level=logging.WARNING, use_chroot=False)
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Synthetic load benchmark of the whole job lifecycle against a local MariaDB.
+# Seeds experiments / jobs / batteries, then N simulated workers claim jobs with run_jobs.get_job_info,
+# heart-beat them, run the stub RTT binary via AsyncRunner, and finalize with run_jobs.try_make_finalized.
+# A janitor process runs run_jobs.reset_jobs periodically, as long-term workers do.
+# Reports claim latency, heartbeat write rate, deadlock / lock timeout counts and finalization cost.
+#
+# python -m benchmarks.bench_lifecycle --db-passwd ... --experiments 100000 --workers 32 --duration 300
+
+import argparse
+import collections
+import logging
+import multiprocessing
+import os
+import shlex
+import sys
+import tempfile
+import threading
+import time
+import coloredlogs
+from benchmarks import bench_utils
+
+
+logger = logging.getLogger(__name__)
+
+
+def classify_db_error(e):
+    try:
+        code = e.args[0]
+    except Exception:
+        code = None
+    if code == 1213 or 'Deadlock found' in str(e):
+        return 'deadlocks'
+    if code == 1205 or 'Lock wait timeout' in str(e):
+        return 'lock_timeouts'
+    return 'errors'
+
+
+class Heartbeater(object):
+    """Heartbeat of the running job from a separate connection, as the heartbeat service does"""
+    def __init__(self, args, run_jobs, stats):
+        self.args = args
+        self.run_jobs = run_jobs
+        self.stats = stats
+        self.job_ids = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        db = bench_utils.connect(self.args)
+        while not self.stop_event.wait(self.args.heartbeat_interval):
+            with self.lock:
+                job_ids = list(self.job_ids)
+            if not job_ids:
+                continue
+            try:
+                cursor = db.cursor()
+                self.run_jobs.jobs_heartbeat(cursor, job_ids)
+                db.commit()
+                self.stats['heartbeats'] += len(job_ids)
+            except Exception as e:
+                db.rollback()
+                self.stats[classify_db_error(e)] += 1
+        db.close()
+
+
+def worker(idx, args, res_queue, start_evt):
+    from files import run_jobs
+    from common import rtt_worker
+    logging.getLogger('files.run_jobs').setLevel(logging.WARNING)
+    logging.getLogger('common.rtt_worker').setLevel(logging.WARNING)
+    run_jobs.backend_data.id_key = idx + 1
+    run_jobs.cache_data_dir = tempfile.mkdtemp(prefix='rtt-bench-lifecycle-')
+    run_jobs.rtt_binary = '%s -m benchmarks.stub_rtt --sleep %s --tests %s' % (sys.executable, args.job_time, args.tests)
+    run_jobs.send_email_to_author = lambda exp_id, connection: None
+
+    env = dict(os.environ, RTT_BENCH_DB_USER=args.db_user, RTT_BENCH_DB_PASSWD=args.db_passwd,
+               RTT_BENCH_DB_NAME=args.db_name)
+    stats = collections.Counter()
+    claim_lat, finalize_lat, overhead = [], [], []
+    heartbeat = Heartbeater(args, run_jobs, stats)
+    heartbeat.thread.start()
+    db = bench_utils.connect(args)
+
+    start_evt.wait()
+    time_end = time.time() + args.duration
+    while time.time() < time_end:
+        tstart = time.time()
+        try:
+            job_info = run_jobs.get_job_info(db, num_workers=args.workers)
+            claim_lat.append(time.time() - tstart)
+        except SystemExit:
+            break
+        except Exception as e:
+            stats[classify_db_error(e)] += 1
+            continue
+
+        with heartbeat.lock:
+            heartbeat.job_ids.add(job_info.id)
+
+        cmd = run_jobs.get_rtt_arguments(job_info, mysql_host=args.db_host, mysql_port=args.db_port)
+        runner = rtt_worker.AsyncRunner(shlex.split(cmd), shell=False, env=env, cwd=bench_utils.REPO_ROOT)
+        runner.log_out_after = False
+        tstart = time.time()
+        runner.start()
+        runner.wait()
+        overhead.append(time.time() - tstart - args.job_time)
+        stats['runner_failed'] += int(runner.ret_code != 0)
+
+        with heartbeat.lock:
+            heartbeat.job_ids.discard(job_info.id)
+
+        tstart = time.time()
+        try:
+            run_jobs.try_make_finalized(db.cursor(), job_info, db)
+            db.commit()
+            finalize_lat.append(time.time() - tstart)
+            stats['jobs'] += 1
+        except Exception as e:
+            db.rollback()
+            stats[classify_db_error(e)] += 1
+
+    heartbeat.stop_event.set()
+    db.close()
+    res_queue.put(('worker', stats, claim_lat, finalize_lat, overhead))
+
+
+def janitor(args, res_queue, start_evt):
+    from files import run_jobs
+    logging.getLogger('files.run_jobs').setLevel(logging.WARNING)
+    stats = collections.Counter()
+    reset_lat = []
+    db = bench_utils.connect(args)
+    start_evt.wait()
+    time_end = time.time() + args.duration
+    while time.time() < time_end:
+        tstart = time.time()
+        try:
+            run_jobs.reset_jobs(db)
+            reset_lat.append(time.time() - tstart)
+        except Exception as e:
+            stats[classify_db_error(e)] += 1
+
+        tstart = time.time()
+        run_jobs.try_finalize_experiments(db)
+        stats['finalize_all_time'] += time.time() - tstart
+        stats['finalize_all'] += 1
+        time.sleep(args.reset_interval)
+
+    db.close()
+    res_queue.put(('janitor', stats, reset_lat, [], []))
+
+
+def fmt_lat(name, vals):
+    return "%s: n=%s p50=%.2f ms p95=%.2f ms p99=%.2f ms max=%.2f ms" \
+           % (name, len(vals), 1000 * bench_utils.percentile(vals, 50), 1000 * bench_utils.percentile(vals, 95),
+              1000 * bench_utils.percentile(vals, 99), 1000 * max(vals or [0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Job lifecycle load benchmark')
+    bench_utils.add_db_args(parser)
+    parser.add_argument('--experiments', dest='experiments', default=100000, type=int,
+                        help='Number of experiments to seed')
+    parser.add_argument('--jobs-per-exp', dest='jobs_per_exp', default=7, type=int,
+                        help='Number of jobs per experiment')
+    parser.add_argument('--workers', dest='workers', default=16, type=int,
+                        help='Number of simulated workers')
+    parser.add_argument('--duration', dest='duration', default=120, type=float,
+                        help='Benchmark duration in seconds')
+    parser.add_argument('--job-time', dest='job_time', default=2.0, type=float,
+                        help='Run time of the stub RTT battery')
+    parser.add_argument('--tests', dest='tests', default=10, type=int,
+                        help='Fake tests written per battery')
+    parser.add_argument('--heartbeat-interval', dest='heartbeat_interval', default=5.0, type=float,
+                        help='Heartbeat interval of the simulated workers')
+    parser.add_argument('--reset-interval', dest='reset_interval', default=10.0, type=float,
+                        help='Interval of the janitor reset_jobs runs')
+    args = parser.parse_args()
+
+    if not args.no_schema:
+        bench_utils.create_schema(args)
+        db = bench_utils.connect(args)
+        bench_utils.seed_jobs(db, args.experiments, args.jobs_per_exp)
+        bench_utils.seed_status_mix(db)
+        db.close()
+
+    res_queue = multiprocessing.Queue()
+    start_evt = multiprocessing.Event()
+    procs = [multiprocessing.Process(target=worker, args=(idx, args, res_queue, start_evt))
+             for idx in range(args.workers)]
+    procs.append(multiprocessing.Process(target=janitor, args=(args, res_queue, start_evt)))
+    for p in procs:
+        p.start()
+
+    time.sleep(2)
+    time_start = time.time()
+    start_evt.set()
+    results = [res_queue.get() for _ in procs]
+    time_total = time.time() - time_start
+    for p in procs:
+        p.join()
+
+    stats = collections.Counter()
+    claim_lat, finalize_lat, overhead, reset_lat = [], [], [], []
+    for kind, cstats, lat_a, lat_b, lat_c in results:
+        stats.update(cstats)
+        if kind == 'worker':
+            claim_lat += lat_a
+            finalize_lat += lat_b
+            overhead += lat_c
+        else:
+            reset_lat += lat_a
+
+    print("Workers: %s, time: %.2f s, jobs finished: %s (%.2f jobs/s)"
+          % (args.workers, time_total, stats['jobs'], stats['jobs'] / time_total))
+    print(fmt_lat("Claim latency", claim_lat))
+    print(fmt_lat("Finalize latency", finalize_lat))
+    print(fmt_lat("Runner overhead", overhead))
+    print(fmt_lat("Reset jobs", reset_lat))
+    print("Finalize all experiments: %s runs, avg %.2f ms"
+          % (stats['finalize_all'], 1000 * stats['finalize_all_time'] / max(1, stats['finalize_all'])))
+    print("Heartbeat writes: %s (%.2f /s)" % (stats['heartbeats'], stats['heartbeats'] / time_total))
+    print("Deadlocks: %s, lock timeouts: %s, other DB errors: %s, runner failures: %s"
+          % (stats['deadlocks'], stats['lock_timeouts'], stats['errors'], stats['runner_failed']))
+
+
+if __name__ == "__main__":
+    coloredlogs.CHROOT_FILES = []
+    coloredlogs.install(level=logging.INFO, use_chroot=False)
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# SFTP download throughput of SftpDownloader against a local SFTP server stand-in
+# (paramiko server serving a temporary directory). Reports MB/s for the given stream counts.
+# With --upload measures SftpUploader instead, including a resume of an interrupted upload.
+#
+# python -m benchmarks.bench_sftp --size 512 --streams 1 4 8 --latency-ms 2
+# python -m benchmarks.bench_sftp --size 512 --streams 1 4 8 --latency-ms 2 --upload
+
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import coloredlogs
+import paramiko
+from common import rtt_sftp_conn
+from common import rtt_utils
+
+
+logger = logging.getLogger(__name__)
+
+
+class StubServer(paramiko.ServerInterface):
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+    latency = 0
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def read(self, offset, length):
+        if self.latency:
+            time.sleep(self.latency)
+        return super().read(offset, length)
+
+    def write(self, offset, data):
+        if self.latency:
+            time.sleep(self.latency)
+        return super().write(offset, data)
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP server serving the ROOT directory"""
+    ROOT = None
+
+    def _realpath(self, path):
+        return self.ROOT + self.canonicalize(path)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        return self.stat(path)
+
+    def open(self, path, flags, attr):
+        try:
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                fobj = os.fdopen(os.open(self._realpath(path), flags, 0o644), 'r+b' if flags & os.O_RDWR else 'wb')
+            else:
+                fobj = open(self._realpath(path), 'rb')
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        handle = StubSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = fobj
+        handle.writefile = fobj
+        return handle
+
+    def setstat(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self._realpath(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._realpath(oldpath), self._realpath(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def remove(self, path):
+        try:
+            os.remove(self._realpath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class StubSshd(object):
+    """Minimal SSH server with SFTP subsystem, listening on a random local port"""
+    def __init__(self, root, latency=0):
+        StubSFTPServer.ROOT = root
+        StubSFTPHandle.latency = latency
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+
+            t = paramiko.Transport(conn)
+            t.add_server_key(self.host_key)
+            t.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTPServer)
+            t.start_server(server=StubServer())
+            self.transports.append(t)
+
+    def start(self):
+        threading.Thread(target=self.serve, daemon=True).start()
+        return self
+
+    def close(self):
+        self.sock.close()
+        for t in self.transports:
+            rtt_utils.try_fnc(lambda: t.close())
+
+
+def create_random_file(path, size):
+    hasher = hashlib.sha256()
+    with open(path, 'wb') as fh:
+        for offset in range(0, size, 1024*1024):
+            data = os.urandom(min(1024*1024, size - offset))
+            hasher.update(data)
+            fh.write(data)
+    return hasher.digest()
+
+
+def bench_upload(args, sftp, tmpdir, src_dir, size, digest):
+    src = os.path.join(tmpdir, 'upload.bin')
+    shutil.copy(os.path.join(src_dir, '1.bin'), src)
+    for streams in args.streams:
+        for _ in range(args.repeat):
+            rtt_utils.try_remove(os.path.join(src_dir, 'up.bin'))
+
+            uploader = rtt_sftp_conn.SftpUploader(sftp, num_streams=streams)
+            tstart = time.time()
+            up_digest = uploader.put(src, '/up.bin')
+            tdelta = time.time() - tstart
+
+            ok = up_digest == digest and rtt_utils.hash_file(os.path.join(src_dir, 'up.bin')) == digest
+            print("Upload streams: %2d, size: %s MB, time: %.2f s, speed: %.2f MB/s, hash ok: %s"
+                  % (streams, args.size, tdelta, size / tdelta / 1024 / 1024, ok))
+
+    # Interrupted upload: partial file with a hole and garbage past the valid prefix is resumed
+    with open(os.path.join(src_dir, 'up.bin'), 'r+b') as fh:
+        fh.truncate(size // 2)
+        fh.seek(size // 2 - 1024 * 1024)
+        fh.write(b'\0' * 1024 * 1024)
+    uploader = rtt_sftp_conn.SftpUploader(sftp, num_streams=args.streams[-1])
+    up_digest = uploader.put(src, '/up.bin')
+    ok = up_digest == digest and rtt_utils.hash_file(os.path.join(src_dir, 'up.bin')) == digest
+    print("Resumed upload from offset %s, uploaded %s B, hash ok: %s" % (uploader.offset, uploader.bytes_uploaded, ok))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SFTP download / upload benchmark')
+    parser.add_argument('--size', dest='size', default=256, type=int,
+                        help='Size of the test file in MB')
+    parser.add_argument('--streams', dest='streams', nargs='+', default=[1, 4, 8], type=int,
+                        help='Numbers of parallel streams to benchmark')
+    parser.add_argument('--latency-ms', dest='latency_ms', default=0, type=float,
+                        help='Server side latency added to each read / write request, emulates network RTT')
+    parser.add_argument('--repeat', dest='repeat', default=1, type=int,
+                        help='Number of runs for each stream count')
+    parser.add_argument('--upload', dest='upload', action='store_const', const=True, default=False,
+                        help='Benchmarks SftpUploader instead of the download')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='rtt-bench-sftp-')
+    try:
+        src_dir = os.path.join(tmpdir, 'storage')
+        os.makedirs(src_dir)
+        size = args.size * 1024 * 1024
+        digest = create_random_file(os.path.join(src_dir, '1.bin'), size)
+
+        client_key = paramiko.RSAKey.generate(2048)
+        client_key_path = os.path.join(tmpdir, 'key')
+        client_key.write_private_key_file(client_key_path, password='bench')
+
+        sshd = StubSshd(src_dir, args.latency_ms / 1000.0).start()
+        params = rtt_sftp_conn.SSHParams(host='127.0.0.1', port=sshd.port, user='rtt',
+                                         pkey_file=client_key_path, pkey_pass='bench')
+        sftp = rtt_sftp_conn.create_sftp_storage_conn_params(params)
+
+        if args.upload:
+            bench_upload(args, sftp, tmpdir, src_dir, size, digest)
+            sftp.close()
+            sshd.close()
+            return
+
+        for streams in args.streams:
+            for _ in range(args.repeat):
+                dest = os.path.join(tmpdir, 'dest.bin')
+                rtt_utils.try_remove(dest)
+
+                downloader = rtt_sftp_conn.SftpDownloader(sftp, num_streams=streams)
+                tstart = time.time()
+                downloader.get('/1.bin', dest)
+                tdelta = time.time() - tstart
+
+                ok = rtt_utils.hash_file(dest) == digest
+                print("Streams: %2d, size: %s MB, time: %.2f s, speed: %.2f MB/s, hash ok: %s"
+                      % (streams, args.size, tdelta, size / tdelta / 1024 / 1024, ok))
+
+        sftp.close()
+        sshd.close()
+
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+
+if __name__ == "__main__":
+    coloredlogs.CHROOT_FILES = []
+    coloredlogs.install(level=logging.INFO, use_chroot=False)
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Shared helpers for benchmarks running against a local MariaDB / MySQL.
+# Benchmarks are executed from the repository root, e.g., python -m benchmarks.bench_claim
+
+import os
+import re
+import time
+import logging
+import MySQLdb
+from common.rtt_db_conn import MySQLParams, connect_mysql_db
+from common.rtt_constants import CommonConst
+from common import rtt_migrations
+from common import rtt_worker
+
+
+logger = logging.getLogger(__name__)
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def add_db_args(parser):
+    parser.add_argument('--db-host', dest='db_host', default='127.0.0.1',
+                        help='MySQL host')
+    parser.add_argument('--db-port', dest='db_port', default=3306, type=int,
+                        help='MySQL port')
+    parser.add_argument('--db-user', dest='db_user', default='root',
+                        help='MySQL user')
+    parser.add_argument('--db-passwd', dest='db_passwd', default='',
+                        help='MySQL password')
+    parser.add_argument('--db-name', dest='db_name', default='rtt_bench',
+                        help='Scratch database name, dropped and re-created by the benchmark')
+    parser.add_argument('--no-schema', dest='no_schema', action='store_const', const=True, default=False,
+                        help='Do not re-create the schema, use the existing data')
+    return parser
+
+
+def db_params(args):
+    return MySQLParams(host=args.db_host, port=args.db_port, db=args.db_name,
+                       user=args.db_user, password=args.db_passwd)
+
+
+def connect(args):
+    return connect_mysql_db(db_params(args))
+
+
+def load_schema_statements():
+    """Table definitions from create_rtt_tables.sql without the DB (re)creation statements"""
+    with open(os.path.join(REPO_ROOT, CommonConst.CREATE_TABLES_SCRIPT)) as fh:
+        stmts = rtt_migrations.parse_sql_statements(fh.read())
+    return [x for x in stmts if not re.match(r'^(DROP DATABASE|CREATE DATABASE|USE)\b', x, re.I)]
+
+
+def create_schema(args, migrate=True):
+    """Drops and creates the scratch benchmark database, schema migrations are applied unless disabled"""
+    if not re.match(r'^[a-zA-Z0-9_]+$', args.db_name) or args.db_name == 'rtt':
+        raise ValueError('Refusing to use database %s for benchmarking' % args.db_name)
+
+    db = MySQLdb.connect(host=args.db_host, port=args.db_port, user=args.db_user, passwd=args.db_passwd)
+    cursor = db.cursor()
+    cursor.execute("DROP DATABASE IF EXISTS `%s`" % args.db_name)
+    cursor.execute("CREATE DATABASE `%s`" % args.db_name)
+    cursor.execute("USE `%s`" % args.db_name)
+    for stmt in load_schema_statements():
+        cursor.execute(stmt)
+    db.commit()
+    if migrate:
+        rtt_migrations.migrate(db)
+    db.close()
+
+
+def seed_jobs(db, num_experiments, jobs_per_experiment, batteries=None, chunk=1000):
+    """Inserts pending experiments with jobs, returns list of experiment IDs"""
+    batteries = batteries or ['nist_sts', 'dieharder', 'tu01_smallcrush', 'tu01_crush',
+                              'tu01_rabbit', 'tu01_alphabit', 'tu01_blockalphabit']
+    cursor = db.cursor()
+    eids = []
+    time_start = time.time()
+    for offset in range(0, num_experiments, chunk):
+        cnum = min(chunk, num_experiments - offset)
+        cursor.executemany(
+            "INSERT INTO experiments(name, config_file, data_file, data_file_sha256) VALUES (%s, %s, %s, %s)",
+            [('bench-%s' % (offset + i), 'bench.json', 'bench.bin', '0' * 64) for i in range(cnum)])
+
+        first_id = cursor.lastrowid
+        ceids = list(range(first_id, first_id + cnum))
+        eids += ceids
+        cursor.executemany("INSERT INTO jobs(battery, experiment_id) VALUES (%s, %s)",
+                           [(batteries[j % len(batteries)], eid) for eid in ceids for j in range(jobs_per_experiment)])
+        db.commit()
+
+    logger.info("Seeded %s experiments, %s jobs in %.2f s"
+                % (num_experiments, num_experiments * jobs_per_experiment, time.time() - time_start))
+    return eids
+
+
+def seed_status_mix(db):
+    """Realistic status mix: most experiments finished, some running with stale and live jobs"""
+    cursor = db.cursor()
+    cursor.execute("UPDATE experiments SET status='finished' WHERE id % 10 < 8")
+    cursor.execute("UPDATE experiments SET status='running' WHERE id % 10 = 8")
+    cursor.execute("UPDATE jobs j JOIN experiments e ON e.id=j.experiment_id "
+                   "SET j.status='finished' WHERE e.status='finished'")
+    cursor.execute("UPDATE jobs j JOIN experiments e ON e.id=j.experiment_id "
+                   "SET j.status='running', j.run_started=NOW(), j.run_heartbeat=DATE_SUB(NOW(), INTERVAL j.id % 30 MINUTE) "
+                   "WHERE e.status='running'")
+    # Battery results named as RTT names them, partial results of running jobs included
+    names = ' '.join("WHEN '%s' THEN '%s'" % (v, k) for k, v in rtt_worker.RTT_BATTERIES.items())
+    cursor.execute("INSERT INTO batteries(name, passed_tests, total_tests, alpha, experiment_id, job_id) "
+                   "SELECT CASE battery %s ELSE battery END, 1, 1, 0.01, experiment_id, id "
+                   "FROM jobs WHERE status!='pending'" % names)
+    db.commit()
+    for table in ['experiments', 'jobs', 'batteries']:
+        cursor.execute("ANALYZE TABLE %s" % table)
+        cursor.fetchall()
+    cursor.close()
+
+
+def percentile(vals, pct):
+    if not vals:
+        return 0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(pct / 100.0 * (len(vals) - 1))))]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# EXPLAIN-based regression check of the scheduler query shapes against a seeded local MariaDB / MySQL.
+# Each query has to use one of the expected indexes on the listed tables, full table scans fail the check.
+# Exits with non-zero code on regression.
+#
+# python -m benchmarks.explain_check --db-passwd ... --experiments 20000
+# python -m benchmarks.explain_check --db-passwd ... --no-migrate    # baseline schema, expected to fail
+
+import argparse
+import logging
+import sys
+import coloredlogs
+from benchmarks import bench_utils
+from files import run_jobs
+
+
+logger = logging.getLogger(__name__)
+
+
+# (name, query, params, {table alias: expected keys}), queries are built by run_jobs so the checked SQL
+# is the executed one. The claim is checked in its SELECT shape, the UPDATE fallback has the same condition.
+QUERIES = [
+    ('claim cached experiments',
+     run_jobs.sql_claim_select(run_jobs.sql_claim_cached(3)), (1, 2, 3),
+     {'jobs': {'jobs_status_experiment', 'jobs_experiment_status'}}),
+    ('claim experiments cached in the location',
+     run_jobs.sql_claim_select(run_jobs.SQL_CLAIM_LOCATION), ('cluster', 'node:/cache'),
+     {'jobs': {'jobs_status_experiment', 'jobs_experiment_status'},
+      'cache_registry': {'cache_registry_location', 'cache_registry_experiment', 'PRIMARY'}}),
+    ('claim pending experiments',
+     run_jobs.sql_claim_select(run_jobs.SQL_CLAIM_PENDING), (),
+     {'jobs': {'jobs_status_experiment', 'jobs_experiment_status'},
+      'experiments': {'experiments_status', 'PRIMARY'}}),
+    ('claim any',
+     run_jobs.sql_claim_select(run_jobs.SQL_CLAIM_ANY), (),
+     {'jobs': {'jobs_status_experiment', 'jobs_status_heartbeat', 'PRIMARY'}}),
+    ('stale jobs reset',
+     run_jobs.SQL_STALE_JOBS, (),
+     {'jobs': {'jobs_status_heartbeat', 'jobs_status_experiment'}}),
+    ('reset job chunk',
+     run_jobs.sql_reset_job_chunk(3), (1, 2, 3),
+     {'jobs': {'PRIMARY'}}),
+    ('finalize experiment',
+     run_jobs.SQL_FINALIZE_EXPERIMENT, (1, 1),
+     {'experiments': {'PRIMARY'}, 'jobs': {'jobs_experiment_status'}}),
+    ('finalize running experiments',
+     run_jobs.SQL_FINALIZE_EXPERIMENTS, (),
+     {'r': {'experiments_status'}, 'j': {'jobs_experiment_status'}}),
+    ('purge partial results',
+     run_jobs.sql_jobs_battery_ids(2), (1, 'Dieharder', 2, 'NIST Statistical Testing Suite'),
+     {'batteries': {'batteries_experiment_name'}}),
+]
+
+
+def explain(cursor, query, params=()):
+    cursor.execute("EXPLAIN " + query, params or None)
+    cols = [x[0] for x in cursor.description]
+    return [dict(zip(cols, row)) for row in cursor.fetchall()]
+
+
+def check_query(cursor, name, query, params, expected):
+    rows = explain(cursor, query, params)
+    ok = True
+    for row in rows:
+        print("  %-32s table: %-14s type: %-8s key: %-28s rows: %s"
+              % (name, row.get('table'), row.get('type'), row.get('key'), row.get('rows')))
+
+    for table, keys in expected.items():
+        trows = [x for x in rows if x.get('table') == table]
+        if not trows:
+            logger.warning("%s: table %s not in the plan" % (name, table))
+            ok = False
+            continue
+        for row in trows:
+            if row.get('type') == 'ALL' or row.get('key') not in keys:
+                logger.error("%s: table %s uses %s (%s), expected one of %s"
+                             % (name, table, row.get('key'), row.get('type'), sorted(keys)))
+                ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EXPLAIN check of the scheduler queries')
+    bench_utils.add_db_args(parser)
+    parser.add_argument('--experiments', dest='experiments', default=20000, type=int,
+                        help='Number of experiments to seed')
+    parser.add_argument('--jobs-per-exp', dest='jobs_per_exp', default=7, type=int,
+                        help='Number of jobs per experiment')
+    parser.add_argument('--no-migrate', dest='no_migrate', action='store_const', const=True, default=False,
+                        help='Check the baseline schema without migrations')
+    args = parser.parse_args()
+
+    if not args.no_schema:
+        bench_utils.create_schema(args, migrate=not args.no_migrate)
+        db = bench_utils.connect(args)
+        bench_utils.seed_jobs(db, args.experiments, args.jobs_per_exp)
+        bench_utils.seed_status_mix(db)
+    else:
+        db = bench_utils.connect(args)
+
+    cursor = db.cursor()
+    failed = [name for name, query, params, expected in QUERIES
+              if not check_query(cursor, name, query, params, expected)]
+    db.rollback()
+    db.close()
+
+    if failed:
+        print("FAILED: %s" % ', '.join(failed))
+        sys.exit(1)
+    print("All %s query plans OK" % len(QUERIES))
+
+
+if __name__ == "__main__":
+    coloredlogs.CHROOT_FILES = []
+    coloredlogs.install(level=logging.INFO, use_chroot=False)
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Stub RTT binary for benchmarks. Accepts the RTT command line built by run_jobs.get_rtt_arguments,
+# sleeps and writes fake battery results to the database like RTT does.
+# DB credentials are taken from RTT_BENCH_DB_USER, RTT_BENCH_DB_PASSWD, RTT_BENCH_DB_NAME env variables.
+
+import argparse
+import os
+import random
+import time
+import MySQLdb
+
+
+def write_results(db, eid, jid, battery, num_tests, num_pvals):
+    cursor = db.cursor()
+    cursor.execute("INSERT INTO batteries(name, passed_tests, total_tests, alpha, experiment_id, job_id) "
+                   "VALUES (%s, %s, %s, %s, %s, %s)", (battery, num_tests, num_tests, 0.01, eid, jid))
+    bid = cursor.lastrowid
+    for tidx in range(num_tests):
+        cursor.execute("INSERT INTO tests(name, partial_alpha, result, test_index, battery_id) "
+                       "VALUES (%s, %s, %s, %s, %s)", ('test-%s' % tidx, 0.01, 'passed', tidx, bid))
+        tid = cursor.lastrowid
+        cursor.execute("INSERT INTO variants(variant_index, test_id) VALUES (%s, %s)", (0, tid))
+        vid = cursor.lastrowid
+        cursor.execute("INSERT INTO subtests(subtest_index, variant_id) VALUES (%s, %s)", (0, vid))
+        sid = cursor.lastrowid
+        cursor.executemany("INSERT INTO p_values(value, subtest_id) VALUES (%s, %s)",
+                           [(random.random(), sid) for _ in range(num_pvals)])
+    db.commit()
+    cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub RTT')
+    parser.add_argument('-b', dest='battery')
+    parser.add_argument('-c', dest='config')
+    parser.add_argument('-f', dest='file')
+    parser.add_argument('-r', dest='storage')
+    parser.add_argument('-s', dest='settings')
+    parser.add_argument('--eid', dest='eid', type=int)
+    parser.add_argument('--jid', dest='jid', type=int)
+    parser.add_argument('--db-host', dest='db_host', default='127.0.0.1')
+    parser.add_argument('--db-port', dest='db_port', default=3306, type=int)
+    parser.add_argument('--rpath', dest='rpath')
+    parser.add_argument('--sleep', dest='sleep', default=1.0, type=float,
+                        help='Simulated battery run time')
+    parser.add_argument('--tests', dest='tests', default=10, type=int,
+                        help='Number of fake tests to write')
+    parser.add_argument('--pvals', dest='pvals', default=20, type=int,
+                        help='Number of p-values per test')
+    args = parser.parse_args()
+
+    for idx in range(10):
+        print("Stub RTT battery %s, progress %s %%" % (args.battery, idx * 10), flush=True)
+        time.sleep(args.sleep / 10.0)
+
+    db = MySQLdb.connect(host=args.db_host, port=args.db_port, user=os.getenv('RTT_BENCH_DB_USER', 'root'),
+                         passwd=os.getenv('RTT_BENCH_DB_PASSWD', ''), db=os.getenv('RTT_BENCH_DB_NAME', 'rtt_bench'))
+    write_results(db, args.eid, args.jid, args.battery, args.tests, args.pvals)
+    db.close()
+    print("Stub RTT finished", flush=True)
+
+
+if __name__ == "__main__":
+    main()
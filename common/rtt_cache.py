@@ -0,0 +1,415 @@
+import os
+import collections
+import hashlib
+import json
+import socket
+import threading
+import time
+from common.clilogging import *
+from common.rtt_sftp_conn import LockedDownloader, DownloadFailedException, write_download_marker
+from . import rtt_utils
+
+
+class CacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self.bytes_evicted = 0
+        self.shared_hits = 0
+        self.bytes_shared = 0
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        total = self.hits + self.shared_hits + self.misses
+        res = "hits: %s, misses: %s (%.2f %% hit rate), downloaded: %.2f MB, saved: %.2f MB, evicted: %s (%.2f MB)" \
+              % (self.hits, self.misses, 100.0 * (self.hits + self.shared_hits) / max(1, total), self.bytes_downloaded / 1024 / 1024,
+                 self.bytes_saved / 1024 / 1024, self.evictions, self.bytes_evicted / 1024 / 1024)
+        if self.shared_hits:
+            res += ", from shared cache: %s (%.2f MB)" % (self.shared_hits, self.bytes_shared / 1024 / 1024)
+        return res
+
+
+class DataCache(object):
+    """
+    Content-addressed cache of experiment data files.
+    Data file is stored once as blobs/{sha256}.bin, {experiment_id}.bin in the cache directory is a hard link
+    to the blob (symlink if hard links are not supported), so the same data submitted under several experiments
+    is downloaded and stored only once. Each blob use touches its .downloaded marker, its mtime is the last use time
+    used by the LRU eviction.
+    Optional shared tier is a DataCache on a cluster-shared file system. Blobs are downloaded to the shared
+    cache, once per cluster under the cross-host lock, and copied to this cache, or with copy_shared unset
+    experiment files link to the shared blobs directly.
+    """
+    BLOB_DIR = 'blobs'
+
+    def __init__(self, data_dir, max_size=None, stats_file=None, shared=None, copy_shared=True):
+        self.data_dir = data_dir
+        self.blob_dir = os.path.join(data_dir, self.BLOB_DIR)
+        self.max_size = max_size
+        self.stats_file = stats_file
+        self.shared = shared
+        self.copy_shared = copy_shared
+        self.stats = CacheStats()
+        self.stats_lock = threading.Lock()
+
+    @staticmethod
+    def is_cas(data_dir):
+        return os.path.isdir(os.path.join(data_dir, DataCache.BLOB_DIR))
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, "{}.bin".format(digest.hex()))
+
+    def touch(self, blob):
+        rtt_utils.try_fnc(lambda: os.utime(blob + '.downloaded', None))
+
+    def link(self, blob, path, digest):
+        """Points path to the blob, atomically replacing the previous file"""
+        try:
+            if os.path.samefile(blob, path) and os.path.exists(path + '.downloaded'):
+                return
+        except OSError:
+            pass
+
+        tmp_path = rtt_utils.get_tmp_path(path)
+        rtt_utils.try_remove(tmp_path)
+        try:
+            try:
+                os.link(blob, tmp_path)
+            except OSError as e:
+                logger.debug("Hard link failed, using symlink: %s" % (e,))
+                os.symlink(os.path.abspath(blob), tmp_path)
+
+            rtt_utils.try_remove(path + '.downloaded')
+            os.replace(tmp_path, path)
+            write_download_marker(path, digest)
+
+        finally:
+            rtt_utils.try_remove(tmp_path)
+
+    def fetch_blob(self, sftp, src, expected_hash, force=False, num_streams=1, verify_rate=0.0, codec=None):
+        """Downloads remote src with the expected hash to the blob store if not present, returns the downloader"""
+        os.makedirs(self.blob_dir, 0o2770, True)
+        blob = self.blob_path(expected_hash)
+
+        downloader = LockedDownloader(sftp, blob, num_streams=num_streams, verify_rate=verify_rate, codec=codec)
+        downloader.download(src, force=force, expected_hash=expected_hash)
+        self.touch(blob)
+        return downloader
+
+    def copy_blob(self, src_blob, blob, expected_hash, locker=None):
+        """Copies the blob of the shared tier to blob, verifying the hash. The caller holds the blob lock."""
+        rtt_utils.try_remove(blob + '.downloaded')
+        tmp_path = rtt_utils.get_tmp_path(blob)
+        hasher = hashlib.sha256()
+        try:
+            with open(src_blob, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+                for data in iter(lambda: fsrc.read(4*1024*1024), b""):
+                    hasher.update(data)
+                    fdst.write(data)
+                    if locker:
+                        locker.touch()
+
+            digest = hasher.digest()
+            if digest != expected_hash:
+                raise DownloadFailedException('Hash of the shared blob %s does not match' % src_blob)
+            os.replace(tmp_path, blob)
+            write_download_marker(blob, digest)
+            return digest
+
+        finally:
+            rtt_utils.try_remove(tmp_path)
+
+    def fetch_shared(self, sftp, src, expected_hash, force=False, num_streams=1, verify_rate=0.0, codec=None):
+        """
+        Two-tier fetch, returns (blob, digest, downloaded, copied). Local blob is checked first under the local lock,
+        if missing it is copied from the shared cache, where it is downloaded if not present.
+        """
+        def fetch_shared_blob():
+            return self.shared.fetch_blob(sftp, src, expected_hash, force=force, num_streams=num_streams,
+                                          verify_rate=verify_rate, codec=codec)
+
+        if not self.copy_shared:
+            downloader = fetch_shared_blob()
+            return self.shared.blob_path(expected_hash), downloader.digest, downloader.downloaded, False
+
+        os.makedirs(self.blob_dir, 0o2770, True)
+        blob = self.blob_path(expected_hash)
+        checker = LockedDownloader(None, blob, verify_rate=verify_rate)
+        with checker.locker:
+            digest = None if force else checker.check_downloaded(expected_hash)
+            if digest is not None:
+                self.touch(blob)
+                return blob, digest, False, False
+
+            downloader = fetch_shared_blob()
+            logger.info("Copying blob from the shared cache to %s" % blob)
+            digest = self.copy_blob(self.shared.blob_path(expected_hash), blob, expected_hash, checker.locker)
+            return blob, digest, downloader.downloaded, True
+
+    def fetch(self, sftp, src, path, expected_hash, force=False, num_streams=1, verify_rate=0.0, codec=None):
+        """Downloads remote src with the expected hash to the blob store if not present, links it to path"""
+        if self.shared:
+            blob, digest, downloaded, copied = self.fetch_shared(sftp, src, expected_hash, force=force,
+                                                                 num_streams=num_streams, verify_rate=verify_rate,
+                                                                 codec=codec)
+        else:
+            downloader = self.fetch_blob(sftp, src, expected_hash, force=force, num_streams=num_streams,
+                                         verify_rate=verify_rate, codec=codec)
+            blob, digest, downloaded, copied = self.blob_path(expected_hash), downloader.digest, \
+                downloader.downloaded, False
+        self.link(blob, path, digest)
+
+        fsize = rtt_utils.try_fnc(lambda: os.path.getsize(blob)) or 0
+        with self.stats_lock:
+            if downloaded:
+                self.stats.misses += 1
+                self.stats.bytes_downloaded += fsize
+            elif copied:
+                self.stats.shared_hits += 1
+                self.stats.bytes_shared += fsize
+            else:
+                self.stats.hits += 1
+                self.stats.bytes_saved += fsize
+
+        result = 'miss' if downloaded else ('shared hit' if copied else 'hit')
+        logger.info("Data cache %s for %s, blob %s" % (result, path, blob))
+        self.save_stats()
+        return digest
+
+    def save_stats(self):
+        if not self.stats_file:
+            return
+        try:
+            with self.stats_lock:
+                data = dict(self.stats.to_dict(), time=time.time())
+            tmp_path = rtt_utils.get_tmp_path(self.stats_file)
+            with open(tmp_path, 'w') as fh:
+                json.dump(data, fh)
+            os.replace(tmp_path, self.stats_file)
+
+        except Exception as e:
+            logger.warning("Could not save cache stats: %s" % (e,))
+
+    def list_blobs(self):
+        """Returns list of (blob_path, size, last_use) of completely downloaded blobs"""
+        res = []
+        if not os.path.isdir(self.blob_dir):
+            return res
+
+        for fname in os.listdir(self.blob_dir):
+            if not fname.endswith('.bin'):
+                continue
+            blob = os.path.join(self.blob_dir, fname)
+            try:
+                res.append((blob, os.path.getsize(blob), os.stat(blob + '.downloaded').st_mtime))
+            except OSError:
+                pass
+        return res
+
+    def get_links(self, removed=None):
+        """
+        Maps (st_dev, st_ino) of blobs to the experiment files in the cache directory pointing to them.
+        Files in removed are considered deleted.
+        """
+        res = collections.defaultdict(list)
+        removed = set(removed or [])
+        for fname in os.listdir(self.data_dir):
+            if not fname.endswith('.bin'):
+                continue
+            fpath = os.path.join(self.data_dir, fname)
+            if fpath in removed:
+                continue
+            try:
+                st = os.stat(fpath)
+                res[(st.st_dev, st.st_ino)].append(fpath)
+            except OSError:
+                pass
+        return res
+
+    def remove_dangling(self, dry_run=False):
+        """
+        Removes experiment files which are symlinks to missing blobs, with their markers. Such links remain
+        when linked shared blobs (copy_shared unset) are evicted from the shared cache. Returns removed paths.
+        """
+        res = []
+        for fname in os.listdir(self.data_dir):
+            fpath = os.path.join(self.data_dir, fname)
+            if not fname.endswith('.bin') or not os.path.islink(fpath) or os.path.exists(fpath):
+                continue
+            res.append(fpath)
+            if dry_run:
+                logger.info("Would remove dangling link %s" % fpath)
+                continue
+
+            logger.info("Removing dangling link %s" % fpath)
+            rtt_utils.try_remove(fpath)
+            for assoc in rtt_utils.get_associated_files(fpath):
+                rtt_utils.try_remove(assoc)
+        return res
+
+    def find_links(self, blob, links=None):
+        """Experiment files in the cache directory pointing to the blob"""
+        try:
+            st = os.stat(blob)
+        except OSError:
+            return []
+        links = links if links is not None else self.get_links()
+        return links.get((st.st_dev, st.st_ino), [])
+
+    def remove_blob(self, blob, links=None):
+        """Removes the blob and experiment files linked to it, if the blob is not locked"""
+        locker = rtt_utils.FileLocker(blob + '.lock', lock_timeout=1)
+        if not locker.acquire_try_once():
+            logger.info("Blob %s is locked, not removing" % blob)
+            return False
+
+        try:
+            for link in self.find_links(blob, links):
+                logger.info("Removing cached file %s" % link)
+                rtt_utils.try_remove(link)
+                for assoc in rtt_utils.get_associated_files(link):
+                    rtt_utils.try_remove(assoc)
+
+            logger.info("Removing blob %s" % blob)
+            os.remove(blob)
+            for assoc in rtt_utils.get_associated_files(blob):
+                if assoc != locker.path:
+                    rtt_utils.try_remove(assoc)
+            return True
+
+        finally:
+            # Release removes the lock file, removing it again could remove a lock acquired meanwhile
+            locker.release()
+
+    def evict(self, protected=None, max_size=None, unused=False, dry_run=False, removed=None):
+        """
+        Evicts least recently used blobs until the cache fits max_size.
+        Blobs with digests in protected (experiments with pending jobs) are kept.
+        If unused is set, blobs without linked experiment files are removed as well.
+        With dry_run nothing is removed, experiment files in removed are considered deleted.
+        Returns number of bytes freed.
+        """
+        max_size = max_size if max_size is not None else self.max_size
+        protected = set(protected or [])
+        blobs = sorted(self.list_blobs(), key=lambda x: x[2])
+        total = sum(x[1] for x in blobs)
+        links = self.get_links(removed)
+        freed = 0
+
+        for blob, size, last_use in blobs:
+            digest = os.path.splitext(os.path.basename(blob))[0]
+            if digest in protected:
+                continue
+
+            over_size = max_size is not None and total - freed > max_size
+            if not over_size and not (unused and not self.find_links(blob, links)):
+                continue
+
+            if dry_run:
+                logger.info("Would evict blob %s, %.2f MB" % (blob, size / 1024 / 1024))
+                freed += size
+
+            elif self.remove_blob(blob, links):
+                freed += size
+                with self.stats_lock:
+                    self.stats.evictions += 1
+                    self.stats.bytes_evicted += size
+
+        if freed and not dry_run:
+            logger.info("Data cache eviction freed %.2f MB, cache size %.2f MB"
+                        % (freed / 1024 / 1024, (total - freed) / 1024 / 1024))
+            self.save_stats()
+        return freed
+
+
+class CacheRegistry(object):
+    """
+    Registry of experiment data cached by workers, the cache_registry table.
+    cache_id identifies the cache directory, shared by all workers using it, location groups caches of a cluster.
+    Experiments are registered on download, sync() reconciles the table with the cache directory content
+    so evicted and cleaned data are unregistered.
+    """
+    def __init__(self, cache_id, location=None, worker_id=None, chunk=1000):
+        self.cache_id = cache_id
+        self.location = location
+        self.worker_id = worker_id
+        self.chunk = chunk
+
+    @staticmethod
+    def is_available(cursor):
+        """False if the registry table was not created yet, i.e., migrations were not applied"""
+        try:
+            cursor.execute("SELECT 1 FROM cache_registry LIMIT 1")
+            cursor.fetchall()
+            return True
+        except Exception as e:
+            logger.warning("Cache registry not available: %s" % (e,))
+            return False
+
+    def register(self, cursor, experiment_ids):
+        experiment_ids = sorted(set(experiment_ids))
+        for offset in range(0, len(experiment_ids), self.chunk):
+            cids = experiment_ids[offset:offset + self.chunk]
+            values = ','.join(['(%s, %s, %s, %s)'] * len(cids))
+            params = []
+            for eid in cids:
+                params += [self.cache_id, eid, self.location, self.worker_id]
+            cursor.execute("""INSERT INTO cache_registry(cache_id, experiment_id, location, worker_id) 
+                              VALUES %s 
+                              ON DUPLICATE KEY UPDATE updated=NOW(), location=VALUES(location), 
+                              worker_id=VALUES(worker_id)""" % values, params)
+
+    def unregister(self, cursor, experiment_ids):
+        experiment_ids = sorted(set(experiment_ids))
+        for offset in range(0, len(experiment_ids), self.chunk):
+            cids = experiment_ids[offset:offset + self.chunk]
+            cursor.execute("DELETE FROM cache_registry WHERE cache_id=%%s AND experiment_id IN (%s)"
+                           % ','.join(['%s'] * len(cids)), [self.cache_id] + cids)
+
+    def sync(self, cursor, experiment_ids):
+        """Makes the registry of this cache match experiment_ids present in the cache, returns (added, removed)"""
+        cursor.execute("SELECT experiment_id FROM cache_registry WHERE cache_id=%s", (self.cache_id,))
+        registered = set(row[0] for row in cursor.fetchall())
+        present = set(experiment_ids)
+        self.unregister(cursor, registered - present)
+        self.register(cursor, present - registered)
+        return len(present - registered), len(registered - present)
+
+
+def load_cache_id(main_cfg, data_dir):
+    """
+    Cache identifier from Local-cache/Cache-id, workers sharing the cache directory on a shared FS
+    should configure the same value. Defaults to host:directory.
+    """
+    return main_cfg.get('Local-cache', 'Cache-id', fallback=None) \
+        or '%s:%s' % (socket.gethostname(), os.path.abspath(data_dir))
+
+
+def get_protected_hashes(cursor):
+    """Data file hashes of experiments which are not finished yet, kept in the cache"""
+    cursor.execute("SELECT DISTINCT data_file_sha256 FROM experiments WHERE status!='finished'")
+    return set(row[0].lower() for row in cursor.fetchall() if row[0])
+
+
+def load_max_size(main_cfg, section='Local-cache'):
+    """Cache size limit from the Local-cache section, in bytes. None if not set"""
+    max_size = main_cfg.getint(section, 'Max-size-mb', fallback=None)
+    return max_size * 1024 * 1024 if max_size else None
+
+
+def load_shared_cache(main_cfg):
+    """
+    Cluster-shared cache tier from the Shared-cache section, None if not configured.
+    Returns (DataCache, copy_shared), copy_shared is False if workers should read the shared blobs in place.
+    """
+    data_dir = main_cfg.get('Shared-cache', 'Data-directory', fallback=None)
+    if not data_dir:
+        return None, True
+    rtt_utils.try_fnc(lambda: os.makedirs(data_dir, 0o2770, True))
+    shared = DataCache(data_dir, max_size=load_max_size(main_cfg, 'Shared-cache'))
+    return shared, main_cfg.getboolean('Shared-cache', 'Copy-local', fallback=True)
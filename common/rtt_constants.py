@@ -5,6 +5,8 @@
 class CommonConst(object):
     COMMON_FILES_DIR = "common"
     CREATE_TABLES_SCRIPT = "files/create_rtt_tables.sql"
+    MIGRATIONS_DIR = "files/migrations"
+    MIGRATE_DB_SCRIPT = "files/migrate_db.py"
     STORAGE_CLEAN_CACHE = "files/clean_cache.py"
     FRONTEND_SUBMIT_EXPERIMENT_SCRIPT = "files/submit_experiment.py"
     FRONTEND_ADD_USER_SCRIPT = "files/add_rtt_user.py"
@@ -1,4 +1,6 @@
 import configparser
+import contextlib
+import threading
 import MySQLdb
 import sys
 from common.clilogging import *
@@ -70,3 +72,102 @@ def create_mysql_db_conn(main_cfg, host_override=None, port_override=None):
     params = mysql_load_params(main_cfg, host_override=host_override, port_override=port_override)
     return connect_mysql_db(params)
 
+
+
+class MySQLPool(object):
+    """
+    Thread-safe pool of MySQL connections for worker threads.
+    MySQLdb connections must not be used by more threads at once, each thread borrows
+    a connection for the duration of the operation and returns it back.
+    """
+    def __init__(self, params: MySQLParams):
+        self.params = params
+        self.lock = threading.Lock()
+        self.idle = []
+        self.conns = []
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+
+        db = connect_mysql_db(self.params)
+        with self.lock:
+            self.conns.append(db)
+        return db
+
+    def put(self, db, discard=False):
+        with self.lock:
+            if not discard:
+                self.idle.append(db)
+                return
+            if db in self.conns:
+                self.conns.remove(db)
+
+        try:
+            db.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        db = self.get()
+        try:
+            yield db
+
+        except BaseException as e:
+            # Broken connections (e.g., server gone away) are not returned to the pool
+            is_broken = isinstance(e, MySQLdb.OperationalError) and e.args and e.args[0] in [2006, 2013]
+            try:
+                db.rollback()
+            except Exception:
+                is_broken = True
+            self.put(db, discard=is_broken)
+            raise
+
+        else:
+            self.put(db)
+
+    def close(self):
+        with self.lock:
+            conns, self.conns, self.idle = self.conns, [], []
+        for db in conns:
+            try:
+                db.close()
+            except Exception:
+                pass
+
+
+JOBS_GENERATION = 'jobs'
+JOBS_RESETS = 'jobs_resets'
+ER_NO_SUCH_TABLE = 1146
+
+
+def bump_jobs_generation(cursor, reset=False):
+    """
+    Increments the jobs generation counter, call it in the transaction adding or resetting pending jobs.
+    Idle workers poll the counter and wake up when it changes. With reset (existing jobs moved back
+    to pending) the resets counter is incremented too, the dispatcher then reloads all pending jobs instead
+    of only the new ones. Returns False if the counter table does not exist yet (migration 0004 not applied).
+    Other errors propagate, e.g., a deadlock rolls back the whole transaction, so the caller must not
+    commit it as successful.
+    """
+    names = (JOBS_GENERATION, JOBS_RESETS) if reset else (JOBS_GENERATION,)
+    try:
+        cursor.execute("INSERT INTO rtt_counters (name, value) VALUES %s "
+                       "ON DUPLICATE KEY UPDATE value=value+1" % ','.join(['(%s, 1)'] * len(names)), names)
+        return True
+    except MySQLdb.Error as e:
+        if e.args and e.args[0] == ER_NO_SUCH_TABLE:
+            return False
+        raise
+
+
+def get_jobs_generation(cursor):
+    """Current jobs generation counter value, None if not available"""
+    try:
+        cursor.execute("SELECT value FROM rtt_counters WHERE name=%s", (JOBS_GENERATION,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    except MySQLdb.Error:
+        return None
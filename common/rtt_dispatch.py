@@ -0,0 +1,516 @@
+import collections
+import heapq
+import json
+import logging
+import threading
+import time
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import rtt_utils
+
+
+logger = logging.getLogger(__name__)
+JOBS_RESETS = 'jobs_resets'  # counter of resets of jobs back to pending, see rtt_db_conn.bump_jobs_generation
+DispatchedJob = collections.namedtuple("DispatchedJob", "id experiment_id battery")
+
+# Minimal schema of the tables used by the dispatcher, for local testing with SQLite
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    status          VARCHAR(32) NOT NULL DEFAULT 'pending',
+    run_started     DATETIME DEFAULT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    battery         VARCHAR(100) NOT NULL,
+    status          VARCHAR(32) NOT NULL DEFAULT 'pending',
+    run_started     DATETIME DEFAULT NULL,
+    run_heartbeat   DATETIME DEFAULT NULL,
+    experiment_id   INTEGER NOT NULL,
+    worker_id       INTEGER DEFAULT NULL,
+    worker_pid      INTEGER DEFAULT NULL,
+    lock_version    INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status_experiment ON jobs(status, experiment_id);
+CREATE TABLE IF NOT EXISTS cache_registry (
+    cache_id        VARCHAR(190) NOT NULL,
+    experiment_id   INTEGER NOT NULL,
+    location        VARCHAR(190) DEFAULT NULL,
+    worker_id       INTEGER DEFAULT NULL,
+    updated         DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (cache_id, experiment_id)
+);
+CREATE TABLE IF NOT EXISTS rtt_counters (
+    name            VARCHAR(64) NOT NULL PRIMARY KEY,
+    value           BIGINT NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS rtt_settings (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    name            VARCHAR(100) NOT NULL UNIQUE,
+    value           VARCHAR(255) DEFAULT NULL
+);
+"""
+
+
+class DispatchStore(object):
+    """
+    Database access of the dispatcher. Only portable SQL is used so the dispatcher runs on MySQL and SQLite,
+    the connection is created by connect_fnc, paramstyle is 'format' (MySQLdb) or 'qmark' (sqlite3).
+    Operations are serialized, the dispatcher is the only claimer so claims are short.
+    """
+    def __init__(self, connect_fnc, paramstyle='format'):
+        self.connect_fnc = connect_fnc
+        self.ph = '?' if paramstyle == 'qmark' else '%s'
+        self.db = None
+        self.lock = threading.Lock()
+
+    def sql(self, sql):
+        return sql.replace('%s', self.ph)
+
+    def run(self, fnc):
+        """Runs fnc(cursor) in a transaction, reconnects on the next call after a failure"""
+        with self.lock:
+            try:
+                if self.db is None:
+                    self.db = self.connect_fnc()
+                cursor = self.db.cursor()
+                res = fnc(cursor)
+                cursor.close()
+                self.db.commit()
+                return res
+
+            except Exception:
+                rtt_utils.try_fnc(lambda: self.db.rollback())
+                rtt_utils.try_fnc(lambda: self.db.close())
+                self.db = None
+                raise
+
+    def load_pending(self, after_id=None):
+        """
+        Returns (pending jobs, IDs of experiments not started yet). With after_id only jobs with a higher ID
+        are loaded and only their experiments are checked.
+        """
+        def fnc(c):
+            if after_id is None:
+                c.execute("SELECT id, experiment_id, battery FROM jobs WHERE status='pending' ORDER BY id")
+            else:
+                c.execute(self.sql("SELECT id, experiment_id, battery FROM jobs WHERE status='pending' AND id>%s "
+                                   "ORDER BY id"), (after_id,))
+            jobs = [DispatchedJob(*row) for row in c.fetchall()]
+            if after_id is None:
+                c.execute("SELECT id FROM experiments WHERE status='pending'")
+                return jobs, set(row[0] for row in c.fetchall())
+
+            exp_ids = sorted(set(x.experiment_id for x in jobs))
+            if not exp_ids:
+                return jobs, set()
+            c.execute(self.sql("SELECT id FROM experiments WHERE status='pending' AND id IN (%s)"
+                               % ','.join(['%s'] * len(exp_ids))), exp_ids)
+            return jobs, set(row[0] for row in c.fetchall())
+        return self.run(fnc)
+
+    def load_counter(self, name):
+        """Value of the counter from rtt_counters, 0 if not set yet. Raises if the table does not exist"""
+        def fnc(c):
+            c.execute(self.sql("SELECT value FROM rtt_counters WHERE name=%s"), (name,))
+            row = c.fetchone()
+            return row[0] if row else 0
+        return self.run(fnc)
+
+    def load_location_cache(self):
+        """Maps location to IDs of experiments cached there, from the cache registry"""
+        def fnc(c):
+            c.execute("SELECT location, experiment_id FROM cache_registry WHERE location IS NOT NULL")
+            res = collections.defaultdict(set)
+            for location, eid in c.fetchall():
+                res[location].add(eid)
+            return res
+        return self.run(fnc)
+
+    def load_settings(self):
+        def fnc(c):
+            c.execute("SELECT name, value FROM rtt_settings")
+            return {row[0]: row[1] for row in c.fetchall()}
+        return self.run(fnc)
+
+    def claim(self, job: DispatchedJob, worker_id, worker_pid):
+        """Marks the job as running by the worker, False if it is not pending anymore"""
+        def fnc(c):
+            c.execute(self.sql("""UPDATE jobs SET run_started=CURRENT_TIMESTAMP, status='running',
+                                  run_heartbeat=CURRENT_TIMESTAMP, worker_id=%s, worker_pid=%s,
+                                  lock_version=lock_version+1
+                                  WHERE id=%s AND status='pending'"""), (worker_id, worker_pid, job.id))
+            if c.rowcount <= 0:
+                return False
+            c.execute(self.sql("""UPDATE experiments SET run_started=CURRENT_TIMESTAMP, status='running'
+                                  WHERE id=%s AND status='pending'"""), (job.experiment_id,))
+            return True
+        return self.run(fnc)
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                rtt_utils.try_fnc(lambda: self.db.close())
+                self.db = None
+
+
+class JobIndex(object):
+    """
+    In-memory index of pending jobs grouped by experiment, ordered by job ID.
+    Experiments are kept in heaps by their first job ID, so a claim does not scan all experiments.
+    Heap entries are invalidated lazily, an entry is valid while it matches the first job of a pending experiment.
+    """
+    def __init__(self):
+        self.by_exp = {}  # experiment_id -> deque of DispatchedJob
+        self.ids = set()  # IDs of indexed jobs
+        self.pending_exps = set()
+        self.heap = []  # (first job ID, experiment_id) of all experiments
+        self.pending_heap = []  # (first job ID, experiment_id) of experiments nobody started yet
+        self.size = 0
+
+    def rebuild(self, jobs, pending_exps):
+        self.by_exp = {}
+        for job in sorted(jobs, key=lambda x: x.id):
+            self.by_exp.setdefault(job.experiment_id, collections.deque()).append(job)
+        self.ids = set(x.id for x in jobs)
+        self.pending_exps = set(pending_exps) & self.by_exp.keys()
+        self.heap = [(x[0].id, eid) for eid, x in self.by_exp.items()]
+        self.pending_heap = [(self.by_exp[eid][0].id, eid) for eid in self.pending_exps]
+        heapq.heapify(self.heap)
+        heapq.heapify(self.pending_heap)
+        self.size = len(jobs)
+
+    def add(self, jobs, pending_exps):
+        """Adds jobs loaded incrementally, already indexed jobs are skipped"""
+        for job in sorted(jobs, key=lambda x: x.id):
+            if job.id in self.ids:
+                continue
+            exp_jobs = self.by_exp.setdefault(job.experiment_id, collections.deque())
+            if exp_jobs and exp_jobs[-1].id > job.id:
+                # Job committed later than jobs with higher IDs, rare
+                exp_jobs.insert(sum(1 for x in exp_jobs if x.id < job.id), job)
+            else:
+                exp_jobs.append(job)
+            self.ids.add(job.id)
+            self.size += 1
+            if exp_jobs[0] is job:
+                heapq.heappush(self.heap, (job.id, job.experiment_id))
+                if job.experiment_id in self.pending_exps:
+                    heapq.heappush(self.pending_heap, (job.id, job.experiment_id))
+
+        for exp_id in set(pending_exps) & self.by_exp.keys() - self.pending_exps:
+            self.pending_exps.add(exp_id)
+            heapq.heappush(self.pending_heap, (self.by_exp[exp_id][0].id, exp_id))
+
+    def first_id(self, exp_id):
+        jobs = self.by_exp.get(exp_id)
+        return jobs[0].id if jobs else None
+
+    def pop(self, exp_id):
+        jobs = self.by_exp.get(exp_id)
+        if not jobs:
+            return None
+        job = jobs.popleft()
+        self.ids.discard(job.id)
+        self.size -= 1
+        if jobs:
+            heapq.heappush(self.heap, (jobs[0].id, exp_id))
+        else:
+            del self.by_exp[exp_id]
+        self.pending_exps.discard(exp_id)
+        return job
+
+    def pop_heap(self, heap, valid):
+        """Pops the job of the experiment with the lowest first job ID in the heap, None if empty"""
+        while heap:
+            job_id, exp_id = heap[0]
+            if valid(exp_id) and self.first_id(exp_id) == job_id:
+                return self.pop(exp_id)
+            heapq.heappop(heap)
+        return None
+
+    def pop_first(self, exp_ids):
+        """Pops the job with the lowest ID from the experiments, linear in the number of exp_ids"""
+        firsts = [(self.first_id(x), x) for x in exp_ids if x in self.by_exp]
+        return self.pop(min(firsts)[1]) if firsts else None
+
+    def take(self, cached=None, nearby=None):
+        """
+        Next job for a worker with experiments cached, preference order is the same as of direct claiming:
+        job of a cached experiment, of an experiment cached nearby (same location), of an experiment
+        nobody started yet, any job.
+        """
+        return self.pop_first(cached or ()) or self.pop_first(nearby or ()) \
+            or self.pop_heap(self.pending_heap, lambda x: x in self.pending_exps) \
+            or self.pop_heap(self.heap, lambda x: True)
+
+
+class DispatchStats(object):
+    def __init__(self):
+        self.claims = 0
+        self.cached_claims = 0
+        self.nearby_claims = 0
+        self.empty = 0
+        self.conflicts = 0
+        self.refreshes = 0
+        self.full_refreshes = 0
+        self.refresh_time = 0.0
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class Dispatcher(object):
+    """
+    Job dispatcher running next to the DB. Pending jobs are loaded to the JobIndex every refresh_interval,
+    workers claim jobs from the index over HTTP instead of querying the DB. Only jobs with IDs above
+    the last loaded one are loaded (id_lookback covers transactions committed out of ID order),
+    all pending jobs are reloaded when jobs were reset back to pending (the resets counter changed)
+    and every full_refresh_interval.
+    Claim request waits up to the requested time for new jobs (long-poll).
+    Each claim is a conditional UPDATE, a job claimed meanwhile by a direct DB claimer is skipped.
+    """
+    def __init__(self, store: DispatchStore, refresh_interval=5, settings_interval=30, max_wait=60,
+                 full_refresh_interval=300, id_lookback=1000):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.id_lookback = id_lookback
+        self.settings_interval = settings_interval
+        self.max_wait = max_wait
+        self.index = JobIndex()
+        self.settings = {}
+        self.location_cached = {}  # location -> experiment IDs cached there, from the cache registry
+        self.registry_available = True
+        self.counters_available = True
+        self.resets = None  # resets counter at the last full load
+        self.max_job_id = None  # highest loaded job ID, None before the first full load
+        self.claimed = set()  # jobs claimed since the refresh started, may be pending in its snapshot
+        self.inflight = set()  # jobs taken from the index, claim not finished yet
+        self.stats = DispatchStats()
+        self.cond = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last_refresh = 0
+        self.last_full_refresh = 0
+        self.last_settings = 0
+
+    def refresh(self):
+        tstart = time.time()
+        resets = self.load_resets()
+        full = resets is None or resets != self.resets or self.max_job_id is None \
+            or tstart - self.last_full_refresh > self.full_refresh_interval
+        with self.cond:
+            self.claimed = set()
+        after_id = None if full else max(0, self.max_job_id - self.id_lookback)
+        jobs, pending_exps = self.store.load_pending(after_id)
+        with self.cond:
+            taken = self.claimed | self.inflight
+            max_loaded = max([x.id for x in jobs], default=0)
+            jobs = [x for x in jobs if x.id not in taken]
+            if full:
+                self.index.rebuild(jobs, pending_exps)
+                self.resets, self.last_full_refresh = resets, tstart
+                self.max_job_id = 0
+                self.stats.full_refreshes += 1
+            else:
+                self.index.add(jobs, pending_exps)
+            self.max_job_id = max(self.max_job_id, max_loaded)
+            self.stats.refreshes += 1
+            self.stats.refresh_time += time.time() - tstart
+            self.last_refresh = time.time()
+            if self.index.size:
+                self.cond.notify_all()
+
+        if time.time() - self.last_settings > self.settings_interval:
+            settings = self.store.load_settings()
+            location_cached = self.load_location_cache()
+            with self.cond:
+                self.settings = settings
+                self.location_cached = location_cached
+            self.last_settings = time.time()
+
+    def load_resets(self):
+        """Resets counter, None if not available, then all pending jobs are loaded on each refresh"""
+        if not self.counters_available:
+            return None
+        try:
+            return self.store.load_counter(JOBS_RESETS)
+        except Exception as e:
+            logger.warning("Counters not available, pending jobs are always fully reloaded: %s" % (e,))
+            self.counters_available = False
+            return None
+
+    def load_location_cache(self):
+        if not self.registry_available:
+            return {}
+        try:
+            return self.store.load_location_cache()
+        except Exception as e:
+            logger.warning("Cache registry not available, location affinity disabled: %s" % (e,))
+            self.registry_available = False
+            return {}
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Exception in dispatcher refresh: %s" % (e,), exc_info=e)
+            self.stop_event.wait(self.refresh_interval)
+
+    def start(self):
+        self.refresh()
+        self.thread = threading.Thread(target=self.run, args=(), name='dispatch-refresh', daemon=True)
+        self.thread.start()
+        return self
+
+    def claim(self, worker_id, worker_pid, cached=None, wait=0, location=None):
+        """Claims a job for the worker, waits up to wait seconds for one. Returns DispatchedJob or None"""
+        cached = set(cached or [])
+        deadline = time.time() + min(max(0, wait or 0), self.max_wait)
+
+        while not self.stop_event.is_set():
+            with self.cond:
+                nearby = self.location_cached.get(location, ()) if location else ()
+                job = self.index.take(cached, nearby)
+                if job is None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.stats.empty += 1
+                        return None
+                    self.cond.wait(remaining)
+                    continue
+                self.inflight.add(job.id)
+
+            claimed = None
+            try:
+                claimed = self.store.claim(job, worker_id, worker_pid)
+            finally:
+                with self.cond:
+                    self.inflight.discard(job.id)
+                    if claimed:
+                        self.claimed.add(job.id)
+                        self.stats.claims += 1
+                        self.stats.cached_claims += int(job.experiment_id in cached)
+                        self.stats.nearby_claims += int(job.experiment_id not in cached and job.experiment_id in nearby)
+                    elif claimed is False:
+                        self.stats.conflicts += 1
+
+            if claimed:
+                logger.info("Job %s of experiment %s dispatched to worker %s" % (job.id, job.experiment_id, worker_id))
+                return job
+        return None
+
+    def get_settings(self):
+        with self.cond:
+            return dict(self.settings)
+
+    def get_stats(self):
+        with self.cond:
+            return dict(self.stats.to_dict(), pending=self.index.size, last_refresh=self.last_refresh)
+
+    def shutdown(self):
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(10)
+        self.store.close()
+
+
+class DispatchHandler(BaseHTTPRequestHandler):
+    dispatcher = None  # type: Dispatcher
+    token = None
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def check_token(self):
+        if self.token and self.headers.get('X-RTT-Token') != self.token:
+            self.send_json(403, {'error': 'forbidden'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.check_token():
+            return
+        if self.path == '/settings':
+            self.send_json(200, {'settings': self.dispatcher.get_settings()})
+        elif self.path == '/stats':
+            self.send_json(200, self.dispatcher.get_stats())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self.check_token():
+            return
+        if self.path != '/claim':
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            job = self.dispatcher.claim(req['worker_id'], req.get('worker_pid'), req.get('cached'),
+                                        float(req.get('wait', 0)), req.get('location'))
+            self.send_json(200, {'job': job._asdict() if job else None})
+
+        except (KeyError, ValueError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+
+        except Exception as e:
+            logger.error("Exception in claim: %s" % (e,), exc_info=e)
+            self.send_json(503, {'error': str(e)})
+
+
+def create_server(dispatcher: Dispatcher, host='0.0.0.0', port=8090, token=None):
+    handler = type('BoundDispatchHandler', (DispatchHandler,), {'dispatcher': dispatcher, 'token': token})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class DispatcherClient(object):
+    """Worker side of the dispatcher protocol"""
+    def __init__(self, url, token=None, timeout=30):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.token = token
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        """HTTP session of the calling thread, requests.Session is not thread-safe"""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            if self.token:
+                session.headers['X-RTT-Token'] = self.token
+        return session
+
+    def claim(self, worker_id, worker_pid, cached=None, wait=0, location=None):
+        """Returns DispatchedJob or None if there is no job, raises on dispatcher failure"""
+        resp = self.session.post(self.url + '/claim', timeout=self.timeout + wait,
+                                 json={'worker_id': worker_id, 'worker_pid': worker_pid,
+                                       'cached': list(cached or []), 'wait': wait, 'location': location})
+        resp.raise_for_status()
+        job = resp.json().get('job')
+        return DispatchedJob(job['id'], job['experiment_id'], job['battery']) if job else None
+
+    def settings(self):
+        resp = self.session.get(self.url + '/settings', timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()['settings']
+
+    def stats(self):
+        resp = self.session.get(self.url + '/stats', timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()
@@ -0,0 +1,125 @@
+import os
+import re
+import logging
+from common.rtt_constants import CommonConst
+
+
+logger = logging.getLogger(__name__)
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Statement errors meaning the change is already in place, e.g., index created by a partially applied migration
+# 1050: table exists, 1060: duplicate column, 1061: duplicate key name, 1091: can't drop, does not exist
+ALREADY_APPLIED_ERRORS = [1050, 1060, 1061, 1091]
+
+SQL_CREATE_MIGRATIONS = """CREATE TABLE IF NOT EXISTS schema_migrations (
+    version             INT UNSIGNED PRIMARY KEY NOT NULL,
+    name                VARCHAR(255) NOT NULL,
+    applied             TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE = INNODB"""
+
+
+class Migration(object):
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+    def statements(self):
+        with open(self.path) as fh:
+            return parse_sql_statements(fh.read())
+
+    def __repr__(self):
+        return "Migration(%04d, %s)" % (self.version, self.name)
+
+
+def parse_sql_statements(text):
+    """Splits SQL script to statements, drops -- comment lines"""
+    lines = [x for x in text.splitlines() if not x.strip().startswith('--')]
+    stmts = [x.strip() for x in '\n'.join(lines).split(';')]
+    return [x for x in stmts if x]
+
+
+def load_migrations(migrations_dir=None):
+    """Migrations from files NNNN_name.sql in the migrations dir, ordered by version"""
+    migrations_dir = migrations_dir or os.path.join(REPO_ROOT, CommonConst.MIGRATIONS_DIR)
+    res = []
+    for fname in sorted(os.listdir(migrations_dir)):
+        m = re.match(r'^(\d+)_(.+)\.sql$', fname)
+        if m:
+            res.append(Migration(int(m.group(1)), m.group(2), os.path.join(migrations_dir, fname)))
+
+    versions = [x.version for x in res]
+    if len(versions) != len(set(versions)):
+        raise ValueError("Duplicate migration versions in %s" % migrations_dir)
+    return sorted(res, key=lambda x: x.version)
+
+
+def get_applied_versions(cursor):
+    cursor.execute(SQL_CREATE_MIGRATIONS)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return set(row[0] for row in cursor.fetchall())
+
+
+def get_pending_migrations(cursor, target=None, migrations_dir=None):
+    applied = get_applied_versions(cursor)
+    return [x for x in load_migrations(migrations_dir)
+            if x.version not in applied and (target is None or x.version <= target)]
+
+
+def is_already_applied_error(e):
+    try:
+        return e.args[0] in ALREADY_APPLIED_ERRORS
+    except Exception:
+        return False
+
+
+def apply_migration(cursor, migration: Migration):
+    """
+    Executes the migration statements and records its version. DDL statements commit implicitly in MySQL,
+    thus statements failing because the change is already present are skipped, so a partially applied
+    migration can be re-run.
+    """
+    for stmt in migration.statements():
+        logger.info("Migration %04d: %s" % (migration.version, ' '.join(stmt.split())))
+        try:
+            cursor.execute(stmt)
+        except Exception as e:
+            if not is_already_applied_error(e):
+                raise
+            logger.info("Already applied, skipping: %s" % (e,))
+
+    cursor.execute("INSERT INTO schema_migrations(version, name) VALUES (%s, %s)",
+                   (migration.version, migration.name))
+
+
+def migrate(db, target=None, dry_run=False, migrations_dir=None):
+    """Applies pending migrations up to the target version, returns list of applied migrations"""
+    cursor = db.cursor()
+    pending = get_pending_migrations(cursor, target, migrations_dir)
+    db.commit()
+    if not pending:
+        logger.info("Database schema is up to date")
+
+    for migration in pending:
+        if dry_run:
+            logger.info("Would apply %s" % migration)
+            for stmt in migration.statements():
+                logger.info("  %s" % ' '.join(stmt.split()))
+            continue
+
+        logger.info("Applying %s" % migration)
+        apply_migration(cursor, migration)
+        db.commit()
+
+    cursor.close()
+    return pending
+
+
+def get_migrations_script(db_name, migrations_dir=None):
+    """SQL script applying all migrations to a freshly created database, for the mysql command line client"""
+    lines = ["USE %s;" % db_name, SQL_CREATE_MIGRATIONS + ";"]
+    for migration in load_migrations(migrations_dir):
+        lines += [x + ";" for x in migration.statements()]
+        lines.append("INSERT INTO schema_migrations(version, name) VALUES (%s, '%s');"
+                     % (migration.version, migration.name))
+    return '\n'.join(lines) + '\n'
@@ -1,6 +1,11 @@
+import collections
 import configparser
+import hashlib
+import json
+import random
+import threading
 import paramiko
-from paramiko.sftp import SFTPError
+from paramiko.sftp import CMD_EXTENDED, CMD_VERSION
 import sys
 import os
 import time
@@ -8,6 +13,16 @@ from common.clilogging import *
 import socket
 from . import rtt_utils
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compressed data on the storage server, file name suffix by codec
+CODEC_ZSTD = 'zstd'
+CODEC_SUFFIXES = {CODEC_ZSTD: '.zst'}
+
 
 class TimeLimitExceeded(Exception):
     pass
@@ -17,17 +32,96 @@ class DownloadFailedException(Exception):
     pass
 
 
+def codec_suffix(codec):
+    """Storage file name suffix of the data compressed with the codec, empty for uncompressed data"""
+    return CODEC_SUFFIXES[codec] if codec else ''
+
+
+def get_decompressor(codec):
+    """Streaming decompressor of the codec, None for uncompressed data"""
+    if not codec:
+        return None
+    if codec != CODEC_ZSTD:
+        raise DownloadFailedException('Unknown data codec: %s' % codec)
+    if zstandard is None:
+        raise DownloadFailedException('Package zstandard is required for %s compressed data' % codec)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def write_download_marker(path, digest):
+    """
+    Writes the .downloaded marker of the completely downloaded file path.
+    Marker stores SHA-256 of the file computed during the download and size, mtime of the file,
+    so the file can be verified later by a cheap metadata check.
+    """
+    st = os.stat(path)
+    meta = {'sha256': digest.hex(), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    tmp_path = rtt_utils.get_tmp_path(path + '.downloaded')
+    with open(tmp_path, 'w') as fh:
+        json.dump(meta, fh)
+    os.replace(tmp_path, path + '.downloaded')
+    return meta
+
+
+def read_download_marker(path):
+    """
+    Returns metadata stored in the .downloaded marker of the file path.
+    None if the marker is missing, {} for the legacy empty marker.
+    """
+    try:
+        with open(path + '.downloaded') as fh:
+            data = fh.read()
+    except FileNotFoundError:
+        return None
+
+    try:
+        meta = json.loads(data) if data.strip() else {}
+        return meta if isinstance(meta, dict) else {}
+    except ValueError:
+        return {}
+
+
+def marker_matches_file(path, meta):
+    """True if size and mtime of the file match the marker metadata"""
+    try:
+        st = os.stat(path)
+        return bool(meta) and 'sha256' in meta \
+            and meta.get('size') == st.st_size and meta.get('mtime_ns') == st.st_mtime_ns
+    except OSError:
+        return False
+
+
 class SftpDownloader(object):
-    def __init__(self, sftp, critical_speed=None, critical_time_zero_bytes=None):
+    """
+    Downloads a remote file over SFTP.
+    Single stream mode reads the file with paramiko prefetch, i.e., many pipelined read requests in flight.
+    With num_streams > 1 the file is split to blocks which are read concurrently over several SFTP channels
+    opened on the same SSH transport, blocks are written to the destination file in order.
+    The destination file always contains a valid prefix of the remote file, so an interrupted
+    download is resumed from the partial file.
+    With codec the remote file is compressed, it is decompressed on the fly, such download is not resumed.
+    SHA-256 of the file is computed incrementally from the written data, available in digest after the download.
+    """
+    def __init__(self, sftp, critical_speed=None, critical_time_zero_bytes=None, num_streams=1,
+                 block_size=8*1024*1024, codec=None):
         self.sftp = sftp
+        self.codec = codec
+        self.decompressor = None
         self.timeout = 60
         self.critical_speed = critical_speed
         self.critical_time_zero_bytes = critical_time_zero_bytes
+        self.num_streams = max(1, num_streams or 1)
+        self.block_size = block_size
+        self.read_size = 1024 * 1024
+        self.max_requests = 128
         self.stat = None
         self.callback = None  # (SftpDownloader) -> Void
+        self.hasher = None
+        self.digest = None
 
         self.time_started = None
         self.time_transfer = None
+        self.offset = 0
         self.bytes_downloaded = 0
         self.last_bytes = 0
         self.last_speed = 0
@@ -35,107 +129,608 @@ class SftpDownloader(object):
         self.last_log = 0
         self.first_zero_bytes_time = None
 
+        self.lock = threading.Condition()
+        self.blocks = {}
+        self.error = None
+        self.terminating = False
+
     @property
     def file_size(self):
         return self.stat.st_size
 
+    @property
+    def bytes_done(self):
+        return self.offset + self.bytes_downloaded
+
     def reset(self):
         self.last_bytes = 0
         self.num_zero_bytes = 0
         self.first_zero_bytes_time = None
         self.time_started = None
+        self.offset = 0
         self.bytes_downloaded = 0
         self.time_transfer = 0
         self.last_log = 0
+        self.blocks = {}
+        self.error = None
+        self.terminating = False
+        self.hasher = hashlib.sha256()
+        self.digest = None
+        self.decompressor = get_decompressor(self.codec)
 
     def stat_file(self, src):
         self.stat = self.sftp.stat(src)
 
-    def get(self, src, dest):
-        self.reset()
-        self.time_started = time.time()
+    def on_progress(self):
+        """Called periodically from the writing thread, checks transfer health. Returns False to abort."""
+        self.time_transfer = (time.time() - self.time_started) + 0.1
+        speed = self.bytes_downloaded / self.time_transfer
+        self.last_speed = speed
 
-        logger.info("Loading stats for file %s" % src)
-        self.sftp.get_channel().settimeout(self.timeout)
-        self.stat_file(src)
-        self.last_log = time.time() - 10
+        if self.callback:
+            self.callback(self)
+
+        if time.time() - self.last_log > 30:
+            logger.debug("Download progress, time: %.2f, speed: %.2f MBps, downloaded %s/%s  %.2f %%"
+                         % (self.time_transfer, speed / 1024 / 1024, self.bytes_done, self.file_size,
+                            100.0 * self.bytes_done / max(1, self.file_size)))
+            self.last_log = time.time()
+
+        if self.critical_speed and self.time_transfer > 60 and speed < self.critical_speed:
+            logger.info("Critical speed reached after %.2f sec, speed: %.2f MBps, downloaded %s/%s"
+                        % (self.time_transfer, speed / 1024 / 1024, self.bytes_done, self.file_size))
+            return False
+
+        if self.bytes_downloaded != self.last_bytes:
+            self.last_bytes = self.bytes_downloaded
+            self.first_zero_bytes_time = None
+        elif self.first_zero_bytes_time is None:
+            self.first_zero_bytes_time = time.time()
+
+        if self.critical_time_zero_bytes and self.first_zero_bytes_time \
+                and self.critical_time_zero_bytes <= (time.time() - self.first_zero_bytes_time):
+            logger.info("No data received for quite a long time, terminating")
+            return False
+        return True
 
-        logger.debug("Opening file %s" % src)
-        sfile = self.sftp.open(src, 'rb')
-        logger.debug("File opened")
+    def write(self, cfile, data):
+        self.bytes_downloaded += len(data)
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        cfile.write(data)
+        self.hasher.update(data)
 
+    def open_remote(self, sftp, src):
+        sfile = sftp.open(src, 'rb')
         sfile.settimeout(self.timeout)
-        # sfile.setblocking(0)
-
-        logger.info("Downloading %s, %s B (%.2f MB)" % (src, self.file_size, self.file_size/1024/1024))
-        with open(dest, 'wb+') as cfile:
-            while self.bytes_downloaded <= self.file_size:
-                self.time_transfer = (time.time() - self.time_started) + 0.1
-                speed = self.bytes_downloaded / self.time_transfer
-                self.last_speed = speed
-
-                if self.callback:
-                    self.callback(self)
-
-                if time.time() - self.last_log > 30:
-                    logger.debug("Download progress, time: %.2f, speed: %.2f MBps, downloaded %s/%s  %.2f %%"
-                                 % (self.time_transfer, speed / 1024 / 1024, self.bytes_downloaded, self.file_size,
-                                    100.0 * self.bytes_downloaded / self.file_size))
-                    self.last_log = time.time()
-
-                if self.critical_speed and self.time_transfer > 60 and speed < self.critical_speed:
-                    logger.info("Critical speed reached after %.2f sec, speed: %.2f MBps, downloaded %s/%s"
-                                % (self.time_transfer, speed / 1024 / 1024, self.bytes_downloaded, self.file_size))
+        return sfile
+
+    def get_single(self, src, cfile):
+        sfile = self.open_remote(self.sftp, src)
+        try:
+            sfile.seek(self.offset)
+            try:
+                sfile.prefetch(self.file_size, max_concurrent_requests=self.max_requests)
+            except TypeError:  # older paramiko, no request limit
+                sfile.prefetch(self.file_size)
+            while self.bytes_done < self.file_size:
+                if not self.on_progress():
                     break
 
-                if self.critical_time_zero_bytes and self.first_zero_bytes_time \
-                        and self.critical_time_zero_bytes <= (time.time() - self.first_zero_bytes_time):
-                    logger.info("No data received for quite a long time, terminating")
+                data = sfile.read(min(self.read_size, self.file_size - self.bytes_done))
+                if not data:
+                    logger.info("Empty data received, terminating transfer")
                     break
 
+                self.write(cfile, data)
+        finally:
+            rtt_utils.try_fnc(lambda: sfile.close())
+
+    def stream_worker(self, src, block_queue, inflight):
+        sftp, sfile = None, None
+        try:
+            sftp = paramiko.SFTPClient.from_transport(self.sftp.get_channel().get_transport())
+            sftp.get_channel().settimeout(self.timeout)
+            sfile = self.open_remote(sftp, src)
+
+            while not self.terminating:
+                inflight.acquire()
                 try:
-                    data = sfile.read(1024 * 4)
-                    if not data:
-                        logger.info("Empty data received, terminating transfer")
-                        break
+                    idx, offset, size = block_queue.popleft()
+                except IndexError:
+                    inflight.release()
+                    return
 
-                    self.first_zero_bytes_time = None
-                    self.bytes_downloaded += len(data)
-                    cfile.write(data)
+                data = b''.join(sfile.readv([(offset, size)]))
+                if len(data) != size:
+                    raise DownloadFailedException('Short read at %s: %s/%s' % (offset, len(data), size))
 
-                except SFTPError as e:
-                    self.first_zero_bytes_time = time.time()
-                    time.sleep(0.1)
+                with self.lock:
+                    self.blocks[idx] = data
+                    self.lock.notify_all()
 
-                except socket.timeout as e:
-                    self.first_zero_bytes_time = time.time()
-                    time.sleep(0.1)
+        except Exception as e:
+            logger.error("Download stream exception: %s" % (e,), exc_info=e)
+            with self.lock:
+                self.error = e
+                self.lock.notify_all()
 
-                except Exception as e:
-                    self.first_zero_bytes_time = time.time()
-                    logger.error('Exc: %s' % (e,), exc_info=e)
-                    time.sleep(0.1)
+        finally:
+            rtt_utils.try_fnc(lambda: sfile.close())
+            rtt_utils.try_fnc(lambda: sftp.close())
 
+    def get_parallel(self, src, cfile):
+        block_queue = collections.deque()
+        for idx, offset in enumerate(range(self.offset, self.file_size, self.block_size)):
+            block_queue.append((idx, offset, min(self.block_size, self.file_size - offset)))
+
+        num_blocks = len(block_queue)
+        inflight = threading.Semaphore(2 * self.num_streams)
+        workers = [threading.Thread(target=self.stream_worker, args=(src, block_queue, inflight), daemon=True)
+                   for _ in range(min(self.num_streams, num_blocks))]
+        for w in workers:
+            w.start()
+
+        try:
+            for idx in range(num_blocks):
+                with self.lock:
+                    while idx not in self.blocks and self.error is None:
+                        self.lock.wait(1)
+                        if not self.on_progress():
+                            return
+                    if self.error is not None:
+                        return
+                    data = self.blocks.pop(idx)
+
+                self.write(cfile, data)
+                inflight.release()
+                if not self.on_progress():
+                    return
+
+        finally:
+            with self.lock:
+                self.terminating = True
+                self.blocks = {}
+            block_queue.clear()
+            for _ in workers:
+                inflight.release()
+
+    def get(self, src, dest, resume=True):
+        self.reset()
+        self.time_started = time.time()
+
+        logger.info("Loading stats for file %s" % src)
+        self.sftp.get_channel().settimeout(self.timeout)
+        self.stat_file(src)
+        self.last_log = time.time() - 10
+
+        # Resume from the partial file, it contains valid prefix of the remote file
+        if resume and not self.codec and os.path.exists(dest) and os.path.getsize(dest) <= self.file_size:
+            self.offset = os.path.getsize(dest)
+
+        logger.info("Downloading %s, %s B (%.2f MB), offset: %s, streams: %s"
+                    % (src, self.file_size, self.file_size/1024/1024, self.offset, self.num_streams))
+        with open(dest, 'r+b' if self.offset else 'wb+') as cfile:
+            # Resumed download, hash the valid prefix first
+            if self.offset:
+                for block in iter(lambda: cfile.read(min(self.read_size, self.offset - cfile.tell())), b""):
+                    self.hasher.update(block)
+            cfile.seek(self.offset)
+            cfile.truncate()
+
+            try:
+                if self.num_streams > 1 and self.file_size - self.offset > self.block_size:
+                    self.get_parallel(src, cfile)
+                else:
+                    self.get_single(src, cfile)
+
+            except Exception as e:
+                logger.error('Exception in download: %s' % (e,), exc_info=e)
+
+        self.time_transfer = (time.time() - self.time_started) + 0.1
         logger.info("Download process finished after %.2f sec, downloaded %s/%s, speed: %.2f MBps"
-                    % (self.time_transfer, self.bytes_downloaded, self.file_size, self.bytes_downloaded / self.time_transfer / 1024 / 1024))
+                    % (self.time_transfer, self.bytes_done, self.file_size,
+                       self.bytes_downloaded / self.time_transfer / 1024 / 1024))
 
-        success = self.bytes_downloaded >= self.file_size
+        success = self.bytes_done >= self.file_size
         if not success:
-            logger.info("Deleting dest file %s" % dest)
-            os.remove(dest)
+            logger.info("Download incomplete, partial file kept for resume %s" % dest)
             raise DownloadFailedException()
+        if self.decompressor and not getattr(self.decompressor, 'eof', True):
+            raise DownloadFailedException('Compressed data %s are truncated' % src)
 
+        self.digest = self.hasher.digest()
         return success
-        #return self.sftp.get(src, dest, callback=self.callback)
+
+
+class UploadFailedException(Exception):
+    pass
+
+
+class RemoteLock(object):
+    """
+    Lock file on the SFTP server, created exclusively. The holder refreshes its mtime with touch(),
+    a lock not touched for expire seconds is considered left by a crashed client and is taken over.
+    The mtime is set from the holder clock, so clients compare it with their own clocks.
+    """
+    def __init__(self, sftp, path, expire=10*60):
+        self.sftp = sftp
+        self.path = path
+        self.expire = expire
+        self.locked = False
+
+    def acquire(self):
+        """Tries to acquire the lock once, returns True on success"""
+        if self.create():
+            return True
+        try:
+            mtime = self.sftp.stat(self.path).st_mtime
+        except IOError:
+            return self.create()
+        if time.time() - mtime <= self.expire:
+            return False
+
+        logger.info("Taking over stale lock %s" % self.path)
+        rtt_utils.try_fnc(lambda: self.sftp.remove(self.path))
+        return self.create()
+
+    def create(self):
+        try:
+            with self.sftp.open(self.path, 'wx') as fh:
+                fh.write(('%s:%s' % (socket.gethostname(), os.getpid())).encode('utf8'))
+            self.locked = True
+            self.touch()
+            return True
+        except IOError:
+            return False
+
+    def touch(self):
+        if self.locked:
+            rtt_utils.try_fnc(lambda: self.sftp.utime(self.path, None))
+
+    def release(self, sftp=None):
+        """Removes the lock, sftp of another session is given when released from another thread"""
+        if self.locked:
+            rtt_utils.try_fnc(lambda: (sftp or self.sftp).remove(self.path))
+            self.locked = False
+
+
+class ExtSFTPClient(paramiko.SFTPClient):
+    """
+    SFTPClient keeping the extensions advertised by the server in its version packet, paramiko discards them.
+    server_extensions is a dict name -> data, None if the version packet was not seen (changed paramiko internals).
+    """
+    def __init__(self, sock):
+        self.server_extensions = None
+        super().__init__(sock)
+
+    def _send_version(self):
+        read_packet = self._read_packet
+
+        def read_version():
+            t, data = read_packet()
+            if t == CMD_VERSION:
+                self.server_extensions = parse_sftp_extensions(data)
+            return t, data
+
+        self._read_packet = read_version
+        try:
+            return super()._send_version()
+        finally:
+            del self._read_packet
+
+
+def parse_sftp_extensions(data):
+    """Extension pairs of the SFTP version packet payload, after the version number"""
+    msg = paramiko.Message(data)
+    msg.get_int()
+    extensions = {}
+    while msg.get_remainder():
+        name = msg.get_string().decode('utf8', 'replace')
+        extensions[name] = msg.get_string().decode('utf8', 'replace')
+    return extensions
+
+
+def sftp_hardlink(sftp, oldpath, newpath):
+    """
+    Creates hard link newpath to oldpath on the server with the hardlink@openssh.com extension,
+    supported by OpenSSH sftp-server / internal-sftp. Raises IOError if not supported,
+    callers fall back to the normal upload.
+    """
+    # Paramiko has no API for custom extended requests, the private _request / _adjust_cwd are used.
+    # The request is sent only if the server advertised the extension, unknown extensions
+    # (connection not created by ExtSFTPClient or changed paramiko internals) are logged as an error.
+    if isinstance(sftp, ManagedSftp):
+        sftp = sftp.manager.get_session()
+    extensions = getattr(sftp, 'server_extensions', None)
+    if extensions is None:
+        logger.error("SFTP server extensions are not known, paramiko %s, hardlink disabled" % paramiko.__version__)
+        raise IOError('SFTP server extensions not known')
+    if "hardlink@openssh.com" not in extensions:
+        raise IOError('SFTP hardlink not supported by the server')
+
+    request = getattr(sftp, '_request', None)
+    adjust_cwd = getattr(sftp, '_adjust_cwd', None)
+    if request is None or adjust_cwd is None:
+        logger.error("SFTP hardlink not supported by paramiko %s" % paramiko.__version__)
+        raise IOError('SFTP hardlink not supported by paramiko %s' % paramiko.__version__)
+    try:
+        request(CMD_EXTENDED, "hardlink@openssh.com", adjust_cwd(oldpath), adjust_cwd(newpath))
+    except IOError:
+        raise
+    except (paramiko.SFTPError, TypeError) as e:
+        raise IOError('SFTP hardlink failed: %s' % (e,))
+
+
+class SftpUploader(object):
+    """
+    Uploads a local file over SFTP, SHA-256 of the file is computed from the uploaded data, available in digest.
+    Single stream mode writes the file with pipelined requests, i.e., without waiting for each write to be acked.
+    With num_streams > 1 the file is split to blocks written concurrently over several SFTP channels
+    opened on the same SSH transport. At most max_inflight blocks are unfinished at any time,
+    so the remote file is a valid prefix of the local file up to the last max_inflight blocks.
+    An interrupted upload is resumed from the remote file without this margin.
+    """
+    MAX_INFLIGHT = 16
+
+    def __init__(self, sftp, num_streams=1, block_size=4*1024*1024, lock=None):
+        self.sftp = sftp
+        self.lock = lock  # RemoteLock refreshed during the upload
+        self.timeout = 60
+        self.num_streams = max(1, num_streams or 1)
+        self.block_size = block_size
+        self.write_size = 1024 * 1024
+        self.max_inflight = min(self.MAX_INFLIGHT, 2 * self.num_streams)
+        self.file_size = 0
+        self.offset = 0
+        self.bytes_uploaded = 0
+        self.time_started = None
+        self.last_log = 0
+        self.hasher = None
+        self.digest = None
+
+        self.lock = threading.Condition()
+        self.blocks = collections.deque()
+        self.done = set()
+        self.error = None
+        self.terminating = False
+
+    @property
+    def bytes_done(self):
+        return self.offset + self.bytes_uploaded
+
+    def reset(self):
+        self.offset = 0
+        self.bytes_uploaded = 0
+        self.time_started = time.time()
+        self.last_log = time.time()
+        self.hasher = hashlib.sha256()
+        self.digest = None
+        self.blocks = collections.deque()
+        self.done = set()
+        self.error = None
+        self.terminating = False
+
+    def resume_offset(self, dest):
+        """Offset of the remote partial file the upload continues from, 0 if missing"""
+        try:
+            size = self.sftp.stat(dest).st_size
+        except IOError:
+            return 0
+        if size > self.file_size:
+            return 0
+        if size == self.file_size and self.file_size <= self.block_size:
+            return 0
+        return max(0, (size // self.block_size - self.MAX_INFLIGHT) * self.block_size)
+
+    def on_progress(self):
+        if time.time() - self.last_log > 30:
+            if self.lock:
+                self.lock.touch()
+            ttime = time.time() - self.time_started + 0.1
+            logger.info("Upload progress, time: %.2f, speed: %.2f MBps, uploaded %s/%s  %.2f %%"
+                        % (ttime, self.bytes_uploaded / ttime / 1024 / 1024, self.bytes_done, self.file_size,
+                           100.0 * self.bytes_done / max(1, self.file_size)))
+            self.last_log = time.time()
+
+    def open_remote(self, sftp, dest, mode):
+        sfile = sftp.open(dest, mode)
+        sfile.settimeout(self.timeout)
+        sfile.set_pipelined(True)
+        return sfile
+
+    def read(self, lfile, size):
+        data = lfile.read(size)
+        if self.hasher:
+            self.hasher.update(data)
+        return data
+
+    def put_single(self, lfile, dest):
+        sfile = self.open_remote(self.sftp, dest, 'r+b' if self.offset else 'wb')
+        try:
+            sfile.seek(self.offset)
+            while self.bytes_done < self.file_size:
+                data = self.read(lfile, min(self.write_size, self.file_size - self.bytes_done))
+                if not data:
+                    raise UploadFailedException('Local file shrank at %s' % self.bytes_done)
+                sfile.write(data)
+                self.bytes_uploaded += len(data)
+                self.on_progress()
+        finally:
+            sfile.close()  # waits for all pipelined writes
+
+    def stream_worker(self, dest):
+        sftp = None
+        try:
+            sftp = paramiko.SFTPClient.from_transport(self.sftp.get_channel().get_transport())
+            sftp.get_channel().settimeout(self.timeout)
+
+            while True:
+                with self.lock:
+                    while not self.blocks and not self.terminating:
+                        self.lock.wait(1)
+                    if not self.blocks:
+                        return
+                    idx, offset, data = self.blocks.popleft()
+
+                # Close waits for all pipelined writes of the block
+                with self.open_remote(sftp, dest, 'r+b') as sfile:
+                    sfile.seek(offset)
+                    sfile.write(data)
+
+                with self.lock:
+                    self.done.add(idx)
+                    self.lock.notify_all()
+
+        except Exception as e:
+            logger.error("Upload stream exception: %s" % (e,), exc_info=e)
+            with self.lock:
+                self.error = e
+                self.lock.notify_all()
+
+        finally:
+            rtt_utils.try_fnc(lambda: sftp.close())
+
+    def put_parallel(self, lfile, dest):
+        # Remote file has to exist for the streams, opened for update
+        with self.sftp.open(dest, 'r+b' if self.offset else 'wb'):
+            pass
+
+        offsets = list(range(self.offset, self.file_size, self.block_size))
+        workers = [threading.Thread(target=self.stream_worker, args=(dest,), daemon=True)
+                   for _ in range(min(self.num_streams, len(offsets)))]
+        for w in workers:
+            w.start()
+
+        unfinished = collections.deque()
+        try:
+            for idx, offset in enumerate(offsets):
+                data = self.read(lfile, min(self.block_size, self.file_size - offset))
+                if not data:
+                    raise UploadFailedException('Local file shrank at %s' % offset)
+
+                # Blocks are retired in order, the window keeps the remote file a prefix up to max_inflight blocks
+                with self.lock:
+                    while True:
+                        while unfinished and unfinished[0][0] in self.done:
+                            self.bytes_uploaded += unfinished.popleft()[1]
+                        if self.error is not None:
+                            raise UploadFailedException('Upload stream failed: %s' % (self.error,))
+                        if len(unfinished) < self.max_inflight:
+                            break
+                        self.lock.wait(1)
+
+                    self.blocks.append((idx, offset, data))
+                    unfinished.append((idx, len(data)))
+                    self.lock.notify_all()
+                self.on_progress()
+
+            with self.lock:
+                while unfinished and self.error is None:
+                    while unfinished and unfinished[0][0] in self.done:
+                        self.bytes_uploaded += unfinished.popleft()[1]
+                    if unfinished:
+                        self.lock.wait(1)
+                if self.error is not None:
+                    raise UploadFailedException('Upload stream failed: %s' % (self.error,))
+
+        finally:
+            with self.lock:
+                self.terminating = True
+                self.blocks.clear()
+                self.lock.notify_all()
+            for w in workers:
+                w.join(self.timeout)
+
+    def hash_remote(self, dest, size):
+        """SHA-256 digest of the first size bytes of the remote file"""
+        hasher = hashlib.sha256()
+        with self.sftp.open(dest, 'rb') as sfile:
+            sfile.settimeout(self.timeout)
+            sfile.prefetch(size)
+            remaining = size
+            while remaining > 0:
+                data = sfile.read(min(self.write_size, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+        return hasher.digest()
+
+    def verify_prefix(self, lfile, dest):
+        """Compares the first offset bytes of the local and remote file, the local prefix is hashed also to hasher"""
+        local = hashlib.sha256()
+        lfile.seek(0)
+        for block in iter(lambda: lfile.read(min(self.write_size, self.offset - lfile.tell())), b""):
+            local.update(block)
+            if self.hasher:
+                self.hasher.update(block)
+        return local.digest() == self.hash_remote(dest, self.offset)
+
+    def put(self, src, dest, resume=True, digest=None):
+        """
+        Uploads src to dest, resumed if a partial dest exists and its content matches src.
+        Returns the SHA-256 digest of the file. With already known digest of src the file is not hashed again.
+        """
+        self.reset()
+        if digest is not None:
+            self.hasher = None
+        self.file_size = os.path.getsize(src)
+        self.sftp.get_channel().settimeout(self.timeout)
+        self.offset = self.resume_offset(dest) if resume else 0
+
+        logger.info("Uploading %s to %s, %s B (%.2f MB), offset: %s, streams: %s"
+                    % (src, dest, self.file_size, self.file_size / 1024 / 1024, self.offset, self.num_streams))
+        with open(src, 'rb') as lfile:
+            # Resumed upload, the remote prefix is trusted only if it matches the local one
+            if self.offset and not self.verify_prefix(lfile, dest):
+                logger.warning("Remote partial file %s does not match %s, uploading from the start" % (dest, src))
+                self.offset = 0
+                self.hasher = hashlib.sha256() if self.hasher else None
+            lfile.seek(self.offset)
+
+            if self.num_streams > 1 and self.file_size - self.offset > self.block_size:
+                self.put_parallel(lfile, dest)
+            else:
+                self.put_single(lfile, dest)
+
+        # Sparse or longer leftovers of previous attempts are cut, then the size is checked
+        if self.sftp.stat(dest).st_size > self.file_size:
+            self.sftp.truncate(dest, self.file_size)
+        remote_size = self.sftp.stat(dest).st_size
+        ttime = time.time() - self.time_started + 0.1
+        logger.info("Upload finished after %.2f sec, uploaded %s/%s, speed: %.2f MBps"
+                    % (ttime, self.bytes_done, self.file_size, self.bytes_uploaded / ttime / 1024 / 1024))
+        if remote_size != self.file_size or self.bytes_done != self.file_size:
+            raise UploadFailedException('Size mismatch of %s, remote: %s, local: %s'
+                                        % (dest, remote_size, self.file_size))
+
+        self.digest = self.hasher.digest() if self.hasher else digest
+        return self.digest
 
 
 class LockedDownloader(object):
-    def __init__(self, sftp, path, acquire_timeout=60*60*8):
+    """
+    Downloads the file under the file lock so workers sharing the cache download it only once.
+    SHA-256 of the downloaded file is stored in the .downloaded marker together with size and mtime.
+    Already downloaded file is verified by the metadata check, full re-hash is done only with
+    probability verify_rate, for legacy markers without the hash and if the metadata do not match.
+    If expected_hash is given, file with a different hash is downloaded again.
+    With codec the remote file is compressed, the local file and the hashes are of the decompressed data.
+    """
+    def __init__(self, sftp, path, acquire_timeout=60*60*8, num_streams=1, attempts=3, verify_rate=0.0,
+                 codec=None):
         self.sftp = sftp
+        self.codec = codec
         self.path = path  # Local path to download to
         self.path_downloaded_check = path + '.downloaded'
         self.locker = rtt_utils.FileLocker(self.path + '.lock', acquire_timeout=acquire_timeout)
         self.last_touch = 0
+        self.num_streams = num_streams
+        self.attempts = attempts
+        self.verify_rate = verify_rate
+        self.digest = None  # SHA-256 of the local file after download()
+        self.downloaded = False  # True if the file was transferred by the last download()
 
     def callback(self, downloader):
         tnow = time.time()
@@ -144,7 +739,34 @@ class LockedDownloader(object):
             self.locker.touch()
             self.last_touch = tnow
 
-    def download(self, src, force=False):
+    def check_downloaded(self, expected_hash=None):
+        """Verifies already downloaded file, returns its digest or None if the file has to be downloaded"""
+        meta = read_download_marker(self.path)
+        if meta is None or not os.path.exists(self.path):
+            return None
+
+        digest = None
+        if marker_matches_file(self.path, meta):
+            digest = bytes.fromhex(meta['sha256'])
+
+        if digest is None or (self.verify_rate and random.random() < self.verify_rate):
+            logger.info("Verifying downloaded file %s by hashing, marker: %s" % (self.path, meta))
+            file_digest = rtt_utils.hash_file(self.path)
+            if digest is not None and digest != file_digest:
+                logger.error("Hash of the downloaded file %s does not match the marker" % self.path)
+                return None
+
+            digest = file_digest
+            if not marker_matches_file(self.path, meta):
+                write_download_marker(self.path, digest)
+
+        if expected_hash and digest != expected_hash:
+            logger.error("Hash of the downloaded file %s does not match the expected hash %s"
+                         % (self.path, expected_hash.hex()))
+            return None
+        return digest
+
+    def download(self, src, force=False, expected_hash=None):
         # Downloads src to the self.path
         # Lock first to check for the presence, need to lock to avoid race conditions,
         # other workers may be downloading the same file right now so file existence check would pass
@@ -156,29 +778,56 @@ class LockedDownloader(object):
             # the execution - exception propagates up as we don't know how to handle this at this
             # level of abstraction
 
-            # After we lock, check for existence. If the file exists.
-            if not force and os.path.exists(self.path) and os.path.exists(self.path_downloaded_check):
-                logger.info("File already downloaded")
-                return True
+            # After we lock, check for existence. If the file exists and is valid, use it.
+            self.downloaded = False
+            if not force:
+                self.digest = self.check_downloaded(expected_hash)
+                if self.digest is not None:
+                    logger.info("File already downloaded")
+                    return True
 
-            # If forced or primary is missing, delete the downloaded marker.
+            # If forced or primary is missing or invalid, delete the downloaded marker.
+            downloaded_before = os.path.exists(self.path_downloaded_check)
             try:
                 os.unlink(self.path_downloaded_check)
             except:
                 pass
 
+            # Partial file without the marker is resumed, unless forced or the complete file was invalid
+            if force or downloaded_before:
+                rtt_utils.try_remove(self.path)
+
             # Otherwise, download the file with lock touching.
             logger.info("Downloading remote file {} into {}".format(src, self.path))
-            downloader = SftpDownloader(self.sftp, critical_speed=1024, critical_time_zero_bytes=30)
-            downloader.callback = self.callback
-            downloader.get(src, self.path)
+            for attempt in range(self.attempts):
+                try:
+                    downloader = SftpDownloader(self.sftp, critical_speed=1024, critical_time_zero_bytes=30,
+                                                num_streams=self.num_streams, codec=self.codec)
+                    downloader.callback = self.callback
+                    downloader.get(src, self.path)
+
+                    if expected_hash and downloader.digest != expected_hash:
+                        logger.error("Downloaded file hash %s does not match the expected hash %s"
+                                     % (downloader.digest.hex(), expected_hash.hex()))
+                        rtt_utils.try_remove(self.path)
+                        raise DownloadFailedException('Hash mismatch')
+
+                    self.digest = downloader.digest
+                    self.downloaded = True
+                    break
+
+                except DownloadFailedException:
+                    logger.info("Download attempt %s failed" % (attempt,))
+                    if attempt + 1 >= self.attempts:
+                        raise
+                    self.locker.touch()
+                    time.sleep(2 + attempt)
 
-            # Download existence touch file
+            # Download existence touch file with the file hash
             # If downloader is terminated in the middle of the download, the download file is still there
             # but lock is expired, so we would manage to acquire the lock and check for file existence.
             # Thus we need this special flag file.
-            with open(self.path_downloaded_check, 'a'):
-                pass
+            write_download_marker(self.path, self.digest)
 
             logger.info("Download complete.")
             return True
@@ -243,9 +892,196 @@ def create_sftp_storage_conn_params(params: SSHParams):
         pkey = paramiko.RSAKey.from_private_key_file(params.pkey_file, params.pkey_pass)
         transport = paramiko.Transport((params.host, params.port))
         transport.connect(username=params.user, pkey=pkey)
-        sftp = paramiko.SFTPClient.from_transport(transport)
+        sftp = ExtSFTPClient.from_transport(transport)
         sftp.get_channel().settimeout(60)
         return sftp
     except Exception as e:
         logger.error("Sftp connection: %s" % (e,), exc_info=e)
         raise
+
+
+
+def is_connection_error(e, transport=None):
+    """True if the exception was caused by a broken SSH connection, not by the SFTP operation itself"""
+    if isinstance(e, (EOFError, paramiko.SSHException, socket.timeout, ConnectionError)):
+        return True
+    return transport is not None and not transport.is_active()
+
+
+class SSHConnectionManager(object):
+    """
+    Keeps one SSH transport to the storage server, shared by SFTP sessions and port forwarding channels.
+    Transport is checked before use, idle transport is probed every probe_interval seconds.
+    Broken transport is reconnected with exponential backoff, SFTP sessions are re-created on the new transport.
+    A small pool of SFTP sessions is kept, threads are spread over the sessions.
+    """
+    def __init__(self, params: SSHParams, num_sessions=2, probe_interval=30, keepalive=15,
+                 connect_attempts=10, max_backoff=60):
+        self.params = params
+        self.num_sessions = max(1, num_sessions)
+        self.probe_interval = probe_interval
+        self.keepalive = keepalive
+        self.connect_attempts = connect_attempts
+        self.max_backoff = max_backoff
+        self.timeout = 60
+
+        self.transport = None
+        self.generation = 0
+        self.sessions = []
+        self.last_ok = 0
+        self.reconnects = 0
+        self.closed = False
+        self.lock = threading.RLock()
+
+    def connect_transport(self):
+        pkey = paramiko.RSAKey.from_private_key_file(self.params.pkey_file, self.params.pkey_pass)
+        transport = paramiko.Transport((self.params.host, self.params.port))
+        try:
+            transport.connect(username=self.params.user, pkey=pkey)
+            if self.keepalive:
+                transport.set_keepalive(self.keepalive)
+            return transport
+        except Exception:
+            rtt_utils.try_fnc(lambda: transport.close())
+            raise
+
+    def reconnect(self):
+        """Creates a new transport, retries with exponential backoff"""
+        with self.lock:
+            self.close_transport()
+            for attempt in range(self.connect_attempts):
+                if self.closed:
+                    raise ConnectionError('Connection manager closed')
+                try:
+                    logger.info("Connecting to SSH %s:%s, attempt %s" % (self.params.host, self.params.port, attempt))
+                    self.transport = self.connect_transport()
+                    self.generation += 1
+                    self.reconnects += 1 if self.generation > 1 else 0
+                    self.last_ok = time.time()
+                    logger.info("SSH connection established, generation %s" % self.generation)
+                    return self.transport
+
+                except Exception as e:
+                    backoff = min(self.max_backoff, 2 ** attempt) + random.uniform(0, 1)
+                    logger.error("SSH connection failed: %s, retry in %.2f s" % (e, backoff))
+                    time.sleep(backoff)
+
+            raise ConnectionError('Could not connect to %s:%s' % (self.params.host, self.params.port))
+
+    def close_transport(self):
+        with self.lock:
+            for sftp in self.sessions:
+                rtt_utils.try_fnc(lambda: sftp.close())
+            self.sessions = []
+            if self.transport:
+                rtt_utils.try_fnc(lambda: self.transport.close())
+            self.transport = None
+
+    def probe(self):
+        """Health check of the connection, round trip over the SFTP session"""
+        try:
+            with self.lock:
+                sftp = self.get_session(probe=False)
+            sftp.normalize('.')
+            self.last_ok = time.time()
+            return True
+        except Exception as e:
+            logger.warning("SSH connection probe failed: %s" % (e,))
+            return False
+
+    def get_transport(self, probe=True):
+        """Returns an active transport, reconnects if the transport is broken or the probe fails"""
+        with self.lock:
+            if self.transport is None or not self.transport.is_active():
+                return self.reconnect()
+
+            if probe and time.time() - self.last_ok > self.probe_interval and not self.probe():
+                return self.reconnect()
+            return self.transport
+
+    def get_session(self, probe=True):
+        """SFTP session for the calling thread"""
+        with self.lock:
+            transport = self.get_transport(probe=probe)
+            if not self.sessions:
+                for _ in range(self.num_sessions):
+                    sftp = ExtSFTPClient.from_transport(transport)
+                    sftp.get_channel().settimeout(self.timeout)
+                    self.sessions.append(sftp)
+            return self.sessions[threading.get_ident() % len(self.sessions)]
+
+    def invalidate(self, generation):
+        """Drops the connection of the given generation, next use reconnects"""
+        with self.lock:
+            if generation == self.generation:
+                logger.info("Dropping broken SSH connection, generation %s" % generation)
+                self.close_transport()
+
+    def mark_ok(self):
+        self.last_ok = time.time()
+
+    def open_channel(self, dest_addr, src_addr=('127.0.0.1', 0)):
+        """Opens direct-tcpip channel to dest_addr through the SSH server, for port forwarding"""
+        transport = self.get_transport()
+        try:
+            return transport.open_channel('direct-tcpip', dest_addr, src_addr, timeout=self.timeout)
+        except Exception as e:
+            if is_connection_error(e, transport):
+                self.invalidate(self.generation)
+            raise
+
+    def close(self):
+        self.closed = True
+        self.close_transport()
+
+
+class ManagedSftp(object):
+    """
+    SFTPClient-like object backed by the SSHConnectionManager.
+    Calls are executed on a pooled SFTP session, on a connection error the connection is re-created
+    and read-only calls are retried once. Objects returned by calls (e.g., opened files) are bound to the session
+    they were created on.
+    """
+    RETRY_SAFE = {'stat', 'lstat', 'open', 'file', 'listdir', 'listdir_attr', 'normalize', 'readlink', 'getcwd'}
+
+    def __init__(self, manager: SSHConnectionManager):
+        self.manager = manager
+
+    def call(self, name, *args, **kwargs):
+        for attempt in range(2):
+            with self.manager.lock:
+                sftp = self.manager.get_session()
+                generation = self.manager.generation
+                transport = self.manager.transport
+            try:
+                res = getattr(sftp, name)(*args, **kwargs)
+                self.manager.mark_ok()
+                return res
+
+            except Exception as e:
+                if not is_connection_error(e, transport):
+                    raise
+                logger.warning("SFTP %s failed on a broken connection: %s, reconnecting" % (name, e))
+                self.manager.invalidate(generation)
+                if attempt > 0 or name not in self.RETRY_SAFE:
+                    raise
+
+    def get_channel(self):
+        return self.manager.get_session().get_channel()
+
+    def close(self):
+        self.manager.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if not callable(getattr(paramiko.SFTPClient, name, None)):
+            return getattr(self.manager.get_session(), name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+
+def create_sftp_storage_manager(main_cfg, **kwargs):
+    """Connection manager to the storage server from the configuration, connects eagerly"""
+    manager = SSHConnectionManager(ssh_load_params(main_cfg), **kwargs)
+    manager.get_transport(probe=False)
+    return manager
\ No newline at end of file
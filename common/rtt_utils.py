@@ -3,7 +3,11 @@ import time
 import logging
 import signal
 import shutil
+import socket
+import threading
 import hashlib
+import random
+import re
 from filelock import Timeout, FileLock, SoftFileLock
 
 
@@ -84,8 +88,13 @@ def try_clean_workers(workers):
         logger.error("Worker dir cleanup exception: %s" % (e,), exc_info=e)
 
 
+def get_tmp_path(path):
+    """Temporary file next to the path, unique per host, process and thread"""
+    return '%s.%s.%s.%s.tmp' % (path, socket.gethostname(), os.getpid(), threading.get_ident())
+
+
 def get_associated_files(path):
-    return [path + '.lock', path + '.lock.2', path + '.downloaded']
+    return [path + '.lock', path + '.lock.2', path + '.downloaded', path + '.downloaded.tmp']
 
 
 class FileLockerError(Exception):
@@ -93,6 +102,11 @@ class FileLockerError(Exception):
 
 
 class FileLocker(object):
+    """
+    Lock file usable across hosts, e.g., on NFS. The lock is an exclusively created file, the holder touches
+    the timing file, lock with the timing file not touched for expire seconds is considered dead and broken.
+    The timing file age is measured by the file system clock, so clock skew between hosts does not matter.
+    """
     def __init__(self, path, acquire_timeout=60*60, lock_timeout=15, expire=120):
         self.path = path
         self.mlock_path = self.path + '.2'
@@ -119,9 +133,21 @@ class FileLocker(object):
         except:
             return 0
 
+    def fs_time(self):
+        """Current time of the file system clock, local time if not available"""
+        probe = get_tmp_path(self.path + '.now')
+        try:
+            with open(probe, 'a'):
+                pass
+            return os.stat(probe).st_mtime
+        except OSError:
+            return time.time()
+        finally:
+            try_remove(probe)
+
     def is_expired(self):
         mtime = self.mtime()
-        return time.time() - mtime > self.expire
+        return self.fs_time() - mtime > self.expire
 
     def delete_timing(self):
         try:
@@ -285,3 +311,41 @@ def hash_file(fname=None, fh=None, hasher=None):
 
     return sha256_hash.digest()
 
+
+
+def mysql_supports_skip_locked(version):
+    """
+    Decides whether the server with given VERSION() string supports FOR UPDATE SKIP LOCKED.
+    MySQL >= 8.0.1, MariaDB >= 10.6.
+    """
+    if not version:
+        return False
+    try:
+        nums = [int(x) for x in re.findall(r'\d+', version.split('-')[0])[:3]]
+        nums += [0] * (3 - len(nums))
+        if 'mariadb' in version.lower():
+            return tuple(nums) >= (10, 6, 0)
+        return tuple(nums) >= (8, 0, 1)
+    except Exception:
+        return False
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter. next() returns the delay to wait, each call grows it by factor
+    up to max_delay, reset() starts over from min_delay. Jitter spreads the delays of workers started together.
+    """
+    def __init__(self, min_delay=5.0, max_delay=120.0, factor=2.0, jitter=0.25):
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.factor = factor
+        self.jitter = jitter
+        self.delay = min_delay
+
+    def next(self):
+        delay = self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.delay = min(self.max_delay, self.delay * self.factor)
+        return delay
+
+    def reset(self):
+        self.delay = self.min_delay
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Author: Dusan Klinec, ph4r05, 2018
-# pip install shellescape sarge
+# pip install shellescape
 
+import codecs
+import collections
+import gzip
 import logging
+import selectors
 import signal
+import subprocess
 import threading
 import time
 import sys
@@ -18,12 +23,10 @@ import paramiko
 import sshtunnel
 from shlex import quote
 import shellescape
-from sarge import Capture, Feeder, run
 from . import rtt_sftp_conn
 from . import rtt_utils
 
 logger = logging.getLogger(__name__)
-SARGE_FILTER_INSTALLED = False
 RTT_BATTERIES = {
     'Dieharder': 'dieharder',
     'NIST Statistical Testing Suite': 'nist_sts',
@@ -53,62 +56,6 @@ def try_fnc(fnc):
         pass
 
 
-class SargeLogFilter(logging.Filter):
-    """Filters out debugging logs generated by sarge - output capture. It is way too verbose for debug"""
-
-    def __init__(self, name="", *args, **kwargs):
-        self.namex = name
-        logging.Filter.__init__(self, *args, **kwargs)
-
-    def filter(self, record):
-        if record.levelno != logging.DEBUG:
-            return 1
-
-        try:
-            # Parse messages are too verbose, skip.
-            if record.name == "sarge.parse":
-                return 0
-
-            # Disable output processing message - length of one character.
-            msg = record.getMessage()
-            if "queued chunk of length 1" in msg:
-                return 0
-
-            return 1
-
-        except Exception as e:
-            logger.error("Exception in log filtering: %s" % (e,), exc_info=e)
-
-        return 1
-
-
-def install_sarge_filter():
-    """
-    Installs Sarge log filter to avoid long 1char debug dumps
-    :return:
-    """
-    global SARGE_FILTER_INSTALLED
-    if SARGE_FILTER_INSTALLED:
-        return
-
-    for handler in logging.getLogger().handlers:
-        handler.addFilter(SargeLogFilter("hnd"))
-    logging.getLogger().addFilter(SargeLogFilter("root"))
-    SARGE_FILTER_INSTALLED = True
-
-
-def sarge_sigint(proc, sig=signal.SIGTERM):
-    """
-    Sends sigint to sarge process
-    :return:
-    """
-    proc.process_ready.wait()
-    p = proc.process
-    if not p:  # pragma: no cover
-        raise ValueError("There is no subprocess")
-    p.send_signal(sig)
-
-
 def escape_shell(inp):
     """
     Shell-escapes input param
@@ -128,7 +75,124 @@ def escape_shell(inp):
     quote(inp)
 
 
+class LineSplitter(object):
+    """Incrementally decodes a byte stream and splits it to lines, unterminated line is bounded by max_line"""
+    def __init__(self, max_line=64*1024):
+        self.decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        self.buf = ''
+        self.max_line = max_line
+
+    def feed(self, data, final=False):
+        self.buf += self.decoder.decode(data, final)
+        lines = self.buf.split('\n')
+        self.buf = lines.pop()
+        if (final and self.buf) or len(self.buf) > self.max_line:
+            lines.append(self.buf)
+            self.buf = ''
+        return [x.strip('\r') for x in lines]
+
+
+class OutputCapture(object):
+    """
+    Bounded capture of process output lines. The first head_lines lines are kept, later lines go to a ring buffer
+    holding at most max_lines lines and max_bytes characters (None = unbounded).
+    If spill_path is set, all lines are also written to the gzip file, so the full output is still available.
+    """
+    def __init__(self, max_lines=None, max_bytes=None, head_lines=0, spill_path=None):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.head_lines = head_lines
+        self.spill_path = spill_path
+        self.spill_fh = None
+        self.head = []
+        self.tail = collections.deque()
+        self.tail_bytes = 0
+        self.total = 0
+        self.dropped = 0
+
+    def append(self, line):
+        self.total += 1
+        if self.spill_path:
+            self.spill(line)
+
+        if len(self.head) < self.head_lines:
+            self.head.append(line)
+            return
+
+        self.tail.append(line)
+        self.tail_bytes += len(line)
+        while len(self.tail) > 1 and (
+                (self.max_lines is not None and len(self.tail) > self.max_lines) or
+                (self.max_bytes is not None and self.tail_bytes > self.max_bytes)):
+            self.tail_bytes -= len(self.tail.popleft())
+            self.dropped += 1
+
+    def spill(self, line):
+        try:
+            if self.spill_fh is None:
+                self.spill_fh = gzip.open(self.spill_path, 'wt', encoding='utf8', compresslevel=3)
+            self.spill_fh.write(line + '\n')
+
+        except Exception as e:
+            logger.warning("Could not spill output to %s: %s" % (self.spill_path, e))
+            self.spill_path = None
+            self.close()
+
+    def close(self):
+        if self.spill_fh is not None:
+            try_fnc(lambda: self.spill_fh.close())
+            self.spill_fh = None
+
+    def iter_lines(self):
+        """All captured lines, read back from the spill file if available, retained lines otherwise"""
+        if self.spill_path and self.spill_fh is None and os.path.exists(self.spill_path):
+            with gzip.open(self.spill_path, 'rt', encoding='utf8') as fh:
+                for line in fh:
+                    yield line.rstrip('\n')
+            return
+        yield from self
+
+    def text(self):
+        """Retained lines joined, with a note about lines dropped between head and tail"""
+        lines = list(self.head)
+        if self.dropped:
+            lines.append("... %s lines omitted%s ..."
+                         % (self.dropped, ', full output in %s' % self.spill_path if self.spill_path else ''))
+        return '\n'.join(lines + list(self.tail))
+
+    def __iter__(self):
+        yield from self.head
+        yield from self.tail
+
+    def __len__(self):
+        return len(self.head) + len(self.tail)
+
+
+class StdinFeeder(object):
+    """Writes to the process stdin, feed() accepts str or bytes"""
+    def __init__(self, fh):
+        self.fh = fh
+
+    def feed(self, data):
+        if self.fh is None:
+            return
+        try:
+            self.fh.write(data.encode('utf8') if isinstance(data, str) else data)
+            self.fh.flush()
+        except (BrokenPipeError, ValueError, OSError) as e:
+            logger.debug("Could not feed the process: %s" % (e,))
+
+    def close(self):
+        if self.fh is not None:
+            try_fnc(lambda: self.fh.close())
+
+
 class AsyncRunner:
+    """
+    Runs a process in a background thread, captures its output line by line.
+    The thread sleeps in the selector until there is output on the pipes, the process exits (pidfd) or
+    the runner is woken up by shutdown(). on_tick is called after each wake up, at least every tick_interval.
+    """
     def __init__(self, cmd, args=None, stdout=None, stderr=None, cwd=None, shell=True, env=None):
         self.cmd = cmd
         self.args = args
@@ -144,18 +208,30 @@ class AsyncRunner:
         self.shell = shell
         self.env = env
         self.preexec_setgrp = False
+        self.tick_interval = 1.0
+        self.term_interval = 5.0  # termination signals are repeated in this interval
+        self.kill_timeout = 30.0  # program not terminated by signals in this time is killed
+        self.drain_timeout = 0.15  # after the process exits, output of its children is read until quiet
+        self.capture_max_lines = None
+        self.capture_max_bytes = None
+        self.capture_head_lines = 0
+        self.capture_spill_dir = None  # full stdout / stderr is written to {stdout,stderr}.log.gz there
 
         self.using_stdout_cap = True
         self.using_stderr_cap = True
         self.ret_code = None
-        self.out_acc = []
-        self.err_acc = []
+        self.out_acc = OutputCapture()
+        self.err_acc = OutputCapture()
         self.feeder = None
         self.proc = None
         self.is_running = False
         self.was_running = False
         self.terminating = False
         self.thread = None
+        self.started_event = threading.Event()
+        self.finished_event = threading.Event()
+        self.wakeup_r, self.wakeup_w = None, None
+        self.wakeup_lock = threading.Lock()
 
     def run(self):
         try:
@@ -165,6 +241,8 @@ class AsyncRunner:
             logger.error("Unexpected exception in runner: %s" % (e,), exc_info=e)
         finally:
             self.was_running = True
+            self.started_event.set()
+            self.finished_event.set()
 
     def __del__(self):
         self.deinit()
@@ -181,21 +259,7 @@ class AsyncRunner:
         if self.using_stderr_cap:
             rtt_utils.try_fnc(lambda: self.proc.stderr.close())
 
-        rtt_utils.try_fnc(lambda: self.proc.close())
-
-    def drain_stream(self, s, block=False, timeout=0.15):
-        ret = []
-        while True:
-            rs = s.read(-1, block, timeout)
-            if not rs:
-                break
-            ret.append(rs)
-        return ret
-
-    def run_internal(self):
-        def preexec_function():
-            os.setpgrp()
-
+    def build_cmd(self):
         cmd = self.cmd
         if self.shell:
             args_str = (
@@ -212,129 +276,164 @@ class AsyncRunner:
             if self.args and not isinstance(self.args, (list, tuple)):
                 raise ValueError("!Shell requires array of args")
             if self.args:
-                cmd += self.args
+                cmd = list(cmd) + list(self.args)
+        return cmd
+
+    def process_line(self, line, is_err=False):
+        dst = self.err_acc if is_err else self.out_acc
+        dst.append(line)
+        if self.log_out_during:
+            if self.no_log_just_write:
+                dv = sys.stderr if is_err else sys.stdout
+                dv.write(line + "\n")
+                dv.flush()
+            else:
+                logger.debug("Out: %s" % line.strip())
+        if self.on_output:
+            self.on_output(self, line, is_err)
+
+    def new_capture(self, name):
+        spill_path = os.path.join(self.capture_spill_dir, '%s.log.gz' % name) if self.capture_spill_dir else None
+        return OutputCapture(max_lines=self.capture_max_lines, max_bytes=self.capture_max_bytes,
+                             head_lines=self.capture_head_lines, spill_path=spill_path)
+
+    def wakeup(self):
+        """Wakes up the runner thread sleeping in the selector"""
+        with self.wakeup_lock:
+            if self.wakeup_w is not None:
+                rtt_utils.try_fnc(lambda: os.write(self.wakeup_w, b'x'))
+
+    def signal_group(self, p, sig):
+        """Signals the process group of the program if started in its own, so its children get it too"""
+        if self.preexec_setgrp:
+            os.killpg(p.pid, sig)
+        else:
+            p.send_signal(sig)
 
+    def send_term(self, p):
+        logger.debug("Terminating by sigterm %s" % p.pid)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            rtt_utils.try_fnc(lambda: self.signal_group(p, sig))
+        logger.debug("Sigterm sent")
+
+    def send_kill(self, p):
+        logger.warning("Program %s did not terminate, killing" % p.pid)
+        rtt_utils.try_fnc(lambda: self.signal_group(p, signal.SIGKILL))
+
+    def run_internal(self):
+        cmd = self.build_cmd()
         self.using_stdout_cap = self.stdout is None
         self.using_stderr_cap = self.stderr is None
-        self.feeder = Feeder()
-
-        logger.debug("Starting command %s in %s" % (cmd, self.cwd))
+        self.ret_code = 1
+        self.out_acc, self.err_acc = self.new_capture('stdout'), self.new_capture('stderr')
 
-        run_args = {}
+        popen_args = {}
         if self.preexec_setgrp:
-            run_args['preexec_fn'] = preexec_function
-
-        p = run(
-            cmd,
-            input=self.feeder,
-            async_=True,
-            stdout=self.stdout or Capture(timeout=0.1, buffer_size=1),
-            stderr=self.stderr or Capture(timeout=0.1, buffer_size=1),
-            cwd=self.cwd,
-            env=self.env,
-            shell=self.shell,
-            **run_args
-        )
+            if sys.version_info >= (3, 11):
+                popen_args['process_group'] = 0
+            else:
+                popen_args['preexec_fn'] = os.setpgrp
 
-        self.proc = p
-        self.ret_code = 1
-        self.out_acc, self.err_acc = [], []
-        out_cur, err_cur = [""], [""]
-
-        def process_line(line, is_err=False):
-            dst = self.err_acc if is_err else self.out_acc
-            dst.append(line)
-            if self.log_out_during:
-                if self.no_log_just_write:
-                    dv = sys.stderr if is_err else sys.stdout
-                    dv.write(line + "\n")
-                    dv.flush()
-                else:
-                    logger.debug("Out: %s" % line.strip())
-            if self.on_output:
-                self.on_output(self, line, is_err)
-
-        def add_output(buffers, is_err=False, finish=False):
-            buffers = [x.decode("utf8") for x in buffers if x is not None and x != ""]
-            lines = [""]
-            if not buffers and not finish:
-                return
-
-            dst_cur = err_cur if is_err else out_cur
-            for x in buffers:
-                clines = [v.strip("\r") for v in x.split("\n")]
-                lines[-1] += clines[0]
-                lines.extend(clines[1:])
-
-            nlines = len(lines)
-            dst_cur[0] += lines[0]
-            if nlines > 1:
-                process_line(dst_cur[0], is_err)
-                dst_cur[0] = ""
-
-            for line in lines[1:-1]:
-                process_line(line, is_err)
-
-            if not finish and nlines > 1:
-                dst_cur[0] = lines[-1] or ""
-
-            if finish:
-                cline = dst_cur[0] if nlines == 1 else lines[-1]
-                if cline:
-                    process_line(cline, is_err)
+        logger.debug("Starting command %s in %s" % (cmd, self.cwd))
+        try:
+            p = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=self.stdout or subprocess.PIPE,
+                stderr=self.stderr or subprocess.PIPE,
+                cwd=self.cwd,
+                env=dict(os.environ, **self.env) if self.env else None,
+                shell=self.shell,
+                **popen_args
+            )
+        except Exception as e:
+            self.is_running = False
+            self.was_running = True
+            logger.error("Program could not be started: %s" % (e,))
+            if self.on_finished:
+                self.on_finished(self)
+            return
 
+        self.proc = p
+        self.feeder = StdinFeeder(p.stdin)
+        sel = selectors.DefaultSelector()
+        pidfd = None
         try:
-            while len(p.commands) == 0:
-                time.sleep(0.15)
+            self.wakeup_r, self.wakeup_w = os.pipe()
+            os.set_blocking(self.wakeup_r, False)
+            sel.register(self.wakeup_r, selectors.EVENT_READ, 'wakeup')
 
-            logger.debug("Program started, progs: %s" % len(p.commands))
-            if p.commands[0] is None:
-                self.is_running = False
-                self.was_running = True
-                logger.error("Program could not be started")
-                return
+            splitters = {}
+            if self.using_stdout_cap:
+                splitters[p.stdout.fileno()] = (LineSplitter(), False)
+                sel.register(p.stdout.fileno(), selectors.EVENT_READ, 'out')
+            if self.using_stderr_cap:
+                splitters[p.stderr.fileno()] = (LineSplitter(), True)
+                sel.register(p.stderr.fileno(), selectors.EVENT_READ, 'err')
 
+            # pidfd becomes readable on the process exit, otherwise exit is checked on each tick
+            try:
+                pidfd = os.pidfd_open(p.pid)
+                sel.register(pidfd, selectors.EVENT_READ, 'exit')
+            except (AttributeError, OSError):
+                pidfd = None
+
+            logger.debug("Program started, pid: %s" % p.pid)
             self.is_running = True
+            self.started_event.set()
             self.on_change()
-            out = None
-            err = None
-
-            while p.commands[0] and p.commands[0].returncode is None:
-                if self.using_stdout_cap:
-                    out = p.stdout.read(-1, False)
-                    add_output([out], is_err=False)
 
-                if self.using_stderr_cap:
-                    err = p.stderr.read(-1, False)
-                    add_output([err], is_err=True)
+            time_exited = None
+            time_term = 0
+            time_term_first = None
+            tick_interval = self.tick_interval if pidfd is not None else min(self.tick_interval, 0.15)
+            while True:
+                timeout = tick_interval if time_exited is None else self.drain_timeout
+                events = sel.select(timeout)
+                for key, _ in events:
+                    if key.data == 'wakeup':
+                        rtt_utils.try_fnc(lambda: os.read(self.wakeup_r, 4096))
+
+                    elif key.data == 'exit':
+                        sel.unregister(key.fd)
+
+                    else:
+                        data = os.read(key.fd, 64*1024)
+                        splitter, is_err = splitters[key.fd]
+                        if not data:
+                            sel.unregister(key.fd)
+                        for line in splitter.feed(data, final=not data):
+                            self.process_line(line, is_err)
 
                 if self.on_tick:
                     self.on_tick(self)
 
-                p.commands[0].poll()
-                if self.terminating and p.commands[0].returncode is None:
-                    logger.debug("Terminating by sigint %s" % p.commands[0])
-                    sarge_sigint(p.commands[0], signal.SIGTERM)
-                    sarge_sigint(p.commands[0], signal.SIGINT)
-                    logger.debug("Sigint sent")
-                    logger.debug("Process closed")
-
-                # If there is data, consume it right away.
-                if (self.using_stdout_cap and out) or (self.using_stderr_cap and err):
-                    continue
-                time.sleep(0.15)
-
-            logger.debug("Runner while ended")
-            p.wait()
-            self.ret_code = p.commands[0].returncode if p.commands[0] else -1
-
-            if self.using_stdout_cap:
-                try_fnc(lambda: p.stdout.close())
-                add_output(self.drain_stream(p.stdout, True), finish=True)
-
-            if self.using_stderr_cap:
-                try_fnc(lambda: p.stderr.close())
-                add_output(self.drain_stream(p.stderr, True), is_err=True, finish=True)
+                if time_exited is None and p.poll() is not None:
+                    time_exited = time.time()
+
+                if time_exited is None and self.terminating and time.time() - time_term > self.term_interval:
+                    time_term_first = time_term_first or time.time()
+                    if time.time() - time_term_first >= self.kill_timeout:
+                        self.send_kill(p)
+                    else:
+                        self.send_term(p)
+                    time_term = time.time()
+
+                # Process exited, finish when all pipes are closed or children holding them stay quiet
+                if time_exited is not None:
+                    streams_open = any(x.data in ('out', 'err') for x in sel.get_map().values())
+                    if not streams_open or not events:
+                        break
+
+            logger.debug("Runner loop ended")
+            self.ret_code = p.wait()
+            if self.terminating and self.preexec_setgrp:
+                # Children left in the group would hold the job resources
+                rtt_utils.try_fnc(lambda: os.killpg(p.pid, signal.SIGKILL))
+
+            for fd, (splitter, is_err) in splitters.items():
+                for line in splitter.feed(b'', final=True):
+                    self.process_line(line, is_err)
 
             self.was_running = True
             self.is_running = False
@@ -344,8 +443,8 @@ class AsyncRunner:
             logger.debug("Command: %s" % cmd)
 
             if self.log_out_after:
-                logger.debug("Std out: %s" % "\n".join(self.out_acc))
-                logger.debug("Error out: %s" % "\n".join(self.err_acc))
+                logger.debug("Std out: %s" % self.out_acc.text())
+                logger.debug("Error out: %s" % self.err_acc.text())
 
         except Exception as e:
             self.is_running = False
@@ -353,8 +452,16 @@ class AsyncRunner:
 
         finally:
             self.was_running = True
-            rtt_utils.try_fnc(lambda: self.feeder.close())
-            rtt_utils.try_fnc(lambda: self.proc.close())
+            self.is_running = False
+            rtt_utils.try_fnc(lambda: sel.close())
+            with self.wakeup_lock:
+                for fd in (pidfd, self.wakeup_r, self.wakeup_w):
+                    if fd is not None:
+                        rtt_utils.try_fnc(lambda: os.close(fd))
+                self.wakeup_r, self.wakeup_w = None, None
+            self.out_acc.close()
+            self.err_acc.close()
+            self.deinit()
 
             if self.on_finished:
                 self.on_finished(self)
@@ -362,45 +469,69 @@ class AsyncRunner:
     def on_change(self):
         pass
 
-    def shutdown(self):
+    def wait(self, timeout=None):
+        """Waits for the process to finish, returns True if finished"""
+        return self.finished_event.wait(timeout)
+
+    def shutdown(self, timeout=None):
+        """
+        Terminates the program with sigterm, killed after kill_timeout. Waits at most timeout seconds
+        (by default a bit longer than the kill takes), returns True if the program finished.
+        """
         if not self.is_running:
-            return
+            return True
 
         self.terminating = True
-        time.sleep(1)
+        self.wakeup()
 
-        # Terminating with sigint
         logger.info("Waiting for program to terminate...")
-        while self.is_running:
-            time.sleep(0.1)
+        timeout = timeout if timeout is not None else self.kill_timeout + 2 * self.term_interval + 5
+        if not self.finished_event.wait(timeout):
+            # Runner thread is stuck, the program is killed from here
+            if self.proc:
+                self.send_kill(self.proc)
+            if not self.finished_event.wait(self.term_interval):
+                logger.error("Program did not terminate")
+                return False
+
         logger.info("Program terminated")
         self.deinit()
+        return True
 
     def start(self):
-        install_sarge_filter()
+        self.started_event.clear()
+        self.finished_event.clear()
         self.thread = threading.Thread(target=self.run, args=())
         self.thread.setDaemon(False)
-        self.thread.start()
         self.terminating = False
         self.is_running = False
-        while not self.is_running and not self.was_running:
-            time.sleep(0.1)
+        self.thread.start()
+        self.started_event.wait()
         return self
 
 
-def get_rtt_runner(rtt_args, cwd=None):
+def set_bounded_capture(async_runner, max_lines=2000, head_lines=200, spill_dir=None):
+    """Batteries can produce hundreds of MB of output, keep only head and tail lines in memory"""
+    async_runner.capture_max_lines = max_lines
+    async_runner.capture_max_bytes = max_lines * 1024 if max_lines else None
+    async_runner.capture_head_lines = head_lines
+    async_runner.capture_spill_dir = spill_dir
+    return async_runner
+
+
+def get_rtt_runner(rtt_args, cwd=None, spill_dir=None):
     rtt_env = {'LD_LIBRARY_PATH': rtt_utils.extend_lib_path(cwd)}
     async_runner = AsyncRunner(rtt_args, cwd=cwd, shell=False, env=rtt_env)
     async_runner.log_out_after = False
     async_runner.preexec_setgrp = True
-    return async_runner
+    return set_bounded_capture(async_runner, spill_dir=spill_dir)
 
 
-def get_booltest_rtt_runner(rtt_args, cwd=None):
+def get_booltest_rtt_runner(rtt_args, cwd=None, spill_dir=None):
     async_runner = AsyncRunner(rtt_args, cwd=cwd, shell=False)
     async_runner.log_out_after = False
     async_runner.preexec_setgrp = True
-    return async_runner
+    return set_bounded_capture(async_runner, spill_dir=spill_dir)
 
 
 class SSHForwarder:
@@ -468,6 +599,171 @@ class SSHForwarderPython(SSHForwarder):
             time.sleep(0.1)
 
 
+class ForwarderStats(object):
+    def __init__(self):
+        self.connections = 0
+        self.active = 0
+        self.failures = 0
+        self.bytes_sent = 0  # local client -> remote
+        self.bytes_received = 0  # remote -> local client
+        self.open_time_total = 0.0
+        self.open_time_max = 0.0
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return "connections: %s, active: %s, failures: %s, sent: %.2f MB, received: %.2f MB, " \
+               "channel open avg: %.2f ms, max: %.2f ms" \
+               % (self.connections, self.active, self.failures, self.bytes_sent / 1024 / 1024,
+                  self.bytes_received / 1024 / 1024, 1000 * self.open_time_total / max(1, self.connections),
+                  1000 * self.open_time_max)
+
+
+class SSHForwarderParamiko(SSHForwarder):
+    """
+    In-process local port forwarding over paramiko direct-tcpip channels.
+    The listening socket is bound by the forwarder itself, so there is no race for the port.
+    Each accepted connection gets its own channel and pump thread, channels share one SSH transport
+    of the SSHConnectionManager, which reconnects the transport if it breaks. Pass the manager
+    used for SFTP to multiplex both over one SSH connection.
+    """
+    def __init__(self, ssh_params: rtt_sftp_conn.SSHParams, remote_server: str, remote_port: int, local_port=None,
+                 manager=None, bind_host='127.0.0.1'):
+        super().__init__(ssh_params, remote_server, remote_port, local_port)
+        self.own_manager = manager is None
+        self.manager = manager if manager else rtt_sftp_conn.SSHConnectionManager(ssh_params)
+        self.bind_host = bind_host
+        self.stats = ForwarderStats()
+        self.stats_lock = threading.Lock()
+        self.sock = None
+        self.thread = None
+        self.is_running = False
+        self.terminating = False
+        self.pumps = {}  # thread -> (client socket, channel)
+        self.pumps_lock = threading.Lock()
+
+    def start(self):
+        self.manager.get_transport(probe=False)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.bind_host, self.local_port or 0))
+        self.sock.listen(64)
+        self.sock.settimeout(0.5)
+        self.local_port = self.sock.getsockname()[1]
+
+        self.terminating = False
+        self.is_running = True
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+        self.thread.start()
+        logger.info("SSH forwarder listening on %s:%s -> %s:%s"
+                    % (self.bind_host, self.local_port, self.remote_server, self.remote_port))
+        return self
+
+    def accept_loop(self):
+        while not self.terminating:
+            try:
+                client, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            t = threading.Thread(target=self.handle, args=(client, addr), daemon=True)
+            with self.pumps_lock:
+                self.pumps[t] = (client, None)
+            t.start()
+        self.is_running = False
+
+    def open_channel(self, addr):
+        for attempt in range(2):
+            try:
+                return self.manager.open_channel((self.remote_server, self.remote_port), addr)
+            except Exception as e:
+                if attempt > 0 or self.terminating:
+                    raise
+                logger.warning("Could not open forwarding channel: %s, retrying" % (e,))
+
+    def handle(self, client, addr):
+        me = threading.current_thread()
+        chan = None
+        try:
+            tstart = time.time()
+            chan = self.open_channel(addr)
+            topen = time.time() - tstart
+            with self.stats_lock:
+                self.stats.connections += 1
+                self.stats.active += 1
+                self.stats.open_time_total += topen
+                self.stats.open_time_max = max(self.stats.open_time_max, topen)
+            with self.pumps_lock:
+                self.pumps[me] = (client, chan)
+
+            try:
+                self.pump(client, chan)
+            finally:
+                with self.stats_lock:
+                    self.stats.active -= 1
+
+        except Exception as e:
+            logger.error("Forwarding of connection from %s failed: %s" % (addr, e))
+            with self.stats_lock:
+                self.stats.failures += 1
+
+        finally:
+            rtt_utils.try_fnc(lambda: chan.close())
+            rtt_utils.try_fnc(lambda: client.close())
+            with self.pumps_lock:
+                self.pumps.pop(me, None)
+
+    def pump(self, client, chan):
+        sel = selectors.DefaultSelector()
+        try:
+            sel.register(client, selectors.EVENT_READ, 'client')
+            sel.register(chan, selectors.EVENT_READ, 'chan')
+            while not self.terminating:
+                for key, _ in sel.select(1.0):
+                    if key.data == 'client':
+                        data = client.recv(64*1024)
+                        if not data:
+                            return
+                        chan.sendall(data)
+                        with self.stats_lock:
+                            self.stats.bytes_sent += len(data)
+                    else:
+                        data = chan.recv(64*1024)
+                        if not data:
+                            return
+                        client.sendall(data)
+                        with self.stats_lock:
+                            self.stats.bytes_received += len(data)
+        finally:
+            sel.close()
+
+    def get_stats(self):
+        with self.stats_lock:
+            return self.stats.to_dict()
+
+    def shutdown(self):
+        logger.info("Shutting down SSH forwarder, %s" % self.stats)
+        self.terminating = True
+        rtt_utils.try_fnc(lambda: self.sock.close())
+        if self.thread:
+            self.thread.join(5)
+
+        with self.pumps_lock:
+            pumps = list(self.pumps.items())
+        for t, (client, chan) in pumps:
+            rtt_utils.try_fnc(lambda: client.close())
+            rtt_utils.try_fnc(lambda: chan.close())
+            t.join(2)
+
+        if self.own_manager:
+            self.manager.close()
+        self.is_running = False
+
+
 def bind_random_port():
     for _ in range(5000):
         port = random.randrange(20000, 65535)
@@ -548,6 +844,7 @@ class SSHForwarderLinux(SSHForwarder):
 
         logger.info("Creating runner with: %s, env: %s" % (cmd, env))
         self.runner = AsyncRunner(cmd, shell=True, env=env)
+        set_bounded_capture(self.runner, max_lines=1000, head_lines=100)
         self.runner.on_output = self.on_ssh_line
         self.runner.on_tick = self.on_ssh_tick
         self.runner.on_finished = self.on_ssh_finish
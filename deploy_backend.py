@@ -222,8 +222,8 @@ def main():
 
         install_python_pkg("pip", no_cache=False)
         install_python_pkgs([
-            "mysqlclient", "sarge", "requests", "shellescape", "coloredlogs", "filelock",
-            "sshtunnel", "booltest", "booltest-rtt"
+            "mysqlclient", "requests", "shellescape", "coloredlogs", "filelock",
+            "sshtunnel", "zstandard", "booltest", "booltest-rtt"
         ])
 
         # Get current versions of needed tools from git
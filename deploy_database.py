@@ -7,6 +7,7 @@ import traceback
 import os
 from common.rtt_deploy_utils import *
 from common.rtt_constants import *
+from common import rtt_migrations
 
 ################################
 # Global variables declaration #
@@ -39,7 +40,8 @@ def main():
     # Sanity checks
     try:
         check_files_exists({
-            CommonConst.CREATE_TABLES_SCRIPT
+            CommonConst.CREATE_TABLES_SCRIPT,
+            CommonConst.MIGRATIONS_DIR
         })
     except AssertionError as e:
         print_error("Invalid configuration. {}".format(e))
@@ -85,6 +87,14 @@ def main():
                             .format(Database.MYSQL_ROOT_USERNAME),
                             stdin=open(CommonConst.CREATE_TABLES_SCRIPT, "r"))
 
+        # Bring the fresh schema to the latest version, later upgrades use files/migrate_db.py
+        print_info("Applying schema migrations")
+        with create_file_wperms(tmp_sql, mask=0o600, mode='w') as fh:
+            fh.write(rtt_migrations.get_migrations_script(Database.MYSQL_DB_NAME))
+        exec_sys_call_check("mysql --no-auto-rehash -u {}"
+                            .format(Database.MYSQL_ROOT_USERNAME),
+                            stdin=open(tmp_sql, "r"))
+
     except BaseException as e:
         print_error("{}. Fix error and run the script again.".format(e))
         traceback.print_exc()
@@ -232,7 +232,7 @@ def main():
 
         install_python_pkg("pip", no_cache=False)
         install_python_pkgs([
-            "pyinstaller", "filelock", "jsonpath-ng", "booltest", "booltest-rtt"
+            "pyinstaller", "filelock", "jsonpath-ng", "zstandard", "booltest", "booltest-rtt"
         ])
 
         os.chdir(Frontend.CHROOT_RTT_FILES)
@@ -72,8 +72,8 @@ def main():
 
         python_packages = [
             "wheel", "django==2.0.8", "django-bootstrap3", "django-bootstrap-form", "django-datetime-widget",
-            "mysqlclient", "sarge", "requests", "shellescape", "coloredlogs", "filelock",
-            "configparser", "cryptography",
+            "mysqlclient", "requests", "shellescape", "coloredlogs", "filelock",
+            "configparser", "cryptography", "zstandard",
             "pyinstaller", "filelock", "jsonpath-ng"
         ]
 
@@ -12,12 +12,15 @@
 import os
 import configparser
 import sys
+import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import coloredlogs
 from common.clilogging import *
 from common.rtt_db_conn import *
 from common.rtt_deploy_utils import *
 from common import rtt_utils
+from common.rtt_cache import DataCache, get_protected_hashes, load_max_size, load_shared_cache
 from common import rtt_constants
 
 
@@ -34,24 +37,59 @@ cache_config_dir = ""
 #########################
 # Functions declaration #
 #########################
-def delete_cache_files(exp_id):
+def get_file_size(path):
+    """Bytes reclaimed by deleting the path, hard links shared with other files and symlinks free nothing"""
+    try:
+        st = os.lstat(path)
+        return st.st_size if st.st_nlink <= 1 and not os.path.islink(path) else 0
+    except OSError:
+        return 0
+
+
+def delete_cache_files(exp_id, dry_run=False):
+    """Deletes cached data and config of the experiment, returns number of reclaimed bytes"""
+    reclaimed = 0
     cache_data_file = os.path.join(cache_data_dir, "{}.bin".format(exp_id))
     cache_config_file = os.path.join(cache_config_dir, "{}.json".format(exp_id))
-    if os.path.exists(cache_data_file):
-        print_info("Deleting file {}".format(cache_data_file))
-        os.remove(cache_data_file)
-        for assoc in rtt_utils.get_associated_files(cache_data_file):
+    for cache_file in (cache_data_file, cache_config_file):
+        if not os.path.lexists(cache_file):
+            print_info("File was already removed: {}".format(cache_file))
+            continue
+
+        reclaimed += get_file_size(cache_file)
+        if dry_run:
+            print_info("Would delete file {}".format(cache_file))
+            continue
+
+        print_info("Deleting file {}".format(cache_file))
+        os.remove(cache_file)
+        for assoc in rtt_utils.get_associated_files(cache_file):
             rtt_utils.try_remove(assoc)
-    else:
-        print_info("File was already removed: {}".format(cache_data_file))
+    return reclaimed
+
+
+def get_cached_experiment_ids(data_dir):
+    res = []
+    for data_file in os.listdir(data_dir):
+        if not data_file.endswith('.bin'):
+            continue
+        try:
+            res.append(int(os.path.splitext(data_file)[0]))
+        except ValueError:
+            pass
+    return res
 
-    if os.path.exists(cache_config_file):
-        print_info("Deleting file {}".format(cache_config_file))
-        os.remove(cache_config_file)
-        for assoc in rtt_utils.get_associated_files(cache_config_file):
-            rtt_utils.try_remove(assoc)
-    else:
-        print_info("File was already removed: {}".format(cache_config_file))
+
+def get_finished_experiments(cursor, exp_ids, chunk=1000):
+    """Returns IDs of finished experiments from exp_ids, statuses are loaded in chunked IN queries"""
+    res = []
+    exp_ids = list(exp_ids)
+    for offset in range(0, len(exp_ids), chunk):
+        cur_ids = exp_ids[offset:offset + chunk]
+        cursor.execute("SELECT id FROM experiments WHERE status='finished' AND id IN (%s)"
+                       % ','.join(['%s'] * len(cur_ids)), cur_ids)
+        res += [row[0] for row in cursor.fetchall()]
+    return res
 
 
 def get_rtt_root_dir(config_dir):
@@ -60,7 +98,7 @@ def get_rtt_root_dir(config_dir):
     return os.sep.join(config_els[:-1 * len(base_els)])
 
 
-def clean_caches(main_cfg_file, mysql_params=None):
+def clean_caches(main_cfg_file, mysql_params=None, dry_run=False, workers=8):
     global cache_data_dir
     global cache_config_dir
 
@@ -91,19 +129,31 @@ def clean_caches(main_cfg_file, mysql_params=None):
     cursor = db.cursor()
 
     try:
-        for data_file in os.listdir(cache_data_dir):
-            if not data_file.endswith('.bin'):
-                continue
-            exp_id = int(os.path.splitext(os.path.basename(data_file))[0])
-            cursor.execute("SELECT status FROM experiments WHERE id=%s",
-                           (exp_id,))
-
-            if cursor.rowcount == 1:
-                row = cursor.fetchone()
-                if row[0] == 'finished':
-                    print_info("Deleting files of experiment: {}".format(exp_id))
-                    delete_cache_files(exp_id)
-
+        exp_ids = get_cached_experiment_ids(cache_data_dir)
+        finished = get_finished_experiments(cursor, exp_ids)
+        db.commit()
+        print_info("Cached experiments: {}, finished: {}".format(len(exp_ids), len(finished)))
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            reclaimed = sum(executor.map(lambda x: delete_cache_files(x, dry_run=dry_run), finished))
+
+        # Links to shared blobs evicted from the shared cache are dropped
+        DataCache(cache_data_dir).remove_dangling(dry_run=dry_run)
+
+        # Content-addressed cache: blobs over the size limit are evicted, without the limit blobs
+        # no longer linked to any experiment are removed. Data of unfinished experiments are kept.
+        if DataCache.is_cas(cache_data_dir):
+            data_cache = DataCache(cache_data_dir, max_size=load_max_size(main_cfg))
+            removed = [os.path.join(cache_data_dir, "{}.bin".format(x)) for x in finished] if dry_run else None
+            reclaimed += data_cache.evict(get_protected_hashes(cursor), unused=not data_cache.max_size,
+                                          dry_run=dry_run, removed=removed)
+
+        # Shared cache tier has no experiment files, only the size limit applies
+        shared_cache, _ = load_shared_cache(main_cfg)
+        if shared_cache and shared_cache.max_size:
+            reclaimed += shared_cache.evict(get_protected_hashes(cursor), dry_run=dry_run)
+
+        print_info("{} {:.2f} MB".format("Reclaimable:" if dry_run else "Reclaimed:", reclaimed / 1024 / 1024))
         cursor.close()
         db.close()
 
@@ -112,6 +162,9 @@ def clean_caches(main_cfg_file, mysql_params=None):
         cursor.close()
         db.close()
 
+    if dry_run:
+        return
+
     rtt_utils.try_clean_logs(rtt_log_dir)
     rtt_utils.try_clean_workers(rtt_work_dir)
 
@@ -120,13 +173,15 @@ def clean_caches(main_cfg_file, mysql_params=None):
 # MAIN FUNCTION #
 #################
 def main():
-    # Get path to main config from console
-    if len(sys.argv) != 2:
-        print_info("[USAGE] {} <path-to-main-config-file>".format(sys.argv[0]))
-        sys.exit(1)
-
-    main_cfg_file = sys.argv[1]
-    clean_caches(main_cfg_file)
+    parser = argparse.ArgumentParser(description='Cleans cached files of finished experiments')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_const', const=True, default=False,
+                        help='Only reports files to delete and reclaimable space')
+    parser.add_argument('--workers', dest='workers', default=8, type=int,
+                        help='Number of parallel file deletions')
+    parser.add_argument('config', default=None,
+                        help='Config file')
+    args = parser.parse_args()
+    clean_caches(args.config, dry_run=args.dry_run, workers=args.workers)
 
 
 if __name__ == "__main__":
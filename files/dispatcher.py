@@ -0,0 +1,84 @@
+#! /usr/bin/python3
+
+######################################################################
+# Job dispatcher daemon. Runs next to the RTT database, keeps        #
+# in-memory index of pending jobs and hands them out to workers      #
+# started with run_jobs.py --dispatcher URL, so workers do not poll  #
+# the jobs table. Workers fall back to direct claiming if the        #
+# dispatcher is not reachable.                                       #
+######################################################################
+
+import configparser
+import sqlite3
+import sys
+import argparse
+import logging
+import coloredlogs
+from common.clilogging import *
+from common import rtt_dispatch
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_store(args, main_cfg):
+    if args.sqlite:
+        def connect():
+            db = sqlite3.connect(args.sqlite, check_same_thread=False)
+            db.executescript(rtt_dispatch.SQLITE_SCHEMA)
+            return db
+        return rtt_dispatch.DispatchStore(connect, paramstyle='qmark')
+
+    # MySQLdb is needed only with the MySQL backend
+    from common.rtt_db_conn import mysql_load_params, connect_mysql_db
+    params = mysql_load_params(main_cfg)
+    return rtt_dispatch.DispatchStore(lambda: connect_mysql_db(params), paramstyle='format')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RTT job dispatcher')
+    parser.add_argument('--host', dest='host', default=None,
+                        help='Address to listen on, default 0.0.0.0')
+    parser.add_argument('--port', dest='port', default=None, type=int,
+                        help='Port to listen on, default 8090')
+    parser.add_argument('--refresh', dest='refresh', default=None, type=float,
+                        help='Seconds between reloads of pending jobs, default 5')
+    parser.add_argument('--sqlite', dest='sqlite', default=None,
+                        help='Uses SQLite database file instead of MySQL, for local testing')
+    parser.add_argument('config', default=None, nargs='?',
+                        help='Config file with the MySQL-Database and optional Dispatcher section')
+    args = parser.parse_args()
+
+    main_cfg = configparser.ConfigParser()
+    if args.config:
+        main_cfg.read(args.config)
+        if len(main_cfg.sections()) == 0:
+            print_error("Can't read configuration: {}".format(args.config))
+            sys.exit(1)
+    elif not args.sqlite:
+        print_error("Configuration file is required without --sqlite")
+        sys.exit(1)
+
+    host = args.host or main_cfg.get('Dispatcher', 'Address', fallback='0.0.0.0')
+    port = args.port or main_cfg.getint('Dispatcher', 'Port', fallback=8090)
+    refresh = args.refresh or main_cfg.getfloat('Dispatcher', 'Refresh-interval', fallback=5)
+    token = main_cfg.get('Dispatcher', 'Token', fallback=None)
+
+    dispatcher = rtt_dispatch.Dispatcher(create_store(args, main_cfg), refresh_interval=refresh).start()
+    server = rtt_dispatch.create_server(dispatcher, host=host, port=port, token=token)
+    logger.info("Dispatcher listening on %s:%s, pending jobs: %s" % (host, port, dispatcher.index.size))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Terminating")
+    finally:
+        server.server_close()
+        dispatcher.shutdown()
+
+
+if __name__ == "__main__":
+    coloredlogs.CHROOT_FILES = []
+    coloredlogs.install(level=logging.INFO, use_chroot=False)
+    print_start("dispatcher")
+    main()
+    print_end()
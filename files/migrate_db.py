@@ -0,0 +1,61 @@
+#! /usr/bin/python3
+
+######################################################################
+# Script applies versioned schema migrations from files/migrations   #
+# to the RTT database. Applied versions are recorded in the          #
+# schema_migrations table, so the script can be run repeatedly.      #
+######################################################################
+
+import configparser
+import sys
+import argparse
+import logging
+import coloredlogs
+from common.clilogging import *
+from common.rtt_db_conn import *
+from common import rtt_migrations
+
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Applies RTT database schema migrations')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_const', const=True, default=False,
+                        help='Only prints migrations to apply')
+    parser.add_argument('--status', dest='status', action='store_const', const=True, default=False,
+                        help='Prints applied and pending migrations')
+    parser.add_argument('--target', dest='target', default=None, type=int,
+                        help='Migrate up to this version')
+    parser.add_argument('config', default=None,
+                        help='Config file with the MySQL-Database section')
+    args = parser.parse_args()
+
+    main_cfg = configparser.ConfigParser()
+    main_cfg.read(args.config)
+    if len(main_cfg.sections()) == 0:
+        print_error("Can't read configuration: {}".format(args.config))
+        sys.exit(1)
+
+    db = create_mysql_db_conn(main_cfg)
+    try:
+        if args.status:
+            cursor = db.cursor()
+            applied = rtt_migrations.get_applied_versions(cursor)
+            for migration in rtt_migrations.load_migrations():
+                print_info("{:04d} {:40s} {}".format(migration.version, migration.name,
+                                                     'applied' if migration.version in applied else 'pending'))
+            return
+
+        rtt_migrations.migrate(db, target=args.target, dry_run=args.dry_run)
+
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    coloredlogs.CHROOT_FILES = []
+    coloredlogs.install(level=logging.INFO, use_chroot=False)
+    print_start("migrate-db")
+    main()
+    print_end()
@@ -0,0 +1,17 @@
+-- Indexes matching the scheduler query shapes.
+
+-- Job claim: status='pending' AND experiment_id IN (...) ORDER BY id
+CREATE INDEX jobs_status_experiment ON jobs (status, experiment_id, id);
+-- Stale job reset: status='running' AND run_heartbeat < ...
+CREATE INDEX jobs_status_heartbeat ON jobs (status, run_heartbeat);
+-- Experiment finalization: jobs of an experiment by status, also serves the experiment_id foreign key
+CREATE INDEX jobs_experiment_status ON jobs (experiment_id, status);
+-- Prefixes of the new indexes
+DROP INDEX jobs_status ON jobs;
+DROP INDEX experiment_id ON jobs;
+
+-- Pending / running experiments lookup
+CREATE INDEX experiments_status ON experiments (status, id);
+
+-- Partial results purge: experiment_id=... AND name=...
+CREATE INDEX batteries_experiment_name ON batteries (experiment_id, name);
@@ -0,0 +1,14 @@
+-- Registry of experiment data cached by workers, used by the cache-affinity scheduling.
+-- cache_id identifies the cache directory (node-local or on a shared FS), location is the worker location
+-- (backend-loc), i.e., the cluster. Rows are added on download, removed on eviction and by periodic sync.
+
+CREATE TABLE cache_registry (
+    cache_id            VARCHAR(190) NOT NULL,
+    experiment_id       BIGINT UNSIGNED NOT NULL,
+    location            VARCHAR(190) DEFAULT NULL,
+    worker_id           BIGINT UNSIGNED DEFAULT NULL,
+    updated             TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (cache_id, experiment_id),
+    INDEX cache_registry_location (location, experiment_id),
+    INDEX cache_registry_experiment (experiment_id)
+) ENGINE = INNODB;
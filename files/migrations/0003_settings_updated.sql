@@ -0,0 +1,3 @@
+-- Change stamp of the settings, workers check COUNT(*), MAX(updated) and reload settings only when it changes.
+
+ALTER TABLE rtt_settings ADD COLUMN updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;
@@ -0,0 +1,11 @@
+-- Named counters. The jobs generation is bumped in each transaction adding or resetting pending jobs,
+-- idle --all-time workers poll the single row and wake up when it changes instead of sleeping blindly.
+
+CREATE TABLE rtt_counters (
+    name                VARCHAR(64) NOT NULL,
+    value               BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    updated             TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (name)
+) ENGINE = INNODB;
+
+INSERT IGNORE INTO rtt_counters (name, value) VALUES ('jobs', 0);
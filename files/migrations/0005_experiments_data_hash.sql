@@ -0,0 +1,3 @@
+-- Deduplicated submission: experiments with the same data by data_file_sha256
+
+CREATE INDEX experiments_data_sha256 ON experiments (data_file_sha256, id);
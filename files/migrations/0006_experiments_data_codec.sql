@@ -0,0 +1,4 @@
+-- Compression of the experiment data on the storage server, NULL for uncompressed {id}.bin,
+-- 'zstd' for {id}.bin.zst. data_file_sha256 is always of the uncompressed data.
+
+ALTER TABLE experiments ADD COLUMN data_file_codec VARCHAR(16) DEFAULT NULL;
@@ -29,9 +29,14 @@ import itertools
 import binascii
 import subprocess
 import shutil
+import threading
+import typing
 from common.clilogging import *
 from common.rtt_db_conn import *
 from common.rtt_sftp_conn import *
+from common.rtt_cache import DataCache, CacheRegistry, get_protected_hashes, load_max_size, load_cache_id, \
+    load_shared_cache
+from common.rtt_dispatch import DispatcherClient
 from common import rtt_constants
 from common import rtt_worker
 from common import rtt_utils
@@ -67,7 +72,23 @@ booltest_rtt_binary = ""
 sender_email = ""
 backend_data = BackendData()
 max_sec_per_test = 4000
+download_streams = 1
+verify_hash_rate = 0.0
+output_spill = False
+idle_backoff_min = 5  # idle --all-time slot waits grow from min to max, reset on a job or new jobs notification
+idle_backoff_max = 120
+jobs_generation_interval = 5
+data_cache = None  # type: typing.Optional[DataCache]
+dispatcher_client = None  # type: typing.Optional[DispatcherClient]
+cache_registry = None  # type: typing.Optional[CacheRegistry]
+claim_stats = collections.Counter()  # claims by the cache affinity tier
+claim_stats_lock = threading.Lock()
 worker_pid = os.getpid()
+skip_locked_supported = None
+scratch_lock = threading.Lock()
+
+# Jobs without heartbeat for 15 minutes are reset, keep the interval well below
+MAX_HEARTBEAT_INTERVAL = 5*60
 
 
 ########################
@@ -83,38 +104,140 @@ def randomize_first_n(lst, n=100):
     return pa + pb
 
 
-def reset_jobs(connection):
-    logger.info("Job reset routine")
-    cursor = connection.cursor()
-    sql_select_reset_job = \
-        """
-        SELECT id, battery, experiment_id, lock_version FROM jobs
-        WHERE status='running' 
-          AND run_started > DATE_SUB(NOW(), INTERVAL 3 DAY)
-          AND run_heartbeat < DATE_SUB(NOW(), INTERVAL 15 MINUTE)
-          AND retries < 10
-        """
+# Running job without heartbeat for this long is considered dead and reset
+SQL_STALE_JOB = """status='running' 
+                   AND run_started > DATE_SUB(NOW(), INTERVAL 3 DAY)
+                   AND run_heartbeat < DATE_SUB(NOW(), INTERVAL 15 MINUTE)
+                   AND retries < 10"""
+SQL_STALE_JOBS = "SELECT id, experiment_id, battery FROM jobs WHERE %s ORDER BY id" % SQL_STALE_JOB
 
-    try:
-        cursor.execute(sql_select_reset_job)
-        if cursor.rowcount == 0:
-            return
+# Job conditions of the claim preference tiers, see claim_job
+SQL_CLAIM_LOCATION = "experiment_id IN (SELECT experiment_id FROM cache_registry WHERE location=%s AND cache_id!=%s)"
+SQL_CLAIM_PENDING = "experiment_id IN (SELECT id FROM experiments WHERE status='pending')"
+SQL_CLAIM_ANY = "1=1"
+
+SQL_FINALIZE_EXPERIMENT = """UPDATE experiments SET run_finished=NOW(), status='finished'
+                             WHERE id=%s AND status!='finished'
+                               AND NOT EXISTS (SELECT 1 FROM jobs 
+                                               WHERE experiment_id=%s AND status NOT IN ('finished', 'error'))"""
+SQL_FINALIZE_EXPERIMENTS = """UPDATE experiments e 
+                              JOIN (SELECT j.experiment_id FROM jobs j 
+                                    JOIN experiments r ON r.id=j.experiment_id AND r.status='running'
+                                    GROUP BY j.experiment_id 
+                                    HAVING SUM(j.status NOT IN ('finished', 'error'))=0) f ON f.experiment_id=e.id
+                              SET e.run_finished=NOW(), e.status='finished'
+                              WHERE e.status='running'"""
+
+
+def sql_in(num):
+    return ','.join(['%s'] * num)
+
+
+def sql_claim_cached(num_exps):
+    """Claim condition of jobs of the given number of experiments"""
+    return "experiment_id IN (%s)" % sql_in(num_exps)
+
+
+def sql_claim_select(cond_sql):
+    """Pending job satisfying cond_sql with the lowest ID"""
+    return "SELECT id, experiment_id, battery FROM jobs WHERE status='pending' AND (%s) ORDER BY id LIMIT 1" \
+        % cond_sql
+
+
+def sql_reset_job_chunk(num_jobs):
+    return """UPDATE jobs SET status='pending', retries=retries+1, lock_version=lock_version+1 
+              WHERE id IN (%s) AND %s""" % (sql_in(num_jobs), SQL_STALE_JOB)
 
-        logger.info("Going to reset %s jobs" % cursor.rowcount)
-        for row in list(cursor.fetchall()):
-            jid = row[0]
 
-            logger.info("Base job reset %s" % jid)
-            cursor.execute("UPDATE jobs SET status='error', retries=retries+1, lock_version=lock_version+1 "
-                           "WHERE id=%s AND lock_version=%s AND status='running'", (jid, row[3]))
+def sql_jobs_battery_ids(num_pairs):
+    """Battery results by (experiment_id, name) pairs"""
+    return "SELECT id FROM batteries WHERE %s" % ' OR '.join(['(experiment_id=%s AND name=%s)'] * num_pairs)
 
-            if cursor.rowcount <= 0:
-                logger.info("Update failed, opt lock not acquired")
 
-            purge_unfinished_job(cursor, jid, eid=row[2], battery=row[1])
+def execute_retry(connection, fnc, attempts=6):
+    """
+    Runs fnc(cursor) in its own transaction and commits. On lock wait timeout or deadlock the
+    transaction is rolled back and retried with a backoff, other exceptions propagate.
+    """
+    for idx in range(attempts):
+        try:
+            cursor = connection.cursor()
+            res = fnc(cursor)
+            cursor.close()
+            connection.commit()
+            return res
+
+        except Exception as e:
+            rtt_utils.try_fnc(lambda: connection.rollback())
+            if not rtt_utils.is_lock_timeout_exception(e) or idx + 1 >= attempts:
+                raise
+            logger.info("Lock timeout, retrying %s: %s" % (idx, e))
+            rand_sleep(2 * (idx + 1), 1)
+
+
+def get_jobs_battery_ids(cursor, jobs):
+    """IDs of (partial) battery results of the jobs given as (id, experiment_id, battery)"""
+    pairs = [(eid, rtt_worker.try_fnc(lambda: rtt_worker.job_battery_to_experiment(battery)))
+             for _, eid, battery in jobs]
+    pairs = [x for x in pairs if x[1]]
+    if not pairs:
+        return []
+
+    params = list(itertools.chain.from_iterable(pairs))
+    cursor.execute(sql_jobs_battery_ids(len(pairs)), params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def delete_batteries(cursor, battery_ids):
+    """Deletes battery results, cascades to tests, variants, subtests and p-values"""
+    if battery_ids:
+        cursor.execute("DELETE FROM batteries WHERE id IN (%s)" % ','.join(['%s'] * len(battery_ids)), battery_ids)
+
+
+def purge_jobs_results(connection, jobs, batch=20):
+    """Deletes partial battery results of the jobs in short transactions of at most batch batteries"""
+    battery_ids = execute_retry(connection, lambda c: get_jobs_battery_ids(c, jobs))
+    for offset in range(0, len(battery_ids), batch):
+        cur_ids = battery_ids[offset:offset + batch]
+        execute_retry(connection, lambda c: delete_batteries(c, cur_ids))
+    return len(battery_ids)
+
+
+def reset_job_chunk(cursor, jobs):
+    """Moves stale jobs back to pending and removes results inserted meanwhile. Returns number of reset jobs"""
+    cursor.execute(sql_reset_job_chunk(len(jobs)), [x[0] for x in jobs])
+    num_reset = cursor.rowcount
+    if num_reset > 0:
+        delete_batteries(cursor, get_jobs_battery_ids(cursor, jobs))
+        bump_jobs_generation(cursor, reset=True)
+    return num_reset
+
+
+def reset_jobs(connection, chunk=50, purge_batch=20):
+    """
+    Resets stale running jobs to pending and purges their partial results.
+    Jobs are processed in chunks, partial battery results of a chunk are deleted in small batches first,
+    each in a short transaction, then the chunk is moved to pending by one statement.
+    Jobs stay running until the final statement, so an interrupted reset is simply repeated by the next run.
+    """
+    logger.info("Job reset routine")
+    try:
+        def load_stale(cursor):
+            cursor.execute(SQL_STALE_JOBS)
+            return list(cursor.fetchall())
+
+        jobs = execute_retry(connection, load_stale)
+        if not jobs:
+            return
 
-            cursor.execute("UPDATE jobs SET status='pending', lock_version=lock_version+1 "
-                           "WHERE id=%s AND lock_version=%s AND status='error'", (jid, row[3] + 1))
+        logger.info("Going to reset %s jobs" % len(jobs))
+        num_reset, num_purged = 0, 0
+        for offset in range(0, len(jobs), chunk):
+            cur_jobs = jobs[offset:offset + chunk]
+            num_purged += purge_jobs_results(connection, cur_jobs, batch=purge_batch)
+            num_reset += execute_retry(connection, lambda c: reset_job_chunk(c, cur_jobs))
+            logger.info("Job reset progress: %s/%s jobs checked, %s reset, %s batteries purged"
+                        % (offset + len(cur_jobs), len(jobs), num_reset, num_purged))
 
         logger.info("Jobs cleaned")
 
@@ -127,143 +250,208 @@ def reset_jobs(connection):
         logger.info("Jobs clean finished")
 
 
-def get_job_info(connection, num_workers=1000):
-    global backend_data
-    cursor = connection.cursor()
+def db_supports_skip_locked(connection):
+    """
+    Returns True if the server supports SELECT ... FOR UPDATE SKIP LOCKED.
+    MySQL supports it since 8.0.1, MariaDB since 10.6. Result is cached for the process.
+    """
+    global skip_locked_supported
+    if skip_locked_supported is not None:
+        return skip_locked_supported
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT VERSION()")
+        version = cursor.fetchone()[0]
+        skip_locked_supported = rtt_utils.mysql_supports_skip_locked(version)
+        logger.info("DB version: %s, SKIP LOCKED supported: %s" % (version, skip_locked_supported))
+
+    except Exception as e:
+        logger.error("Exception in DB version check: %s" % (e,), exc_info=e)
+        skip_locked_supported = False
+    return skip_locked_supported
 
-    # Preparing sql expressions
-    sql_upd_job_running = \
-        """UPDATE jobs SET run_started=NOW(), status='running', run_heartbeat=NOW(), 
+
+def get_cached_experiment_ids(limit=None):
+    """Experiment IDs whose data are completely downloaded in the local cache"""
+    res = []
+    try:
+        for fname in os.listdir(cache_data_dir):
+            if not fname.endswith('.bin'):
+                continue
+            eid = rtt_utils.try_fnc(lambda: int(fname[:-4]))
+            fpath = os.path.join(cache_data_dir, fname)
+            # Link to an evicted shared blob is dangling, exists() follows the link
+            if eid is None or not os.path.exists(fpath) or not os.path.exists(fpath + '.downloaded'):
+                continue
+            res.append(eid)
+
+    except Exception as e:
+        logger.error("Exception in listing cached experiments: %s" % (e,), exc_info=e)
+
+    random.shuffle(res)
+    return res[:limit] if limit else res
+
+
+def claim_job(cursor, cond_sql, cond_params=()):
+    """
+    Claims one pending job satisfying cond_sql. Transaction is not committed.
+    With SKIP LOCKED the job row is locked by a locking read skipping rows locked by other claimers,
+    otherwise the job is claimed by a single UPDATE ... LIMIT 1, remembering the claimed ID in LAST_INSERT_ID().
+    Returns JobInfo or None if there is no such job.
+    """
+    if skip_locked_supported:
+        cursor.execute(sql_claim_select(cond_sql) + " FOR UPDATE SKIP LOCKED", cond_params)
+        if cursor.rowcount <= 0:
+            return None
+
+        row = cursor.fetchone()
+        cursor.execute(
+            """UPDATE jobs SET run_started=NOW(), status='running', run_heartbeat=NOW(), 
+               worker_id=%s, worker_pid=%s, lock_version=lock_version+1 
+               WHERE id=%s""", (backend_data.id_key, os.getpid(), row[0]))
+        return JobInfo(row[0], row[1], row[2])
+
+    cursor.execute(
+        """UPDATE jobs SET id=LAST_INSERT_ID(id), run_started=NOW(), status='running', run_heartbeat=NOW(), 
            worker_id=%s, worker_pid=%s, lock_version=lock_version+1 
-           WHERE id=%s AND lock_version=%s"""
+           WHERE status='pending' AND (""" + cond_sql + """)
+           ORDER BY id LIMIT 1""", (backend_data.id_key, os.getpid()) + tuple(cond_params))
+    if cursor.rowcount <= 0:
+        return None
+
+    cursor.execute("SELECT id, experiment_id, battery FROM jobs WHERE id=LAST_INSERT_ID()")
+    row = cursor.fetchone()
+    return JobInfo(row[0], row[1], row[2])
+
+
+def count_claim(tier):
+    with claim_stats_lock:
+        claim_stats[tier] += 1
+
+
+def get_claim_stats():
+    """Claims by the affinity tier and the hit rate, i.e., fraction of jobs with data in the local cache"""
+    with claim_stats_lock:
+        total = sum(claim_stats.values())
+        return "local: %s, location: %s, other: %s, cache hit rate: %.2f %%" \
+               % (claim_stats['local'], claim_stats['location'], total - claim_stats['local'] - claim_stats['location'],
+                  100.0 * claim_stats['local'] / max(1, total))
+
+
+def get_job_info_dispatcher(num_workers=1000, wait=0):
+    """Claims a job from the dispatcher, with the same preference order. Raises if the dispatcher fails"""
+    time_claim = -time.time()
+    cached_exps = get_cached_experiment_ids(4 * num_workers)
+    job = dispatcher_client.claim(backend_data.id_key, os.getpid(), cached_exps, wait=wait,
+                                  location=backend_data.location)
+    if not job:
+        print_info("No pending jobs from the dispatcher, query time: %.2f" % (time_claim + time.time()))
+        raise SystemExit("No jobs")
+
+    count_claim('local' if job.experiment_id in cached_exps else 'dispatcher')
+
+    logger.info("Claimed job %s from the dispatcher, exp: %s, in %.2f s"
+                % (job.id, job.experiment_id, time_claim + time.time()))
+    return JobInfo(job.id, job.experiment_id, job.battery)
+
+
+def get_job_info(connection, num_workers=1000, wait=0):
+    """
+    Claims a job for this worker. Preference order:
+     - job of an experiment whose data are already in the local cache,
+     - job of an experiment cached by another worker in the same location (cache registry),
+     - job of an experiment no other worker has started yet (each experiment computed by a single node),
+     - any pending job.
+    Each tier costs one claim transaction, no candidate lists are transferred.
+    With the dispatcher configured the job is claimed from it, waiting up to wait seconds for a job,
+    the DB is used directly only if the dispatcher is not available.
+    """
+    if dispatcher_client:
+        try:
+            return get_job_info_dispatcher(num_workers, wait)
+        except SystemExit:
+            raise
+        except Exception as e:
+            logger.warning("Dispatcher claim failed: %s, claiming from the DB" % (e,))
+
+    db_supports_skip_locked(connection)
+    cursor = connection.cursor()
     sql_upd_experiment_running = \
         """UPDATE experiments SET run_started=NOW(), status='running' WHERE status='pending' AND id=%s"""
-    sql_sel_job = \
-        """SELECT id, experiment_id, battery, lock_version 
-           FROM jobs
-           WHERE status='pending' AND experiment_id=%s 
-           """
-    sql_sel_exps = \
-        """SELECT experiment_id FROM jobs 
-        WHERE status='pending' GROUP BY experiment_id 
-        ORDER BY experiment_id LIMIT %d 
-        """ % (4 * num_workers,)
-    sql_sel_exp_pending = \
-        """SELECT id FROM experiments 
-           WHERE status='pending' 
-           ORDER BY id LIMIT %d
-         """ % (4 * num_workers,)
-    sql_sel_jobs_pending = \
-        """SELECT id, experiment_id, battery, lock_version 
-           FROM jobs WHERE status='pending' 
-           ORDER BY id LIMIT %d
-           """ % (4 * num_workers,)
-
-    # Looking for jobs whose files are already present in local cache
-    time_exp_cached = -time.time()
-    cursor.execute(sql_sel_exps)
-    time_exp_cached += time.time()
-
-    # This terminates script if there are no pending jobs
-    if cursor.rowcount == 0:
-        connection.commit()
-        print_info("No pending jobs, query time: %.2f" % time_exp_cached)
-        sys.exit(0)
-
-    # Looking for experiments whose data are already cached
-    # on the node
-    logger.info("Pending jobs by experiment ID: %s, loaded in: %.2f" % (cursor.rowcount, time_exp_cached))
-    pending_exps = randomize_first_n(list(cursor.fetchall()), num_workers)
-    for row in pending_exps:
-        experiment_id = row[0]
-        cache_data = get_data_path(cache_data_dir, experiment_id)
-        if not os.path.exists(cache_data):
-            continue
-
-        logger.debug("Trying to acquire random job with exp_id=%s" % (experiment_id, ))
-        cursor.execute(sql_sel_job, (experiment_id, ))
-        if cursor.rowcount == 0:
-            logger.info("All pending jobs for cached data are gone, retry later, query time: %.2f" % time_exp_cached)
-            continue
-
-        crows = randomize_first_n(list(cursor.fetchall()), num_workers)
-        for crow in crows:
-            job_info = JobInfo(crow[0], crow[1], crow[2])
-
-            logger.debug("Trying to acquire job %s" % (crow,))
-            cursor.execute(sql_upd_job_running, (backend_data.id_key, os.getpid(), job_info.id, crow[3]))
-            if cursor.rowcount <= 0:
-                continue  # taken already
 
+    try:
+        time_claim = -time.time()
+
+        # Looking for jobs whose files are already present in local cache
+        cached_exps = get_cached_experiment_ids(4 * num_workers)
+        if cached_exps:
+            job_info = claim_job(cursor, sql_claim_cached(len(cached_exps)), cached_exps)
+            if job_info:
+                connection.commit()
+                count_claim('local')
+                logger.info("Claimed job %s with cached data, exp: %s, in %.2f s"
+                            % (job_info.id, job_info.experiment_id, time_claim + time.time()))
+                return job_info
+
+        # Data cached in the same location, e.g., on the shared FS of the cluster
+        if cache_registry and backend_data.location:
+            job_info = claim_job(cursor, SQL_CLAIM_LOCATION, (backend_data.location, cache_registry.cache_id))
+            if job_info:
+                connection.commit()
+                count_claim('location')
+                logger.info("Claimed job %s with data cached in the location, exp: %s, in %.2f s"
+                            % (job_info.id, job_info.experiment_id, time_claim + time.time()))
+                return job_info
+
+        # Looking for experiments that have all their jobs set as pending. This will cause that
+        # each experiment is computed by single node, given enough experiments are available
+        job_info = claim_job(cursor, SQL_CLAIM_PENDING)
+        if job_info:
+            cursor.execute(sql_upd_experiment_running, (job_info.experiment_id,))
             connection.commit()
+            count_claim('pending')
+            logger.info("Claimed job %s of a pending experiment %s in %.2f s"
+                        % (job_info.id, job_info.experiment_id, time_claim + time.time()))
             return job_info
-    rand_sleep()
-
-    # If program gets here, no relevant cached files were found
-
-    # Looking for experiments that have all their jobs set as pending. This will cause that
-    # each experiment is computed by single node, given enough experiments are available
-    logger.debug("Selecting pending experiments...")
-    time_exp_pending = -time.time()
-    cursor.execute(sql_sel_exp_pending)
-    time_exp_pending += time.time()
-
-    logger.debug("Number of pending experiments: %s, loaded in %.2f s" % (cursor.rowcount, time_exp_pending))
-    pending_exps = randomize_first_n(list(cursor.fetchall()), num_workers)
-    for row in pending_exps:
-        experiment_id = row[0]
-        logger.debug("Trying to acquire random job with exp_id=%s" % (experiment_id,))
-        cursor.execute(sql_sel_job, (experiment_id, ))
-        if cursor.rowcount == 0:
-            logger.info("All pending jobs are gone for this experiment %s, retry later, query time: %.2f" % (experiment_id, time_exp_pending))
-            continue
-
-        crows = randomize_first_n(list(cursor.fetchall()), num_workers)
-        for crow in crows:
-            job_info = JobInfo(crow[0], crow[1], crow[2])
-
-            logger.debug("Trying to acquire job %s" % (crow, ))
-            cursor.execute(sql_upd_job_running, (backend_data.id_key, os.getpid(), job_info.id, crow[3]))
-            if cursor.rowcount <= 0:
-                continue  # taken already
-
-            cursor.execute(sql_upd_experiment_running, (experiment_id, ))
+
+        # No experiment untouched by other nodes, just pick any pending job.
+        job_info = claim_job(cursor, SQL_CLAIM_ANY)
+        if job_info:
             connection.commit()
+            count_claim('any')
+            logger.info("Claimed job %s, exp: %s, in %.2f s"
+                        % (job_info.id, job_info.experiment_id, time_claim + time.time()))
             return job_info
 
-    rand_sleep()
-
-    # If program gets here it means that there are no experiments that haven't been
-    # started by other nodes before. So now just pick one job and execute him.
-    # No need for check for existence, table is locked and check is at the beginning
-    logger.debug("Selecting pending jobs...")
-    time_job_pending = -time.time()
-    cursor.execute(sql_sel_jobs_pending)
-    time_job_pending += time.time()
-
-    logger.debug("Number of pending jobs: %s, loaded in %.2f s" % (cursor.rowcount, time_job_pending))
-    pending_jobs = randomize_first_n(list(cursor.fetchall()), num_workers)
-    for row in pending_jobs:
-        logger.debug("Trying to acquire job with id=%s" % (row[0],))
+    except BaseException:
+        connection.rollback()
+        raise
 
-        job_info = JobInfo(row[0], row[1], row[2])
-        cursor.execute(sql_upd_job_running, (backend_data.id_key, os.getpid(), job_info.id, row[3]))
-        if cursor.rowcount <= 0:
-            continue  # not pending now, maybe taken. go to the next one...
+    # This terminates script if there are no pending jobs
+    connection.commit()
+    print_info("No pending jobs, query time: %.2f" % (time_claim + time.time()))
+    raise SystemExit("No jobs")
 
-        connection.commit()
-        return job_info
 
-    connection.rollback()
-    raise SystemExit("No jobs")
+def jobs_heartbeat(cursor, job_ids, worker_id=None, chunk=1000):
+    """
+    Heartbeat for all given jobs in one UPDATE ... WHERE id IN (...) per chunk, no commit.
+    Only running jobs still owned by the worker are touched, jobs reclaimed as stale stay with the new owner.
+    """
+    worker_id = worker_id if worker_id is not None else backend_data.id_key
+    job_ids = list(job_ids)
+    for offset in range(0, len(job_ids), chunk):
+        cids = job_ids[offset:offset + chunk]
+        cursor.execute("""UPDATE jobs SET run_heartbeat=NOW(), worker_pid=%%s 
+                          WHERE id IN (%s) AND status='running' AND worker_id=%%s"""
+                       % ','.join(['%s'] * len(cids)), [os.getpid()] + cids + [worker_id])
 
 
 def job_heartbeat(connection, job_info):
     for idx in range(15):
         try:
-            cursor = connection.cursor()
-            sql_upd_job_running = """UPDATE jobs SET run_heartbeat=NOW(), status='running', worker_pid=%s WHERE id=%s"""
-            cursor.execute(sql_upd_job_running, (os.getpid(), job_info.id))
+            jobs_heartbeat(connection.cursor(), [job_info.id])
             connection.commit()
             return
         except Exception as e:
@@ -271,6 +459,75 @@ def job_heartbeat(connection, job_info):
             rand_sleep()
 
 
+class HeartbeatService:
+    """
+    Sends heartbeats for all jobs of this worker process (all slots, reserved prefetched jobs)
+    and the worker keep-alive record in one transaction per interval.
+    Runs in its own thread with its own DB connection so a slow DB does not stall the job supervision.
+    """
+    def __init__(self, mysql_params: MySQLParams, backend_data: BackendData, interval=20):
+        self.mysql_params = mysql_params
+        self.backend_data = backend_data
+        self.interval = interval
+        self.db = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.job_ids = set()
+        self.stop_event = threading.Event()
+        self.last_beat = None
+
+    def register(self, job_info):
+        with self.lock:
+            self.job_ids.add(job_info.id)
+
+    def unregister(self, job_info):
+        with self.lock:
+            self.job_ids.discard(job_info.id)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, args=(), name='heartbeat')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.beat()
+            self.stop_event.wait(max(1, self.interval + random.uniform(-1, 1)))
+
+    def beat(self):
+        with self.lock:
+            job_ids = sorted(self.job_ids)
+
+        time_beat = -time.time()
+        try:
+            if not self.db:
+                self.db = connect_mysql_db(self.mysql_params)
+
+            cursor = self.db.cursor()
+            if job_ids:
+                jobs_heartbeat(cursor, job_ids, self.backend_data.id_key)
+            if self.backend_data.id_key:
+                cursor.execute("UPDATE workers SET worker_last_seen=NOW(), worker_active=1 WHERE id=%s",
+                               (self.backend_data.id_key,))
+            self.db.commit()
+            self.last_beat = time.time()
+            logger.debug("Heartbeat for jobs %s in %.2f s" % (job_ids, time_beat + time.time()))
+
+        except BaseException as e:
+            logger.error("Exception in heartbeat: %s" % (e,), exc_info=e)
+            rtt_utils.try_fnc(lambda: self.db.close())
+            self.db = None
+
+    def shutdown(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(60)
+        if self.db:
+            rtt_utils.try_fnc(lambda: self.db.close())
+            self.db = None
+
+
 def deactivate_worker(connection, backend_data):
     logger.info("Deactivating worker %s" % backend_data.id_key)
     cursor = connection.cursor()
@@ -326,17 +583,73 @@ def refresh_backend_record(connection, backend_data: BackendData):
         rand_sleep()
 
 
-def fetch_data(experiment_id, sftp, force=False):
-    storage_data_path = get_data_path(storage_data_dir, experiment_id)
+def fetch_data(experiment_id, sftp, force=False, expected_hash=None, codec=None):
+    """
+    Downloads experiment data and config to the cache, returns SHA-256 digest of the data file.
+    Data compressed on the storage with the codec are decompressed during the download.
+    """
+    storage_data_path = get_data_path(storage_data_dir, experiment_id) + codec_suffix(codec)
     storage_config_path = get_config_path(storage_config_dir, experiment_id)
     cache_data_path = get_data_path(cache_data_dir, experiment_id)
     cache_config_path = get_config_path(cache_config_dir, experiment_id)
 
-    downloader = LockedDownloader(sftp, cache_data_path)
-    downloader.download(storage_data_path, force=force)
+    if data_cache and expected_hash:
+        data_hash = data_cache.fetch(sftp, storage_data_path, cache_data_path, expected_hash, force=force,
+                                     num_streams=download_streams, verify_rate=verify_hash_rate, codec=codec)
+    else:
+        downloader = LockedDownloader(sftp, cache_data_path, num_streams=download_streams, verify_rate=verify_hash_rate,
+                                      codec=codec)
+        downloader.download(storage_data_path, force=force, expected_hash=expected_hash)
+        data_hash = downloader.digest
 
     downloader = LockedDownloader(sftp, cache_config_path)
     downloader.download(storage_config_path, force=force)
+    return data_hash
+
+
+def try_register_cached(connection, experiment_id):
+    """Records experiment data present in the local cache to the cache registry, failures are only logged"""
+    if not cache_registry:
+        return
+    try:
+        cache_registry.register(connection.cursor(), [experiment_id])
+        connection.commit()
+    except Exception as e:
+        logger.warning("Cache registry update failed: %s" % (e,))
+        rtt_utils.try_fnc(lambda: connection.rollback())
+
+
+def try_sync_cache_registry(connection):
+    """Reconciles the cache registry with the local cache content, e.g., after eviction"""
+    if not cache_registry:
+        return
+    try:
+        added, removed = cache_registry.sync(connection.cursor(), get_cached_experiment_ids())
+        connection.commit()
+        logger.info("Cache registry synced, added: %s, removed: %s" % (added, removed))
+    except Exception as e:
+        logger.warning("Cache registry sync failed: %s" % (e,))
+        rtt_utils.try_fnc(lambda: connection.rollback())
+
+
+def get_experiment_data_info(connection, experiment_id):
+    """
+    Returns (hash, codec) of the experiment data recorded on submit, SHA-256 digest of the uncompressed data file
+    or None if not available and compression codec of the data on the storage, None for uncompressed data.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT data_file_sha256, data_file_codec FROM experiments WHERE id=%s", (experiment_id,))
+    except MySQLdb.OperationalError as e:
+        # Codec column not migrated yet, all data are uncompressed
+        logger.debug("Data codec not available: %s" % (e,))
+        cursor.execute("SELECT data_file_sha256, NULL FROM experiments WHERE id=%s", (experiment_id,))
+    row = cursor.fetchone()
+    cursor.close()
+    connection.commit()
+    if not row:
+        return None, None
+    return (rtt_utils.try_fnc(lambda: bytes.fromhex(row[0])) if row[0] else None), row[1]
 
 
 def get_data_path(data_dir, experiment_id):
@@ -391,29 +704,19 @@ def get_booltest_rtt_arguments(job_info, rtt_config=None, mysql_host=None, mysql
     return args
 
 
-def try_experiment_finished(exp_id, connection):
-    for idx in range(15):
-        try:
-            return experiment_finished(exp_id, connection)
-        except Exception as e:
-            logger.error("Exception in try_experiment_finished: %s, iter: %s" % (e, idx))
-            rand_sleep()
-    raise ValueError("Could not set experiment finished")
-
-
-def experiment_finished(exp_id, connection):
-    cursor = connection.cursor()
-    cursor.execute("""SELECT status FROM jobs
-                      WHERE experiment_id=%s""", (exp_id, ))
-    if cursor.rowcount == 0:
-        print_error("Experiment with id {} has no jobs.".format(exp_id))
-        sys.exit(1)
+def finalize_experiment(cursor, exp_id):
+    """
+    Marks the experiment finished if all its jobs are finished or failed, in a single statement.
+    Returns True if this call finalized the experiment, so exactly one worker notifies the author.
+    """
+    cursor.execute(SQL_FINALIZE_EXPERIMENT, (exp_id, exp_id))
+    return cursor.rowcount > 0
 
-    for row in cursor.fetchall():
-        if row[0] != 'finished' and row[0] != 'error':
-            return False
 
-    return True
+def finalize_experiments(cursor):
+    """Marks all running experiments without unfinished jobs finished in one statement, returns their count"""
+    cursor.execute(SQL_FINALIZE_EXPERIMENTS)
+    return cursor.rowcount
 
 
 def try_clean_cache(config, mysql_params=None):
@@ -432,47 +735,16 @@ def try_clean_logs(log_dir):
     rtt_utils.try_clean_logs(log_dir)
 
 
-def purge_unfinished_job(cursor, job_id, eid, battery):
-    try:
-        logger.info("Purging job ID: %s, experiment ID: %s, battery: %s" % (job_id, eid, battery))
-        exp_batt = rtt_worker.job_battery_to_experiment(battery)
-        cursor.execute("SELECT id FROM batteries WHERE experiment_id=%s AND name=%s", (eid, exp_batt))
-
-        if cursor.rowcount == 0:
-            logger.info("No batteries results to purge")
-            return
-
-        logger.info("Going to purge %s batteries" % cursor.rowcount)
-        for row in list(cursor.fetchall()):
-            bid = row[0]
-            logger.info("Purging battery results with ID: %s, name: %s" % (bid, exp_batt))
-
-            cursor.execute("DELETE FROM batteries WHERE id=%s", (bid,))
-
-    except Exception as e:
-        logger.error("Exception in purge_unfinished_job: %s" % (e,), exc_info=e)
-        rand_sleep()
-
-
 def try_finalize_experiments(connection):
-    sql_get_running_exps = "SELECT id FROM experiments WHERE status='running'"
-    sql_upd_experiment_finished = "UPDATE experiments SET  run_finished=NOW(), status='finished' WHERE id=%s"
-
     try:
         cursor = connection.cursor()
-        cursor.execute(sql_get_running_exps)
-        logger.info("Experiment finalize check for %s records" % cursor.rowcount)
-
-        for row in cursor.fetchall():
-            eid = row[0]
-            efinished = try_experiment_finished(eid, connection)
-            if efinished:
-                logger.info("Finishing experiment %s" % eid)
-                cursor.execute(sql_upd_experiment_finished, (eid,))
+        num_finalized = finalize_experiments(cursor)
         connection.commit()
+        logger.info("Experiment finalize check, finalized %s experiments" % num_finalized)
 
     except Exception as e:
         logger.error("Exception in finalizing experiments: %s" % (e,), exc_info=e)
+        rtt_utils.try_fnc(lambda: connection.rollback())
         rand_sleep()
 
 
@@ -489,11 +761,9 @@ def try_upd_job_finished(cursor, job_info, state='finished'):
 
 
 def try_upd_experiment_finished(cursor, job_info):
-    sql_upd_experiment_finished = """UPDATE experiments SET  run_finished=NOW(), status='finished' WHERE id=%s"""
     for idx in range(15):
         try:
-            cursor.execute(sql_upd_experiment_finished, (job_info.experiment_id,))
-            return
+            return finalize_experiment(cursor, job_info.experiment_id)
         except Exception as e:
             logger.error("Exception in try_upd_experiment_finished: %s" % (e,), exc_info=e)
             rand_sleep()
@@ -502,10 +772,10 @@ def try_upd_experiment_finished(cursor, job_info):
 
 def try_make_finalized(cursor, job_info, db):
     try_upd_job_finished(cursor, job_info)
-    finished = try_experiment_finished(job_info.experiment_id, db)
+    finished = try_upd_experiment_finished(cursor, job_info)
     if finished:
         try:
-            try_upd_experiment_finished(cursor, job_info)
+            logger.info("Experiment %s finished" % job_info.experiment_id)
             send_email_to_author(job_info.experiment_id, db)
         except Exception as e:
             logger.error("Exception in try_make_finalized: %s" % (e,), exc_info=e)
@@ -522,12 +792,13 @@ def pathfix(inp):
     return inp
 
 
-def create_worker_exp_dir(worker_base_dir, backend_data: BackendData, scratch_dir=None):
+def create_worker_exp_dir(worker_base_dir, backend_data: BackendData, scratch_dir=None, slot=None):
     scratch_dir = scratch_dir if scratch_dir else worker_base_dir
     wname = pathfix(backend_data.name or "")
     waddr = pathfix(backend_data.address or "")
     wid = pathfix(backend_data.id[:8] or "")
-    exp_dir = os.path.join(scratch_dir, 'workers', '%s-%s-%s' % (waddr, wname, wid))
+    wslot = '' if slot is None else '-s%02d' % slot
+    exp_dir = os.path.join(scratch_dir, 'workers', '%s-%s-%s%s' % (waddr, wname, wid, wslot))
     rtt_worker.create_experiments_dir(exp_dir)
     rtt_worker.copy_templates_dir(worker_base_dir, exp_dir)
     return exp_dir
@@ -593,13 +864,15 @@ def get_rtt_root_dir(config_dir):
     return os.sep.join(config_els[:-1 * len(base_els)])
 
 
-def create_forwarder(main_config, mysql_param=None) -> (rtt_worker.SSHForwarder, MySQLParams):
+def create_forwarder(main_config, mysql_param=None, manager=None) -> (rtt_worker.SSHForwarder, MySQLParams):
+    """MySQL port forwarding over SSH channels, shares the SSH connection with SFTP if manager is given"""
     logger.info("Creating SSH forwarder to mysql server")
     ssh_param = ssh_load_params(main_config)
     mysql_param = mysql_param if mysql_param else mysql_load_params(main_config)
-    forwarder = rtt_worker.SSHForwarderLinux(ssh_params=ssh_param,
-                                             remote_server=mysql_param.host,
-                                             remote_port=mysql_param.port)
+    forwarder = rtt_worker.SSHForwarderParamiko(ssh_params=ssh_param,
+                                                remote_server=mysql_param.host,
+                                                remote_port=mysql_param.port,
+                                                manager=manager)
     forwarder.start()
     logger.info("Forwarder started, port: %s" % forwarder.local_port)
 
@@ -625,19 +898,109 @@ def load_rtt_settings(db):
         rand_sleep()
 
 
+def get_settings_version(db):
+    """Change stamp of rtt_settings, None if not supported by the schema"""
+    try:
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(*), MAX(updated) FROM rtt_settings")
+        row = cursor.fetchone()
+        cursor.close()
+        db.commit()
+        return tuple(row)
+    except Exception as e:
+        logger.debug("Settings version not available: %s" % (e,))
+        rtt_utils.try_fnc(lambda: db.rollback())
+        return None
+
+
+class SettingsCache:
+    """
+    Cached rtt_settings. Each get() checks the settings change stamp (one aggregate row),
+    the settings are loaded only if the stamp changed or the cached copy is older than ttl.
+    Without the stamp column (migration not applied) the settings are loaded each time.
+    """
+    def __init__(self, ttl=10*60):
+        self.ttl = ttl
+        self.settings = None
+        self.version = None
+        self.time_loaded = 0
+
+    def get(self, db):
+        version = get_settings_version(db)
+        if self.settings is not None and version is not None and version == self.version \
+                and time.time() - self.time_loaded < self.ttl:
+            return self.settings
+
+        settings = load_rtt_settings(db)
+        rtt_utils.try_fnc(lambda: db.commit())  # ends the read snapshot, next stamp check sees new changes
+        if settings is None:
+            return self.settings or {}
+
+        if self.settings is not None and settings != self.settings:
+            logger.info("Settings changed: %s" % settings)
+        self.settings, self.version, self.time_loaded = settings, version, time.time()
+        return settings
+
+
+class JobsWatcher:
+    """
+    Polls the jobs generation counter while some slots are idle, wakes them up when it changes,
+    i.e., when new jobs were submitted or stale jobs were reset to pending.
+    """
+    def __init__(self, ctx, interval=5):
+        self.ctx = ctx
+        self.interval = interval
+        self.generation = None
+        self.time_checked = 0
+
+    def check(self, db):
+        if not self.ctx.idle_slots:
+            self.generation = None  # busy slots claim anyway, start over when idle again
+            return
+        if time.time() - self.time_checked < self.interval:
+            return
+
+        self.time_checked = time.time()
+        generation = None
+        try:
+            cursor = db.cursor()
+            generation = get_jobs_generation(cursor)
+            cursor.close()
+            db.commit()
+        except Exception as e:
+            logger.debug("Jobs generation not available: %s" % (e,))
+            rtt_utils.try_fnc(lambda: db.rollback())
+
+        if generation is not None and self.generation is not None and generation != self.generation:
+            logger.info("Jobs generation changed %s -> %s, waking up idle slots" % (self.generation, generation))
+            self.ctx.notify_jobs()
+        self.generation = generation
+
+
+def load_settings(db, settings_cache=None):
+    """Settings from the dispatcher if configured, from the DB otherwise"""
+    if dispatcher_client:
+        try:
+            return dispatcher_client.settings()
+        except Exception as e:
+            logger.warning("Could not load settings from the dispatcher: %s" % (e,))
+    if settings_cache:
+        return settings_cache.get(db)
+    return load_rtt_settings(db) or {}
+
+
 def test_rtt_binary_compatibility():
     for idx in range(3):
         try:
             logger.info("Testing RTT binary compatibility...")
             runner = rtt_worker.get_rtt_runner(rtt_binary, os.path.dirname(rtt_binary))
+            banner = threading.Event()
+            runner.on_output = lambda r, line, is_err: banner.set() if 'Randomness Testing Toolkit' in line else None
             runner.start()
-            tstart = time.time()
-            while runner.is_running and time.time() - tstart < 60:
-                time.sleep(0.2)
+            runner.wait(60)
             runner.shutdown()
 
-            outs = runner.out_acc + runner.err_acc
-            found = len(list(itertools.dropwhile(lambda x: 'Randomness Testing Toolkit' not in x, outs))) > 0
+            found = banner.is_set()
 
             if not found:
                 logger.info("RTT not binary compatible, it seems, idx: %s" % idx)
@@ -667,10 +1030,7 @@ def pack_log_dir(worker_exp_dir, exp_log_dir, job_info, backend_data):
 
     tstart = time.time()
     timeout = 5 * 60
-    while async_runner.is_running and time.time() - tstart < timeout:
-        time.sleep(0.2)
-
-    if async_runner.is_running:
+    if not async_runner.wait(timeout):
         logger.error("Compress process still running")
         async_runner.shutdown()
         return
@@ -707,8 +1067,9 @@ def get_scratch_worker_dir(scratch_dir):
     return os.path.join(scratch_dir, "workers")
 
 
-def get_scratch_data_dir(scratch_dir):
-    return os.path.join(scratch_dir, "data")
+def get_scratch_data_dir(scratch_dir, slot=None):
+    data_dir = os.path.join(scratch_dir, "data")
+    return data_dir if slot is None else os.path.join(data_dir, "s%02d" % slot)
 
 
 def clean_scratch(scratch_dir=None):
@@ -720,7 +1081,23 @@ def clean_scratch(scratch_dir=None):
     rtt_utils.try_remove_rf(get_scratch_data_dir(scratch_dir))
 
 
-def scratch_input_file(file_path, args, file_hash=None):
+def get_scratch_used_size(data_root, skip_dir=None, keep=None):
+    """Size of files in the scratch data dir, files in skip_dir not present in keep are not counted"""
+    used = 0
+    for root, dirs, files in os.walk(data_root):
+        for fname in files:
+            fpath = os.path.abspath(os.path.join(root, fname))
+            if skip_dir and os.path.dirname(fpath) == skip_dir and fpath not in keep:
+                continue
+            used += rtt_utils.try_fnc(lambda: os.path.getsize(fpath)) or 0
+    return used
+
+
+def scratch_input_file(file_path, args, file_hash=None, keep=None, slot=None):
+    """
+    Copies input file to the scratch dir if enabled. Each worker slot has its own scratch data dir,
+    files in it not listed in keep (e.g., file of the running job when prefetching) are removed.
+    """
     if not args.pbspro or not args.data_to_scratch:
         return file_path
 
@@ -732,29 +1109,427 @@ def scratch_input_file(file_path, args, file_hash=None):
         st = os.stat(file_path)
         fsize = st.st_size
         scratch_size = rtt_utils.try_fnc(lambda: int(os.getenv('SCRATCH_VOLUME', None)))
-
-        # Check scratch size, if too small, use input file directly
-        if scratch_size is not None and fsize + 100*1024*1024 > scratch_size:
-            return file_path
-
-        # Delete previously used data file, re-create folder and copy
-        sdirdata = os.path.join(sdir, "data")
+        sdirdata = os.path.abspath(get_scratch_data_dir(sdir, slot))
         cached_file = os.path.join(sdirdata, os.path.basename(file_path))
-        if file_hash and os.path.exists(cached_file) and file_hash == try_hash_file(cached_file):
+        keep = set(os.path.abspath(x) for x in (keep or []) if x) - {cached_file}
+
+        # Scratch copy keeps mtime of the source, same size and mtime means the same file
+        cst = rtt_utils.try_fnc(lambda: os.stat(cached_file))
+        if cst and cst.st_size == fsize and cst.st_mtime_ns == st.st_mtime_ns \
+                and (not file_hash or random.random() >= verify_hash_rate or file_hash == try_hash_file(cached_file)):
             logger.debug("Using cached file")
             return cached_file
 
-        logger.debug("Preparing scratch data dir")
-        rtt_utils.try_fnc(lambda: shutil.rmtree(sdirdata, True))
-        os.makedirs(sdirdata, 0o771, True)
+        # Slots share the scratch space, size check and copy are done under the lock
+        with scratch_lock:
+            # Check scratch size, if too small, use input file directly
+            used_size = get_scratch_used_size(get_scratch_data_dir(sdir), sdirdata, keep)
+            if scratch_size is not None and fsize + used_size + 100*1024*1024 > scratch_size:
+                return file_path
+
+            # Delete previously used data files, re-create folder and copy
+            logger.debug("Preparing scratch data dir")
+            os.makedirs(sdirdata, 0o771, True)
+            for fname in os.listdir(sdirdata):
+                fpath = os.path.join(sdirdata, fname)
+                if fpath not in keep:
+                    rtt_utils.try_remove(fpath)
 
-        logger.debug("Copying file %s to %s scratch" % (file_path, cached_file))
-        return shutil.copyfile(file_path, cached_file, follow_symlinks=True)
+            logger.debug("Copying file %s to %s scratch" % (file_path, cached_file))
+            return shutil.copy2(file_path, cached_file, follow_symlinks=True)
 
     except Exception as e:
         logger.error("Exception in scratch data file move: %s" % (e,), exc_info=e)
 
 
+def prepare_job_data(job_info, sftp, args, keep=None, slot=None, expected_hash=None, codec=None):
+    """
+    Downloads job data and moves them to scratch. Returns (data_file_path, data_hash).
+    The hash is computed during the download, expected_hash is the hash recorded on submit.
+    """
+    data_hash = fetch_data(job_info.experiment_id, sftp, expected_hash=expected_hash, codec=codec)
+    data_file_path = get_data_path(cache_data_dir, job_info.experiment_id)
+    data_file_path = scratch_input_file(data_file_path, args, data_hash, keep=keep, slot=slot)
+    return data_file_path, data_hash
+
+
+def release_job(connection, job_info, failed=False):
+    """
+    Returns claimed but not started job back to the pending state.
+    Failed job counts as a retry, so a job failing repeatedly is not claimed forever.
+    """
+    try:
+        logger.info("Releasing %s job %s" % ('failed' if failed else 'reserved', job_info.id))
+        cursor = connection.cursor()
+        cursor.execute("""UPDATE jobs SET status='pending', run_started=NULL, run_heartbeat=NULL, 
+                          worker_id=NULL, worker_pid=NULL, lock_version=lock_version+1, retries=retries+%s 
+                          WHERE id=%s AND status='running' AND worker_id=%s""",
+                       (1 if failed else 0, job_info.id, backend_data.id_key))
+        if cursor.rowcount > 0:
+            bump_jobs_generation(cursor, reset=True)
+        connection.commit()
+
+    except Exception as e:
+        logger.error("Exception in releasing job %s: %s" % (job_info.id, e), exc_info=e)
+        rtt_utils.try_fnc(lambda: connection.rollback())
+
+
+PreparedJob = collections.namedtuple("PreparedJob", "job_info data_file_path data_hash")
+
+
+class JobPrefetcher:
+    """
+    Claims the next job and stages its data in a background thread while the current job is running.
+    The reserved job is heart-beaten by the heartbeat service and released if the worker terminates before starting it.
+    """
+    def __init__(self, pool: MySQLPool, sftp, args, num_workers=1000, slot=None, heartbeat=None):
+        self.pool = pool
+        self.heartbeat = heartbeat  # type: typing.Optional[HeartbeatService]
+        self.sftp = sftp
+        self.args = args
+        self.num_workers = num_workers
+        self.slot = slot
+        self.thread = None
+        self.lock = threading.Lock()
+        self.reserved = None  # type: typing.Optional[JobInfo]
+        self.prepared = None  # type: typing.Optional[PreparedJob]
+        self.keep = None
+
+    def start(self, keep=None):
+        if self.thread or self.prepared:
+            return
+        self.keep = keep
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        job_info = None
+        try:
+            logger.info("Prefetching next job")
+            with self.pool.connection() as db:
+                job_info = get_job_info(db, num_workers=self.num_workers)
+            with self.lock:
+                self.reserved = job_info
+            if self.heartbeat:
+                self.heartbeat.register(job_info)
+
+            with self.pool.connection() as db:
+                expected_hash, data_codec = get_experiment_data_info(db, job_info.experiment_id)
+            data_file_path, data_hash = prepare_job_data(job_info, self.sftp, self.args, keep=self.keep, slot=self.slot,
+                                                         expected_hash=expected_hash, codec=data_codec)
+            with self.pool.connection() as db:
+                try_register_cached(db, job_info.experiment_id)
+            with self.lock:
+                self.prepared = PreparedJob(job_info, data_file_path, data_hash)
+            logger.info("Prefetched job %s, expId: %s" % (job_info.id, job_info.experiment_id))
+
+        except SystemExit:
+            logger.debug("No jobs to prefetch")
+
+        except Exception as e:
+            logger.error("Exception in job prefetch: %s" % (e,), exc_info=e)
+            if job_info:
+                self.unregister(job_info)
+                with self.pool.connection() as db:
+                    release_job(db, job_info)
+            with self.lock:
+                self.reserved = None
+
+    def unregister(self, job_info):
+        if self.heartbeat and job_info:
+            self.heartbeat.unregister(job_info)
+
+    def take(self):
+        """Waits for the running prefetch and returns the prepared job, if any"""
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+        with self.lock:
+            prepared, self.prepared, self.reserved = self.prepared, None, None
+        return prepared
+
+    def shutdown(self, connection, timeout=30):
+        if self.thread:
+            self.thread.join(timeout)
+
+        with self.lock:
+            job_info, self.reserved, self.prepared = self.reserved, None, None
+        if job_info:
+            self.unregister(job_info)
+            release_job(connection, job_info)
+
+
+class WorkerContext:
+    """State shared by worker slots, maintained by the supervising main loop"""
+    def __init__(self, args, pool: MySQLPool, sftp, mysql_params: MySQLParams, worker_base_dir, scratch_dir,
+                 exp_log_dir=None):
+        self.args = args
+        self.pool = pool
+        self.sftp = sftp
+        self.mysql_params = mysql_params
+        self.worker_base_dir = worker_base_dir
+        self.scratch_dir = scratch_dir
+        self.exp_log_dir = exp_log_dir
+        self.heartbeat = None  # type: typing.Optional[HeartbeatService]
+        self.num_workers = 1000
+        self.paused = False
+        self.stop_event = threading.Event()
+        self.jobs_cond = threading.Condition()
+        self.jobs_wakeups = 0
+        self.idle_slots = 0
+
+    def is_stopping(self):
+        return self.stop_event.is_set()
+
+    def stop(self, reason=None):
+        if not self.stop_event.is_set():
+            logger.info("Stopping worker slots: %s" % (reason,))
+        self.stop_event.set()
+        self.notify_jobs()
+
+    def sleep(self, val=2.0, diff=0.5):
+        """Random sleep interrupted by the stop"""
+        self.stop_event.wait(max(0.0001, val + random.uniform(0, 2*diff) - diff))
+
+    def wait_for_jobs(self, timeout):
+        """Idle wait of a slot, interrupted by the stop or by the new jobs notification"""
+        with self.jobs_cond:
+            wakeups = self.jobs_wakeups
+            self.idle_slots += 1
+            try:
+                self.jobs_cond.wait_for(lambda: self.stop_event.is_set() or self.jobs_wakeups != wakeups, timeout)
+            finally:
+                self.idle_slots -= 1
+            return self.jobs_wakeups != wakeups and not self.stop_event.is_set()
+
+    def notify_jobs(self):
+        """Wakes up all idle slots"""
+        with self.jobs_cond:
+            self.jobs_wakeups += 1
+            self.jobs_cond.notify_all()
+
+
+class WorkerSlot:
+    """
+    One job execution slot of the worker. Each slot claims, runs, heart-beats and finalizes
+    jobs independently in its own thread, in its own worker experiment directory.
+    """
+    def __init__(self, idx, ctx: WorkerContext):
+        self.idx = idx
+        self.ctx = ctx
+        self.args = ctx.args
+        self.exp_dir = None
+        self.thread = None
+        self.error = None
+        self.is_running = False
+        self.backoff = rtt_utils.Backoff(min_delay=idle_backoff_min, max_delay=idle_backoff_max)
+        self.prefetcher = JobPrefetcher(ctx.pool, ctx.sftp, ctx.args, slot=idx, heartbeat=ctx.heartbeat) \
+            if ctx.args.prefetch else None
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, args=(), name='slot-%02d' % self.idx)
+        self.thread.setDaemon(False)
+        self.thread.start()
+        return self
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def run(self):
+        try:
+            self.work()
+
+        except BaseException as e:
+            self.error = e
+            logger.error("Slot %s terminated with exception: %s" % (self.idx, e), exc_info=e)
+
+        finally:
+            self.is_running = False
+            self.shutdown()
+
+    def shutdown(self):
+        if self.prefetcher:
+            try:
+                with self.ctx.pool.connection() as db:
+                    self.prefetcher.shutdown(db)
+            except Exception as e:
+                logger.error("Exception in prefetcher shutdown: %s" % (e,), exc_info=e)
+        rtt_utils.try_remove_rf(self.exp_dir)
+
+    def work(self):
+        ctx = self.ctx
+        logger.info("Creating worker scratch dir for slot %s under: %s" % (self.idx, ctx.scratch_dir))
+        self.exp_dir = os.path.abspath(create_worker_exp_dir(ctx.worker_base_dir, backend_data, ctx.scratch_dir,
+                                                             slot=self.idx))
+        logger.info("Worker scratch dir: %s" % self.exp_dir)
+
+        while not ctx.is_stopping():
+            if ctx.paused:
+                ctx.sleep(30, 5)
+                continue
+
+            # Job claimed and prepared by the prefetcher while the previous job was running
+            prepared = self.prefetcher.take() if self.prefetcher else None
+            job_info = prepared.job_info if prepared else self.claim()
+            if not job_info:
+                continue
+
+            # Job is heart-beaten from the claim, also during the data download
+            ctx.heartbeat.register(job_info)
+            try:
+                if prepared:
+                    job_info, data_file_path, data_hash_preexec = prepared
+                    logger.info("Using prefetched job, ID: %s, expId: %s" % (job_info.id, job_info.experiment_id))
+
+                else:
+                    logger.info("Job fetched, ID: %s, expId: %s, slot: %s"
+                                % (job_info.id, job_info.experiment_id, self.idx))
+                    with ctx.pool.connection() as db:
+                        expected_hash, data_codec = get_experiment_data_info(db, job_info.experiment_id)
+                    data_file_path, data_hash_preexec = prepare_job_data(job_info, ctx.sftp, self.args, slot=self.idx,
+                                                                         expected_hash=expected_hash, codec=data_codec)
+                    with ctx.pool.connection() as db:
+                        try_register_cached(db, job_info.experiment_id)
+
+                self.execute(job_info, data_file_path, data_hash_preexec)
+                self.backoff.reset()
+
+            except Exception as e:
+                # Failed download or execution must not end the slot, the job is returned to pending
+                logger.error("Job %s failed in slot %s: %s" % (job_info.id, self.idx, e), exc_info=e)
+                self.on_job_failed(job_info)
+
+            finally:
+                ctx.heartbeat.unregister(job_info)
+
+    def on_job_failed(self, job_info):
+        try:
+            with self.ctx.pool.connection() as db:
+                release_job(db, job_info, failed=True)
+        except Exception as e:
+            logger.error("Exception in releasing failed job %s: %s" % (job_info.id, e), exc_info=e)
+
+        delay = self.backoff.next()
+        logger.info("Slot %s waits %.2f s after the failed job" % (self.idx, delay))
+        self.ctx.sleep(delay, 0)
+
+    def claim(self):
+        ctx = self.ctx
+        try:
+            logger.info("Loading jobs to process")
+            with ctx.pool.connection() as db:
+                # Dispatcher holds the request until a job is available
+                wait = 30 if self.args.run_time and self.args.all_time else 0
+                return get_job_info(db, num_workers=ctx.num_workers, wait=wait)  # type: JobInfo
+
+        # If we should spend all allocated time ignore the exit
+        except SystemExit as e:
+            logger.debug("No jobs to process")
+            if self.args.run_time and self.args.all_time:
+                # Waits longer with each empty claim, new jobs notification resets the wait
+                delay = self.backoff.next()
+                logger.debug("Slot %s idle for %.2f s" % (self.idx, delay))
+                if ctx.wait_for_jobs(delay):
+                    logger.info("New jobs notification, slot %s" % self.idx)
+                    self.backoff.reset()
+            else:
+                ctx.stop("No jobs")
+
+        except Exception as e:
+            is_timeout = rtt_utils.is_lock_timeout_exception(e)
+            logger.info("Exception in job fetch: %s (%s), is timeout: %s" % (e, type(e), is_timeout))
+            if not is_timeout:
+                ctx.sleep(25, 3)
+
+    def execute(self, job_info, data_file_path, data_hash_preexec):
+        ctx = self.ctx
+        logger.info("Executing job: job_id {}, experiment_id {}, file {}, hash {}, slot {}"
+                    .format(job_info.id, job_info.experiment_id,
+                            data_file_path, binascii.hexlify(data_hash_preexec), self.idx))
+
+        async_runner = None
+        is_booltest = False
+        time_job_start = time.time()
+        if 'booltest' in job_info.battery.lower():
+            rtt_settings = os.path.join(ctx.worker_base_dir, rtt_constants.Backend.RTT_SETTINGS_JSON)
+            rtt_args = get_booltest_rtt_arguments(job_info, rtt_config=rtt_settings,
+                                                  mysql_host=ctx.mysql_params.host, mysql_port=ctx.mysql_params.port,
+                                                  exp_dir=self.exp_dir, input_data_path=data_file_path)
+            if not rtt_args:
+                rand_sleep()
+                return
+
+            logger.info("CMD: {}".format(rtt_args))
+            async_runner = rtt_worker.get_booltest_rtt_runner(shlex.split(rtt_args),
+                                                              spill_dir=self.exp_dir if output_spill else None)
+            is_booltest = True
+
+        else:
+            rtt_args = get_rtt_arguments(job_info,
+                                         mysql_host=ctx.mysql_params.host,
+                                         mysql_port=ctx.mysql_params.port,
+                                         exp_dir=self.exp_dir,
+                                         input_data_path=data_file_path)
+            logger.info("CMD: {}".format(rtt_args))
+            async_runner = rtt_worker.get_rtt_runner(shlex.split(rtt_args), cwd=os.path.dirname(rtt_binary),
+                                                     spill_dir=self.exp_dir if output_spill else None)
+
+        logger.info("Starting async command")
+        test_failed = False
+        data_stat_preexec = rtt_utils.try_fnc(lambda: os.stat(data_file_path))
+        async_runner.start()
+        logger.info("Async command started")
+        if self.prefetcher and not ctx.is_stopping():
+            self.prefetcher.start(keep=[data_file_path])
+
+        cjob_time_limit = 2.2 * max_sec_per_test if is_booltest else max_sec_per_test
+        while not async_runner.wait(max(1.0, time_job_start + cjob_time_limit - time.time())):
+            logger.error("Current test takes too long, either reconfigure the param or fix the test. Terminating...")
+            test_failed = True
+            async_runner.shutdown()
+
+        logger.info("Async command finished")
+
+        # Cheap metadata check, full re-hash only for a sample of jobs
+        data_stat_postexec = rtt_utils.try_fnc(lambda: os.stat(data_file_path))
+        if not data_stat_preexec or not data_stat_postexec \
+                or data_stat_preexec.st_size != data_stat_postexec.st_size \
+                or data_stat_preexec.st_mtime_ns != data_stat_postexec.st_mtime_ns:
+            logger.error("Data file size or mtime differ!")
+
+        elif verify_hash_rate and random.random() < verify_hash_rate:
+            data_hash_postexec = try_hash_file(data_file_path)
+            logger.info("Data file hash: %s" % binascii.hexlify(data_hash_postexec))
+            if data_hash_preexec != data_hash_postexec:
+                logger.error("Data file hashes differ!")
+
+        if "nist" in job_info.battery and ctx.exp_log_dir and self.args.pack_nist:
+            logger.info("Packing worker dir %s to %s" % (self.exp_dir, ctx.exp_log_dir))
+            pack_log_dir(self.exp_dir, ctx.exp_log_dir, job_info, backend_data)
+
+        with ctx.pool.connection() as db:
+            if async_runner.ret_code != 0 or test_failed:
+                logger.error("RTT return code is not zero: %s (or timed out)" % async_runner.ret_code)
+                db.commit()
+                return
+
+            try_make_finalized(db.cursor(), job_info, db)
+            logger.info("Experiment finalized in the DB")
+            db.commit()
+
+
+def get_num_slots(args):
+    """Number of worker slots: --slots, 0 = number of CPUs, default RTT_PARALLEL env or 1"""
+    if args.slots is not None:
+        return args.slots if args.slots > 0 else (os.cpu_count() or 1)
+    rtt_parallel = rtt_utils.try_fnc(lambda: int(os.getenv('RTT_PARALLEL', None)))
+    return max(1, rtt_parallel or 1)
+
+
 #################
 # MAIN FUNCTION #
 #################
@@ -768,6 +1543,15 @@ def main():
     global sender_email
     global backend_data
     global max_sec_per_test
+    global download_streams
+    global verify_hash_rate
+    global output_spill
+    global idle_backoff_min
+    global idle_backoff_max
+    global jobs_generation_interval
+    global dispatcher_client
+    global cache_registry
+    global data_cache
 
     parser = argparse.ArgumentParser(description='RttWorker')
     parser.add_argument('-i', '--id', dest='id', default=None,
@@ -810,11 +1594,27 @@ def main():
                         help='Enables PBSpro features, such as scratch space usage')
     parser.add_argument('--data-to-scratch', dest='data_to_scratch', action='store_const', const=True, default=False,
                         help='Enables PBSpro features, such as scratch space usage')
+    parser.add_argument('--slots', dest='slots', default=None, type=int,
+                        help='Number of jobs to run in parallel, 0 = number of CPUs, default RTT_PARALLEL env or 1')
+    parser.add_argument('--download-streams', dest='download_streams', default=None, type=int,
+                        help='Number of parallel SFTP streams for data download')
+    parser.add_argument('--verify-hash-rate', dest='verify_hash_rate', default=None, type=float,
+                        help='Fraction of jobs for which the cached data file is fully re-hashed, default 0')
+    parser.add_argument('--output-spill', dest='output_spill', action='store_const', const=True, default=None,
+                        help='Writes full RTT stdout / stderr to gzip files in the worker dir, only tail is kept in memory')
+    parser.add_argument('--dispatcher', dest='dispatcher', default=None,
+                        help='URL of the job dispatcher, jobs are claimed from the DB directly if not set or unavailable')
+    parser.add_argument('--heartbeat-interval', dest='heartbeat_interval', default=None, type=int,
+                        help='Seconds between batched job heartbeats, default 20')
+    parser.add_argument('--prefetch', dest='prefetch', action='store_const', const=True, default=False,
+                        help='Claims and downloads the next job while the current one is running')
     parser.add_argument('--pack-nist', dest='pack_nist', default=0, type=int,
                         help='Pack NIST outputs for later debugging')
     parser.add_argument('config', default=None,
                         help='Config file')
     args = parser.parse_args()
+    args.heartbeat_interval_set = args.heartbeat_interval is not None
+    args.heartbeat_interval = min(MAX_HEARTBEAT_INTERVAL, args.heartbeat_interval or 20)
 
     # Get path to main config from console
     if not args.config:
@@ -822,7 +1622,6 @@ def main():
         sys.exit(1)
 
     # All the new generated files will have permissions rwxrwx---
-    num_workers = 1000
     old_mask = os.umask(0o007)
     main_cfg_file = args.config
     exp_log_dir = None
@@ -857,6 +1656,20 @@ def main():
         backend_data.aux = args.aux if args.aux else main_cfg.get('Backend', 'backend-aux', fallback=None)
         max_sec_per_test = args.job_time if args.job_time else main_cfg.getint('Backend', 'Maximum-seconds-per-test', fallback=3800)
         exp_log_dir = args.log_dir if args.log_dir else main_cfg.get('Backend', 'log-dir', fallback=None)
+        download_streams = args.download_streams if args.download_streams else \
+            main_cfg.getint('Backend', 'download-streams', fallback=1)
+        verify_hash_rate = args.verify_hash_rate if args.verify_hash_rate is not None else \
+            main_cfg.getfloat('Backend', 'verify-hash-rate', fallback=0.0)
+        dispatcher_url = args.dispatcher or main_cfg.get('Backend', 'dispatcher-url', fallback=None)
+        if dispatcher_url:
+            dispatcher_client = DispatcherClient(dispatcher_url,
+                                                 token=main_cfg.get('Backend', 'dispatcher-token', fallback=None))
+        output_spill = args.output_spill if args.output_spill is not None else \
+            main_cfg.getboolean('Backend', 'output-spill', fallback=False)
+        idle_backoff_min = main_cfg.getfloat('Backend', 'idle-backoff-min', fallback=idle_backoff_min)
+        idle_backoff_max = main_cfg.getfloat('Backend', 'idle-backoff-max', fallback=idle_backoff_max)
+        jobs_generation_interval = main_cfg.getfloat('Backend', 'jobs-generation-interval',
+                                                     fallback=jobs_generation_interval)
         if args.id_rand:
             backend_data.id = hashlib.md5(backend_data.name.encode('utf8')).hexdigest()
             logger.info("Generated worker ID: %s" % backend_data.id)
@@ -877,7 +1690,7 @@ def main():
     ##########################
     # Connecting to database #
     ##########################
-    db, mysql_params, mysql_forwarder = None, None, None
+    db, mysql_params, mysql_forwarder, ssh_manager = None, None, None, None
 
     # Retry connector to mysql - for cloud workers
     for conn_retry in range(10):
@@ -885,7 +1698,9 @@ def main():
             logger.info("Connecting to mysql...")
             mysql_params = mysql_load_params(main_cfg, host_override=args.db_host, port_override=args.db_port)
             if args.forwarded_mysql:
-                mysql_forwarder, mysql_params = create_forwarder(main_cfg, mysql_param=mysql_params)
+                ssh_manager = ssh_manager or create_sftp_storage_manager(main_cfg)
+                mysql_forwarder, mysql_params = create_forwarder(main_cfg, mysql_param=mysql_params,
+                                                                 manager=ssh_manager)
                 logger.info("Using forwarded mysql: %s:%s" % (mysql_params.host, mysql_params.port))
 
             db = connect_mysql_db(mysql_params)
@@ -908,21 +1723,14 @@ def main():
     ##########################
     # Connecting to storage  #
     ##########################
-    sftp = None
-    for conn_retry in range(10):
-        try:
-            logger.info("Connecting to SFTP...")
-            sftp = create_sftp_storage_conn(main_cfg)
-            logger.info("SFTP connection created")
-            break
-
-        except Exception as e:
-            sftp = None
-            logger.error("Error in starting sftp connection, iter: %s, err: %s" % (conn_retry, e))
-            time.sleep(2 + conn_retry * 0.2 + random.uniform(0, 2000) / 1000.0)
-
-    if not sftp:
-        raise ValueError("Could not create SFTP connection")
+    # Connection manager reconnects the SFTP session when the storage server restarts
+    try:
+        logger.info("Connecting to SFTP...")
+        ssh_manager = ssh_manager or create_sftp_storage_manager(main_cfg)
+        sftp = ManagedSftp(ssh_manager)
+        logger.info("SFTP connection created")
+    except Exception as e:
+        raise ValueError("Could not create SFTP connection: %s" % (e,))
 
     # Changing working directory so RTT will find files it needs
     # to run
@@ -941,19 +1749,48 @@ def main():
     if not args.cleanup_only:
         ensure_backend_record(db, backend_data)
 
+    # Content-addressed data cache, per-worker statistics are stored in the cache stats dir
+    if main_cfg.getboolean('Local-cache', 'Content-addressed', fallback=True):
+        stats_dir = os.path.join(cache_data_dir, 'stats')
+        rtt_utils.try_fnc(lambda: os.makedirs(stats_dir, 0o2770, True))
+        shared_cache, copy_shared = load_shared_cache(main_cfg)
+        data_cache = DataCache(cache_data_dir, max_size=load_max_size(main_cfg),
+                               stats_file=os.path.join(stats_dir, 'worker-%s.json' % backend_data.id),
+                               shared=shared_cache, copy_shared=copy_shared)
+        if shared_cache:
+            logger.info("Shared cache tier: %s, copy to local: %s" % (shared_cache.data_dir, copy_shared))
+
+    # Registry of cached experiments shared with other workers for the cache-affinity scheduling
+    if not args.cleanup_only and main_cfg.getboolean('Local-cache', 'Registry', fallback=True) \
+            and CacheRegistry.is_available(cursor):
+        db.commit()
+        cache_registry = CacheRegistry(load_cache_id(main_cfg, cache_data_dir), location=backend_data.location,
+                                       worker_id=backend_data.id_key)
+        try_sync_cache_registry(db)
+
     killer = rtt_utils.GracefulKiller()
     time_last_report = time.time() - 10
     time_last_cleanup = time.time() - 30
+    time_last_evict = 0
+    time_last_registry_sync = time.time()
+    time_last_refresh = 0
     cleanup_interval = 5*60
+    refresh_interval = 20  # settings take effect at most this long after the change
+    settings_cache = SettingsCache()
+    heartbeat = HeartbeatService(mysql_params, backend_data, interval=args.heartbeat_interval)
     ############################################################
-    # Execution try block. If error happens during execution   #
-    # database is rollback'd to last commit. Already finished  #
-    # jobs are left intact. Job during which error happened is #
-    # left with status running. This might cause some problems #
-    # in the future (???)                                      #
+    # Execution try block. Worker slots claim and execute jobs #
+    # in their own threads, the main loop supervises them:     #
+    # keep-alive, settings, time limits and job cleanup.       #
+    # If error happens during execution database is rollback'd #
+    # to last commit. Already finished jobs are left intact.   #
+    # Job during which error happened is left with status      #
+    # running, job reset routine returns it to pending later.  #
     ############################################################
     logger.info("Starting job load loop")
-    worker_exp_dir = None
+    pool = MySQLPool(mysql_params)
+    slots = []
+    num_slots = get_num_slots(args)
 
     try:
         rand_sleep()
@@ -962,25 +1799,37 @@ def main():
             raise SystemExit()
 
         scratch_dir = scratch_dir_get(worker_base_dir, args.pbspro)
-        logger.info("Creating worker scratch dir under: %s" % (scratch_dir, ))
-        worker_exp_dir = create_worker_exp_dir(worker_base_dir, backend_data, scratch_dir)
-        worker_exp_dir = os.path.abspath(worker_exp_dir)
-        logger.info("Worker scratch dir: %s" % worker_exp_dir)
-
-        # Do this until get_job_info uses sys.exit(0) =>
-        # => there are no pending jobs
-        # Otherwise loop is without break, so code will always
-        # jump into SystemExit catch
+        ctx = WorkerContext(args, pool, sftp, mysql_params, worker_base_dir, scratch_dir, exp_log_dir)
+        ctx.heartbeat = heartbeat.start()
+        jobs_watcher = JobsWatcher(ctx, interval=jobs_generation_interval)
+
+        logger.info("Starting %s worker slots" % num_slots)
+        slots = [WorkerSlot(idx, ctx) for idx in range(num_slots)]
+
+        # Loop ends when all slots terminate, e.g., there are no pending jobs,
+        # or the worker is stopped, waiting for running jobs to finish.
+        # Then it jumps into SystemExit catch.
         while True:
-            rand_sleep(0.1, 0.05)
+            rand_sleep(0.5, 0.05)
             if killer.is_killed():
-                logger.info("Terminating due to kill")
-                raise SystemExit()
+                ctx.stop("Terminating due to kill")
 
             if time.time() - time_last_report > 600:
-                logger.info("Main loop running")
+                logger.info("Main loop running, active slots: %s" % sum(1 for x in slots if x.is_running))
+                if data_cache:
+                    logger.info("Data cache stats: %s" % data_cache.stats)
+                if mysql_forwarder:
+                    logger.info("MySQL forwarder stats: %s" % mysql_forwarder.stats)
+                logger.info("Job claims: %s" % get_claim_stats())
                 time_last_report = time.time()
 
+            if ctx.is_stopping() or (time_last_refresh and not any(x.is_running for x in slots)):
+                logger.info("Waiting for worker slots to finish")
+                ctx.stop("All slots finished")
+                for slot in slots:
+                    slot.join()
+                raise SystemExit()
+
             # Check if we have enough time to run
             if args.run_time:
                 time_running = time.time() - time_start
@@ -989,45 +1838,54 @@ def main():
                 # Correct job termination only if allocated time is at least 1.5x longest job
                 # otherwise we just stop too early so let them run...
                 if args.run_time > 1.5 * max_sec_per_test and time_left < max_sec_per_test:
-                    logger.info("Time running: %.2f remaining: %.2f, terminating" % (time_running, time_left))
-                    raise SystemExit()
+                    ctx.stop("Time running: %.2f remaining: %.2f, terminating" % (time_running, time_left))
+                    continue
 
                 if time_left < 60*10:
-                    logger.info("Time running: %.2f remaining: %.2f, terminating" % (time_running, time_left))
-                    raise SystemExit()
+                    ctx.stop("Time running: %.2f remaining: %.2f, terminating" % (time_running, time_left))
+                    continue
 
-            # refresh worker keep-alive
-            refresh_backend_record(db, backend_data)
+            # Idle slots are woken up by new pending jobs
+            if time_last_refresh and not ctx.paused:
+                jobs_watcher.check(db)
+
+            if time.time() - time_last_refresh < refresh_interval:
+                continue
+            time_last_refresh = time.time()
 
             # Settings
-            csettings = load_rtt_settings(db)
+            csettings = load_settings(db, settings_cache)
+            ctx.paused = False
             if not backend_data.type_longterm and 'shortterm-disable' in csettings:
                 should_disable = int(csettings['shortterm-disable'])
                 if should_disable and should_disable >= time.time():
                     logger.info("Shorrterm disabled until %s, remaining: %.2f" % (should_disable, should_disable - time.time()))
-                    rand_sleep(30, 5)
-                    continue
+                    ctx.paused = True
 
             if backend_data.type_longterm and 'longterm-disable' in csettings:
                 should_disable = int(csettings['longterm-disable'])
                 if should_disable and should_disable >= time.time():
                     logger.info(
                         "Longterm disabled until %s, remaining: %.2f" % (should_disable, should_disable - time.time()))
-                    rand_sleep(30, 5)
-                    continue
+                    ctx.paused = True
 
             if 'terminate-older' in csettings:
                 terminate_older = int(csettings['terminate-older'])
                 if terminate_older and terminate_older >= time_start:
-                    logger.info(
-                        "Terminating as this job is old %s vs started %s" % (terminate_older, time_start))
-                    raise SystemExit()
+                    ctx.stop("Terminating as this job is old %s vs started %s" % (terminate_older, time_start))
+                    continue
 
             if 'cleanup-interval' in csettings:
                 cleanup_interval = int(csettings['cleanup-interval'])
 
+            if 'heartbeat-interval' in csettings and not args.heartbeat_interval_set:
+                heartbeat.interval = min(MAX_HEARTBEAT_INTERVAL, int(csettings['heartbeat-interval']))
+
             if 'num-workers' in csettings:
-                num_workers = int(csettings['num-workers'])
+                ctx.num_workers = int(csettings['num-workers'])
+                for slot in slots:
+                    if slot.prefetcher:
+                        slot.prefetcher.num_workers = ctx.num_workers
 
             # Cleanup
             # Reset unfinished jobs, only by long-term workers to avoid locking on cleanup actions
@@ -1040,115 +1898,47 @@ def main():
                     logger.error("Job reset exception: %s" % (e,), exc_info=e)
                     rand_sleep()
 
-            # If we should spend all allocated time ignore the exit
-            job_info = None
-            try:
-                logger.info("Loading jobs to process")
-                job_info = get_job_info(db, num_workers=num_workers)  # type: JobInfo
-
-            except SystemExit as e:
-                logger.debug("No jobs to process")
-                if args.run_time and args.all_time:
-                    rand_sleep(40, 5)
-                    continue
-
-                else:
-                    raise
-
-            except Exception as e:
-                is_timeout = rtt_utils.is_lock_timeout_exception(e)
-                logger.info("Exception in job fetch: %s (%s), is timeout: %s" % (e, type(e), is_timeout))
-                if not is_timeout:
-                    rand_sleep(25, 3)
-                continue
-
-            logger.info("Job fetched, ID: %s, expId: %s" % (job_info.id, job_info.experiment_id))
-            fetch_data(job_info.experiment_id, sftp)
-            data_file_path = get_data_path(cache_data_dir, job_info.experiment_id)
-            data_hash_preexec = try_hash_file(data_file_path)
-            data_file_path = scratch_input_file(data_file_path, args, data_hash_preexec)
-
-            logger.info("Executing job: job_id {}, experiment_id {}, file {}, hash {}"
-                        .format(job_info.id, job_info.experiment_id,
-                                data_file_path, binascii.hexlify(data_hash_preexec)))
-
-            async_runner = None
-            is_booltest = False
-            time_job_start = time.time()
-            if 'booltest' in job_info.battery.lower():
-                rtt_settings = os.path.join(worker_base_dir, rtt_constants.Backend.RTT_SETTINGS_JSON)
-                rtt_args = get_booltest_rtt_arguments(job_info, rtt_config=rtt_settings,
-                                                      mysql_host=mysql_params.host, mysql_port=mysql_params.port,
-                                                      exp_dir=worker_exp_dir, input_data_path=data_file_path)
-                if not rtt_args:
-                    rand_sleep()
-                    continue
-
-                logger.info("CMD: {}".format(rtt_args))
-                async_runner = rtt_worker.get_booltest_rtt_runner(shlex.split(rtt_args))
-                is_booltest = True
-
-            else:
-                rtt_args = get_rtt_arguments(job_info,
-                                             mysql_host=mysql_params.host,
-                                             mysql_port=mysql_params.port,
-                                             exp_dir=worker_exp_dir,
-                                             input_data_path=data_file_path)
-                logger.info("CMD: {}".format(rtt_args))
-                async_runner = rtt_worker.get_rtt_runner(shlex.split(rtt_args), cwd=os.path.dirname(rtt_binary))
-
-            logger.info("Starting async command")
-            last_heartbeat = time_job_start - 5
-            test_failed = False
-            async_runner.start()
-            logger.info("Async command started")
-
-            while async_runner.is_running:
-                if time.time() - last_heartbeat > 20:
-                    logger.debug('Heartbeat for job id: %s, running for %.2f s'
-                                 % (job_info.id, time.time() - time_job_start))
-
-                    job_heartbeat(db, job_info)
-                    last_heartbeat = time.time()
-
-                cjob_time_limit = 2.2 * max_sec_per_test if is_booltest else max_sec_per_test
-                if time.time() - time_job_start > cjob_time_limit:
-                    logger.error("Current test takes too long, either reconfigure the param or fix the test. Terminating...")
-                    test_failed = True
-                    async_runner.shutdown()
-
-                time.sleep(1)
-
-            logger.info("Async command finished")
-
-            data_hash_postexec = try_hash_file(data_file_path)
-            logger.info("Data file hash: %s" % binascii.hexlify(data_hash_postexec))
-            if data_hash_preexec != data_hash_postexec:
-                logger.error("Data file hashes differ!")
+            # Size-bounded cache eviction, data of unfinished experiments are kept
+            # Shared tier is evicted by all workers. Blobs are locked only while linked or downloaded,
+            # data in use by running jobs are kept as protected hashes of unfinished experiments
+            # Links to shared blobs evicted by other workers are removed with their markers
+            evict_caches = [x for x in (data_cache, data_cache and data_cache.shared) if x and x.max_size]
+            if data_cache and time.time() - time_last_evict > cleanup_interval:
+                try:
+                    data_cache.remove_dangling()
+                    if evict_caches:
+                        c = db.cursor()
+                        protected = get_protected_hashes(c)
+                        c.close()
+                        db.commit()
+                        for cache in evict_caches:
+                            cache.evict(protected)
+                    time_last_evict = time.time()
 
-            if "nist" in job_info.battery and exp_log_dir and args.pack_nist:
-                logger.info("Packing worker dir %s to %s" % (worker_exp_dir, exp_log_dir))
-                pack_log_dir(worker_exp_dir, exp_log_dir, job_info, backend_data)
+                except Exception as e:
+                    logger.error("Cache eviction exception: %s" % (e,), exc_info=e)
 
-            if async_runner.ret_code != 0 or test_failed:
-                logger.error("RTT return code is not zero: %s (or timed out)" % async_runner.ret_code)
-                db.commit()
-                continue
+            # Evicted and cleaned data removed from the cache registry
+            if cache_registry and time.time() - time_last_registry_sync > cleanup_interval:
+                try_sync_cache_registry(db)
+                time_last_registry_sync = time.time()
 
-            try_make_finalized(cursor, job_info, db)
-            logger.info("Experiment finalized in the DB")
-            db.commit()            
+            # Slots are started after the first settings load
+            for slot in slots:
+                if not slot.thread:
+                    slot.start()
 
     except SystemExit as e:
         logger.error(e)
 
+        heartbeat.shutdown()
         try_finalize_experiments(db)
         if args.deactivate:
             deactivate_worker(db, backend_data)
 
         cursor.close()
         db.close()
-        sftp.close()
+        pool.close()
 
         if args.clean_cache or args.cleanup_only:
             try_clean_cache(main_cfg_file, mysql_params=mysql_params)
@@ -1158,25 +1948,36 @@ def main():
             rtt_utils.try_clean_workers(rtt_work_dir)
         if mysql_forwarder:
             mysql_forwarder.shutdown()
-        rtt_utils.try_remove_rf(worker_exp_dir)
+        sftp.close()  # closes the SSH connection shared with the forwarder
+        for slot in slots:
+            rtt_utils.try_remove_rf(slot.exp_dir)
         clean_scratch()
 
         logger.info("System exit, terminating")
         os.umask(old_mask)
+        if any(x.error for x in slots):
+            sys.exit(1)
 
     except BaseException as e:
         logger.error(e)
         print_error("Job execution: {}".format(e))
         traceback.print_exc()
         db.rollback()
+        if slots:
+            ctx.stop("Main loop exception")
+        for slot in slots:
+            slot.join()
+        heartbeat.shutdown()
         cursor.close()
         db.close()
+        pool.close()
         os.umask(old_mask)
-        rtt_utils.try_remove_rf(worker_exp_dir)
         clean_scratch()
 
         if mysql_forwarder:
             mysql_forwarder.shutdown()
+        if ssh_manager:
+            ssh_manager.close()
 
         sys.exit(1)
 
@@ -1185,4 +1986,3 @@ if __name__ == "__main__":
     print_start("run-jobs")
     main()
     print_end()
-
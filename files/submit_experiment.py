@@ -24,12 +24,19 @@ import MySQLdb
 import os
 import sys
 import argparse
+import collections
+import concurrent.futures
 import hashlib
+import json
 import logging
+import threading
+import tempfile
+import uuid
 import paramiko
 from common.clilogging import *
 from common.rtt_db_conn import *
 from common.rtt_sftp_conn import *
+from common import rtt_utils
 
 
 logger = logging.getLogger(__name__)
@@ -56,31 +63,29 @@ battery_flags = {'nist_sts':             1,
 storage_data_dir = ""
 storage_config_dir = ""
 
+ManifestItem = collections.namedtuple("ManifestItem", "idx name email cfg file batteries")
+UploadedData = collections.namedtuple("UploadedData", "tmp_data_file tmp_config_file data_sha256 codec lock")
+
+# Compression of the data on the storage server, see pick_codec
+COMPRESS_LEVEL = 3
+COMPRESS_SAMPLE_SIZE = 4*1024*1024
+COMPRESS_MAX_RATIO = 0.9
+
 
 ########################
 # Function declaration #
 ########################
-# Calculates SHA256 of given file, returns
-# digest encoded in hex
-def sha256file(fname):
-    sha256_hash = hashlib.sha256()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(chunk)
-    return sha256_hash.hexdigest()
-
-
 # Will parse input arguments from user
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-e", "--email", required=False,
                         help="(optional) notification will be sent to entered address")
-    parser.add_argument("-n", "--name", required=True,
-                        help="name of the experiment")
-    parser.add_argument("-c", "--cfg", required=True,
-                        help="path to config file")
-    parser.add_argument("-f", "--file", required=True,
-                        help="path to data file")
+    parser.add_argument("-n", "--name", required=False,
+                        help="name of the experiment, required without --manifest")
+    parser.add_argument("-c", "--cfg", required=False,
+                        help="path to config file, required without --manifest")
+    parser.add_argument("-f", "--file", required=False,
+                        help="path to data file, required without --manifest")
     parser.add_argument("-a", "--all_batteries", action="store_true",
                         help="include all available batteries (except TestU01 Big Crush!)")
     parser.add_argument("--nist_sts", action="store_true",
@@ -103,6 +108,27 @@ def parse_arguments():
                         help="switch inclusion of BoolTest1 battery")
     parser.add_argument("--booltest-2", dest='booltest2', action="store_true",
                         help="switch inclusion of BoolTest2 battery")
+    parser.add_argument("--streams", dest='streams', default=None, type=int,
+                        help="number of parallel upload streams, default from Storage/Upload-streams or 1")
+    parser.add_argument("--compress", dest='compress', default=None, choices=["none", "zstd", "auto"],
+                        help="compression of the data on the storage server, auto compresses only well "
+                             "compressible data, default from Storage/Compress or none. Requires zstandard package")
+    parser.add_argument("--dedup", dest='dedup', action="store_const", const=True, default=None,
+                        help="link the data already on the storage server instead of the upload, the data file "
+                             "is hashed before the upload. Default from Storage/Dedup or disabled")
+    parser.add_argument("--no-dedup", dest='dedup', action="store_const", const=False, default=None,
+                        help="always upload the data, also when the same data are already on the storage server")
+    parser.add_argument("--manifest", dest='manifest', default=None,
+                        help="bulk mode, file with one JSON object per line with keys name, cfg, file "
+                             "and optional email, batteries (list of battery names or \"all\"). "
+                             "Battery switches apply to items without batteries")
+    parser.add_argument("--manifest-state", dest='manifest_state', default=None,
+                        help="file recording submitted manifest items, default is manifest file + .state. "
+                             "Submitted items are skipped when the manifest is submitted again")
+    parser.add_argument("--parallel", dest='parallel', default=4, type=int,
+                        help="number of files uploaded concurrently in the bulk mode")
+    parser.add_argument("--chunk", dest='chunk', default=50, type=int,
+                        help="number of experiments created in one transaction in the bulk mode")
     return parser.parse_args()
 
 
@@ -134,27 +160,386 @@ def pick_batteries(args):
     return picked_batts
 
 
-# Will transfer data to the storage server
-def upload_data(local_data_file, local_config_file, experiment_id, sftp):
-    storage_data_file = os.path.join(storage_data_dir, "{}.bin".format(experiment_id))
-    storage_config_file = os.path.join(storage_config_dir, "{}.json".format(experiment_id))
+# Name of the partial upload on the storage server. It is the same
+# for the same local file (and tag), so the interrupted upload is
+# resumed by the next submission of the file.
+def upload_tmp_name(local_file, suffix, tag=""):
+    st = os.stat(local_file)
+    key = "%s:%s:%s:%s" % (os.path.abspath(local_file), st.st_size, st.st_mtime_ns, tag)
+    return ".upload-{}{}.part".format(hashlib.sha256(key.encode('utf8')).hexdigest()[:24], suffix)
+
+
+# Data file of the experiment on the storage server, compressed data have the codec suffix
+def storage_data_path(experiment_id, codec=None):
+    return os.path.join(storage_data_dir, "{}.bin{}".format(experiment_id, codec_suffix(codec)))
+
+
+def tmp_data_path(local_data_file, codec=None, tag=""):
+    return os.path.join(storage_data_dir, upload_tmp_name(local_data_file, ".bin" + codec_suffix(codec), tag))
+
+
+# (ID, codec) of existing experiments with the same data, newest first
+def find_same_data(cursor, data_sha256, limit=5):
+    try:
+        cursor.execute("SELECT id, data_file_codec FROM experiments WHERE data_file_sha256=%s "
+                       "ORDER BY id DESC LIMIT %s", (data_sha256, limit))
+    except MySQLdb.OperationalError:
+        # Codec column not migrated yet, all data are uncompressed
+        cursor.execute("SELECT id, NULL FROM experiments WHERE data_file_sha256=%s "
+                       "ORDER BY id DESC LIMIT %s", (data_sha256, limit))
+    return [(x[0], x[1]) for x in cursor.fetchall()]
+
+
+# Hard-links data of an existing experiment to the temporary upload
+# name on the storage server, so the data are not sent again.
+# Returns (experiment ID, codec) of the linked data, None if not linked.
+def link_existing_data(sftp, candidates, local_data_file, tag=""):
+    size = os.path.getsize(local_data_file)
+    for experiment_id, codec in candidates:
+        storage_data_file = storage_data_path(experiment_id, codec)
+        tmp_data_file = tmp_data_path(local_data_file, codec, tag)
+        try:
+            # Size of compressed data is not known, the hash is verified by workers
+            if sftp.stat(storage_data_file).st_size != size and not codec:
+                continue
+            try:
+                sftp.remove(tmp_data_file)  # partial upload
+            except IOError:
+                pass
+            sftp_hardlink(sftp, storage_data_file, tmp_data_file)
+            return experiment_id, codec
+
+        except IOError as e:
+            logger.info("Could not link data of experiment %s: %s" % (experiment_id, e))
+    return None
+
+
+# Codec of the data stored on the storage server, None for uncompressed
+# data. With "auto" only well compressible data are compressed, judged
+# by the compression ratio of the sample from the file start.
+def pick_codec(local_data_file, mode):
+    if not mode or mode == "none":
+        return None
+    if zstandard is None:
+        print_error("Package zstandard is not installed, data will not be compressed.")
+        return None
+    if mode == "auto":
+        with open(local_data_file, "rb") as fh:
+            sample = fh.read(COMPRESS_SAMPLE_SIZE)
+        compressed = zstandard.ZstdCompressor(level=COMPRESS_LEVEL).compress(sample)
+        if not sample or len(compressed) > COMPRESS_MAX_RATIO * len(sample):
+            return None
+    return CODEC_ZSTD
+
+
+# Compresses the data file to the local temporary file, returns its path
+# and SHA256 of the uncompressed data encoded in hex, hashed only if not
+# given. The output is the same for the same file, so the interrupted
+# upload is still resumed.
+def compress_data(local_data_file, tag="", data_sha256=None):
+    hasher = hashlib.sha256() if data_sha256 is None else None
+    compressed_file = os.path.join(tempfile.gettempdir(), upload_tmp_name(local_data_file, ".bin.zst", tag))
+    cobj = zstandard.ZstdCompressor(level=COMPRESS_LEVEL).compressobj(size=os.path.getsize(local_data_file))
+    with open(local_data_file, "rb") as fin, open(compressed_file, "wb") as fout:
+        for chunk in iter(lambda: fin.read(4*1024*1024), b""):
+            if hasher:
+                hasher.update(chunk)
+            fout.write(cobj.compress(chunk))
+        fout.write(cobj.flush())
+    return compressed_file, hasher.hexdigest() if hasher else data_sha256
+
+
+# Locks the temporary upload names of the file on the storage server.
+# The deterministic names are locked by an active submission of the
+# same file, the upload then gets unique names with a random nonce
+# instead of writing into the same partial file.
+# Returns the lock and the tag of the names.
+def lock_upload(sftp, local_data_file, tag=""):
+    lock = RemoteLock(sftp, os.path.join(storage_data_dir, upload_tmp_name(local_data_file, ".lock", tag)))
+    if lock.acquire():
+        return lock, tag
+
+    print_info("The same file is being uploaded by another submission, using unique temporary names")
+    tag = "{}:{}:{}".format(tag, os.getpid(), uuid.uuid4().hex)
+    lock = RemoteLock(sftp, os.path.join(storage_data_dir, upload_tmp_name(local_data_file, ".lock", tag)))
+    if not lock.acquire():
+        raise UploadFailedException("Could not lock upload of {}".format(local_data_file))
+    return lock, tag
+
+
+# Will transfer data to the storage server under temporary names.
+# SHA256 of the data is computed during the upload. With find_fnc
+# (SHA256 hex -> [(experiment ID, codec)]) data already on the storage
+# server are linked, the lookup needs the data hashed before the upload,
+# the hash is then not computed again. With codec data are compressed
+# before the upload. The returned lock of the temporary names is held
+# until the experiment is created, then released by the caller.
+def upload_data(local_data_file, local_config_file, sftp, num_streams=1, tag="", find_fnc=None, codec=None):
+    lock, tag = lock_upload(sftp, local_data_file, tag)
+    try:
+        return upload_locked(local_data_file, local_config_file, sftp, lock, num_streams, tag, find_fnc, codec)
+    except BaseException:
+        lock.release()
+        raise
+
+
+def upload_locked(local_data_file, local_config_file, sftp, lock, num_streams=1, tag="", find_fnc=None, codec=None):
+    tmp_config_file = os.path.join(storage_config_dir, upload_tmp_name(local_config_file, ".json", tag))
+    data_sha256 = None
+    if find_fnc:
+        data_sha256 = rtt_utils.hash_file(local_data_file).hex()
+        linked = link_existing_data(sftp, find_fnc(data_sha256), local_data_file, tag)
+        if linked is not None:
+            print_info("Data are already on the storage server, linked from experiment {}".format(linked[0]))
+            sftp.put(local_config_file, tmp_config_file)
+            return UploadedData(tmp_data_path(local_data_file, linked[1], tag), tmp_config_file, data_sha256,
+                                linked[1], lock)
+
     print_info("Transferring files...")
-    sftp.put(local_data_file, storage_data_file)
-    sftp.put(local_config_file, storage_config_file)
+    tmp_data_file = tmp_data_path(local_data_file, codec, tag)
+    uploader = SftpUploader(sftp, num_streams=num_streams, lock=lock)
+    if codec:
+        compressed_file, data_sha256 = compress_data(local_data_file, tag, data_sha256)
+        try:
+            uploader.put(compressed_file, tmp_data_file)
+            print_info("Data compressed to {:.2f} %".format(
+                100.0 * uploader.file_size / max(1, os.path.getsize(local_data_file))))
+        finally:
+            os.unlink(compressed_file)
+    else:
+        digest = bytes.fromhex(data_sha256) if data_sha256 else None
+        data_sha256 = uploader.put(local_data_file, tmp_data_file, digest=digest).hex()
+
+    sftp.put(local_config_file, tmp_config_file)
     print_info("File transfer complete.")
+    return UploadedData(tmp_data_file, tmp_config_file, data_sha256, codec, lock)
 
 
-def try_execute(fnc, attempts=40, msg=""):
-    for att in range(attempts):
-        try:
-            fnc()
-            return
+def sftp_rename(sftp, src, dst):
+    try:
+        sftp.posix_rename(src, dst)
+    except IOError:
+        # Server without posix-rename extension, rename fails if the target exists
+        sftp.rename(src, dst)
+
 
-        except Exception as e:
-            logger.error("Exception in executing function, %s, att=%s, msg=%s" % (e, att, msg))
-            if att - 1 == attempts:
-                raise
-    raise ValueError("Should not happen, failstop")
+# Moves uploaded files to the names of the experiment
+def publish_data(tmp_data_file, tmp_config_file, experiment_id, sftp, codec=None):
+    storage_data_file = storage_data_path(experiment_id, codec)
+    storage_config_file = os.path.join(storage_config_dir, "{}.json".format(experiment_id))
+    sftp_rename(sftp, tmp_data_file, storage_data_file)
+    sftp_rename(sftp, tmp_config_file, storage_config_file)
+    return storage_data_file, storage_config_file
+
+
+# Battery names of the manifest item to the battery flags
+def batteries_to_flags(batteries, default_batts):
+    if batteries is None:
+        return default_batts
+    if batteries == "all":
+        return sum(battery_flags.values()) - battery_flags['tu01_bigcrush']
+    if isinstance(batteries, str):
+        batteries = [batteries]
+    picked_batts = 0
+    for name in batteries:
+        if name not in battery_flags:
+            raise ValueError("Unknown battery: {}".format(name))
+        picked_batts |= battery_flags[name]
+    return picked_batts
+
+
+# Reads the bulk submission manifest, one JSON object per line
+def load_manifest(path, default_batts):
+    items = []
+    with open(path) as fh:
+        for idx, line in enumerate(fh):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                rec = json.loads(line)
+                items.append(ManifestItem(idx, rec['name'], rec.get('email'), rec['cfg'], rec['file'],
+                                          batteries_to_flags(rec.get('batteries'), default_batts)))
+            except Exception as e:
+                raise ValueError("Invalid manifest line {}: {}".format(idx + 1, e))
+    return items
+
+
+def item_key(item):
+    return "{}:{}".format(item.idx, os.path.abspath(item.file))
+
+
+# Keys of the manifest items already submitted
+def load_manifest_state(path):
+    if not os.path.exists(path):
+        return {}
+    res = {}
+    with open(path) as fh:
+        for line in fh:
+            if line.strip():
+                rec = json.loads(line)
+                res[rec['key']] = rec['experiment_id']
+    return res
+
+
+def save_manifest_state(path, items):
+    with open(path, 'a') as fh:
+        for item, experiment_id in items:
+            fh.write(json.dumps({'key': item_key(item), 'name': item.name, 'experiment_id': experiment_id}) + "\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+# Inserts the experiment and its jobs, one multi-row insert for all jobs.
+# Returns experiment ID and number of jobs. Statements run once, a failure
+# rolls back the whole transaction, the caller handles it.
+def insert_experiment(cursor, name, email, cfg, data_file, data_sha256, picked_batts, codec=None):
+    if codec:
+        sql_ins_experiment = "INSERT INTO experiments " \
+                             "(name, author_email, config_file, data_file, data_file_sha256, data_file_codec) " \
+                             "VALUES(%s,%s,%s,%s,%s,%s)"
+        params = (name, email, cfg, data_file, data_sha256, codec)
+    else:
+        sql_ins_experiment = "INSERT INTO experiments " \
+                             "(name, author_email, config_file, data_file, data_file_sha256) " \
+                             "VALUES(%s,%s,%s,%s,%s)"
+        params = (name, email, cfg, data_file, data_sha256)
+    cursor.execute(sql_ins_experiment, params)
+    experiment_id = cursor.lastrowid
+
+    sql_ins_job = "INSERT INTO jobs " \
+                  "(battery, experiment_id) " \
+                  "VALUES(%s,%s)"
+    jobs = [(key, experiment_id) for key in battery_flags if picked_batts & battery_flags[key]]
+    cursor.executemany(sql_ins_job, jobs)
+    return experiment_id, len(jobs)
+
+
+# Creates experiments of uploaded manifest items in one transaction.
+# Returns list of (item, experiment_id), empty on failure
+def create_experiments_chunk(db, cursor, sftp, uploaded):
+    created, published = [], []
+    try:
+        for item, data in uploaded:
+            experiment_id, num_jobs = insert_experiment(cursor, item.name, item.email, item.cfg, item.file,
+                                                        data.data_sha256, item.batteries, codec=data.codec)
+            published.append((publish_data(data.tmp_data_file, data.tmp_config_file, experiment_id, sftp, data.codec),
+                              (data.tmp_data_file, data.tmp_config_file)))
+            created.append((item, experiment_id))
+            print_info("Created experiment {} with {} jobs: {}".format(experiment_id, num_jobs, item.name))
+
+        bump_jobs_generation(cursor)
+        db.commit()
+        return created
+
+    except Exception as e:
+        print_error("Experiments creation: {}".format(e))
+        db.rollback()
+        # Files are moved back, the next submission resumes them
+        for files, tmp_files in published:
+            try:
+                sftp_rename(sftp, files[0], tmp_files[0])
+                sftp_rename(sftp, files[1], tmp_files[1])
+            except Exception as ex:
+                logger.error("Could not move back uploaded files: %s" % (ex,))
+        return []
+
+
+# Data lookup for the deduplicated upload, None if disabled
+def get_find_fnc(args, main_cfg, db, cursor, db_lock):
+    dedup = args.dedup if args.dedup is not None else main_cfg.getboolean('Storage', 'Dedup', fallback=False)
+    if not dedup:
+        return None
+
+    def find(data_sha256):
+        with db_lock:
+            try:
+                return find_same_data(cursor, data_sha256)
+            finally:
+                db.commit()  # no read snapshot is kept open during the upload
+    return find
+
+
+# Bulk mode. Files are uploaded concurrently, each upload thread has its own
+# SFTP session on the shared SSH connection. Uploaded items are created
+# in the DB in chunks, each chunk in one transaction. Created items are
+# recorded in the state file so a failed submission is simply repeated.
+def submit_manifest(args, main_cfg, db, cursor, sftp, default_batts):
+    db_lock = threading.Lock()  # DB lookups of upload threads
+    items = load_manifest(args.manifest, default_batts)
+    state_file = args.manifest_state or args.manifest + ".state"
+    done = load_manifest_state(state_file)
+    pending = [x for x in items if item_key(x) not in done]
+    print_info("Manifest items: {}, already submitted: {}, to submit: {}"
+               .format(len(items), len(items) - len(pending), len(pending)))
+
+    num_failed = 0
+    for item in list(pending):
+        if item.batteries == 0 or not os.path.exists(item.file) or not os.path.exists(item.cfg):
+            print_error("Invalid item {} (missing files or no batteries)".format(item.name))
+            pending.remove(item)
+            num_failed += 1
+
+    num_streams = args.streams or main_cfg.getint('Storage', 'Upload-streams', fallback=1)
+    find_fnc = get_find_fnc(args, main_cfg, db, cursor, db_lock)
+    compress = args.compress or main_cfg.get('Storage', 'Compress', fallback='none')
+    sessions = threading.local()
+    clients = []  # SFTP sessions of the upload threads, closed at the end
+
+    def upload(item):
+        if not hasattr(sessions, 'sftp'):
+            sessions.sftp = paramiko.SFTPClient.from_transport(sftp.get_channel().get_transport())
+            clients.append(sessions.sftp)
+        return item, upload_data(item.file, item.cfg, sessions.sftp, num_streams=num_streams, tag=item_key(item),
+                                 find_fnc=find_fnc, codec=pick_codec(item.file, compress))
+
+    num_created = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.parallel)) as executor:
+            futures = [executor.submit(upload, x) for x in pending]
+            uploaded = []
+            for idx, future in enumerate(concurrent.futures.as_completed(futures)):
+                try:
+                    uploaded.append(future.result())
+                except Exception as e:
+                    print_error("Upload failed: {}".format(e))
+                    num_failed += 1
+
+                if uploaded and (len(uploaded) >= args.chunk or idx + 1 == len(futures)):
+                    with db_lock:
+                        created = create_experiments_chunk(db, cursor, sftp, uploaded)
+                    save_manifest_state(state_file, created)
+                    for _, data in uploaded:
+                        data.lock.release(sftp)
+                    num_created += len(created)
+                    num_failed += len(uploaded) - len(created)
+                    uploaded = []
+    finally:
+        for client in clients:
+            rtt_utils.try_fnc(client.close)
+
+    print_info("Submitted {} experiments, failed: {}".format(num_created, num_failed))
+    return num_failed
+
+
+def submit_bulk(args, main_cfg, picked_batts):
+    db = create_mysql_db_conn(main_cfg)
+    cursor = db.cursor()
+    sftp = create_sftp_storage_conn(main_cfg)
+    try:
+        num_failed = submit_manifest(args, main_cfg, db, cursor, sftp, picked_batts)
+    except BaseException as e:
+        print_error("Bulk submission: {}".format(e))
+        num_failed = 1
+    finally:
+        cursor.close()
+        db.close()
+        sftp.close()
+
+    if num_failed:
+        print_error("Some experiments were not submitted, submit the manifest again to retry them.")
+        sys.exit(1)
+    print_info("All jobs successfully created.")
 
 
 #################
@@ -191,6 +576,16 @@ def main():
     #################
     # Sanity checks #
     #################
+    if args.manifest:
+        if not os.path.exists(args.manifest):
+            print_error("Manifest does not exist: {}".format(args.manifest))
+            sys.exit(1)
+        submit_bulk(args, main_cfg, picked_batts)
+        return
+
+    if not args.name or not args.cfg or not args.file:
+        print_error("Arguments --name, --cfg and --file are required without --manifest")
+        sys.exit(1)
     if not os.path.exists(args.file):
         print_error("Data file does not exist: {}".format(args.file))
         sys.exit(1)
@@ -213,44 +608,50 @@ def main():
     sftp = create_sftp_storage_conn(main_cfg)
 
     #####################################################
-    # Data are first transferred to the storage server. #
-    # After successful upload, jobs for requested       #
-    # batteries will be inserted into db. If anything   #
-    # happens, jobs will not be created. Data can still #
-    # remain on the storage server.                     #
+    # Data are first transferred to the storage server  #
+    # under temporary names and hashed on the fly.      #
+    # Interrupted upload is resumed by the next run.    #
+    # After successful upload the experiment and jobs   #
+    # for requested batteries are inserted into db and  #
+    # files renamed to the experiment ID in one short   #
+    # transaction. If anything happens, jobs will not   #
+    # be created. Data can still remain on the storage  #
+    # server under the temporary names.                 #
     #####################################################
+    published, uploaded = None, None
     try:
-        # Creating experiment
-        sql_ins_experiment = "INSERT INTO experiments " \
-                             "(name, author_email, config_file, data_file, data_file_sha256) " \
-                             "VALUES(%s,%s,%s,%s,%s)"
-
-        try_execute(lambda: cursor.execute(sql_ins_experiment, (args.name, args.email, args.cfg, args.file, sha256file(args.file))),
-                    msg="Experiment insert %s" % args.file)
-
-        experiment_id = cursor.lastrowid
-        print_info("Created new experiment with id {}".format(experiment_id))
-        # Uploading data to storage server
-        upload_data(args.file, args.cfg, experiment_id, sftp)
-        # Creating jobs
-        sql_ins_job = "INSERT INTO jobs " \
-                      "(battery, experiment_id) " \
-                      "VALUES(%s,%s)"
-        for key in battery_flags:
-            if picked_batts & battery_flags[key]:
-                try_execute(lambda: cursor.execute(sql_ins_job, (key, experiment_id)),
-                            msg="Job insert, %s, %s" % (args.file, key))
-
-                print_info("Created job with id {}.".format(cursor.lastrowid))
-        
-        # Final commit - the jobs and experiment will be now visible
+        num_streams = args.streams or main_cfg.getint('Storage', 'Upload-streams', fallback=1)
+        find_fnc = get_find_fnc(args, main_cfg, db, cursor, threading.Lock())
+        codec = pick_codec(args.file, args.compress or main_cfg.get('Storage', 'Compress', fallback='none'))
+        uploaded = upload_data(args.file, args.cfg, sftp, num_streams=num_streams, find_fnc=find_fnc, codec=codec)
+        tmp_data_file, tmp_config_file, data_sha256, codec = uploaded[:4]
+
+        # Creating experiment and jobs
+        experiment_id, num_jobs = insert_experiment(cursor, args.name, args.email, args.cfg, args.file,
+                                                    data_sha256, picked_batts, codec=codec)
+        print_info("Created new experiment with id {} and {} jobs".format(experiment_id, num_jobs))
+        # Uploaded data get the experiment name
+        published = publish_data(tmp_data_file, tmp_config_file, experiment_id, sftp, codec)
+
+        # Wakes up idle workers, then final commit - the jobs and experiment will be now visible
+        bump_jobs_generation(cursor)
         db.commit()
+        uploaded.lock.release()
         cursor.close()
         db.close()
         sftp.close()
     except BaseException as e:
         print_error("Job creation: {}".format(e))
         db.rollback()
+        if published:
+            # Files are moved back, the next submission resumes them
+            try:
+                sftp_rename(sftp, published[0], tmp_data_file)
+                sftp_rename(sftp, published[1], tmp_config_file)
+            except Exception as ex:
+                logger.error("Could not move back uploaded files: %s" % (ex,))
+        if uploaded:
+            uploaded.lock.release()
         cursor.close()
         db.close()
         sftp.close()
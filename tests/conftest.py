@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the repository packages (common, files) without installation
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def sshd(tmp_path_factory):
+    paramiko = pytest.importorskip('paramiko')
+    from benchmarks.bench_sftp import StubSshd
+    root = tmp_path_factory.mktemp('sftp-root')
+    key_file = str(tmp_path_factory.mktemp('keys') / 'id_rsa')
+    paramiko.RSAKey.generate(2048).write_private_key_file(key_file, password='x')
+    server = StubSshd(str(root)).start()
+    server.root, server.key_file = str(root), key_file
+    server.connect = lambda: connect(server)
+    yield server
+    server.close()
+
+
+def connect(sshd):
+    from common import rtt_sftp_conn
+    return rtt_sftp_conn.create_sftp_storage_conn_params(
+        rtt_sftp_conn.SSHParams(host='127.0.0.1', port=sshd.port, pkey_file=sshd.key_file, pkey_pass='x'))
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from common import rtt_utils
+from common.rtt_cache import DataCache, CacheStats
+from common.rtt_sftp_conn import DownloadFailedException, write_download_marker
+
+
+def add_blob(cache, data, last_use=None):
+    """Stores data to the cache blob store as a completely downloaded blob, returns its digest"""
+    digest = hashlib.sha256(data).digest()
+    os.makedirs(cache.blob_dir, exist_ok=True)
+    blob = cache.blob_path(digest)
+    with open(blob, 'wb') as fh:
+        fh.write(data)
+    write_download_marker(blob, digest)
+    if last_use is not None:
+        os.utime(blob + '.downloaded', (last_use, last_use))
+    return digest
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DataCache(str(tmp_path / 'cache'))
+
+
+def test_link_points_to_blob(cache):
+    digest = add_blob(cache, b'data' * 100)
+    path = os.path.join(cache.data_dir, '1.bin')
+    cache.link(cache.blob_path(digest), path, digest)
+    assert os.path.samefile(path, cache.blob_path(digest))
+    assert os.path.exists(path + '.downloaded')
+    assert [x for x in os.listdir(cache.data_dir) if x.endswith('.tmp')] == []
+
+
+def test_link_concurrent(cache):
+    digest = add_blob(cache, b'data' * 100)
+    path = os.path.join(cache.data_dir, '1.bin')
+    errors = []
+
+    def run():
+        try:
+            for _ in range(100):
+                cache.link(cache.blob_path(digest), path, digest)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert os.path.samefile(path, cache.blob_path(digest))
+
+
+def test_fetch_hit_without_download(cache):
+    data = b'x' * 1000
+    digest = add_blob(cache, data)
+    path = os.path.join(cache.data_dir, '5.bin')
+    assert cache.fetch(None, '/data/5.bin', path, digest) == digest
+    assert cache.stats.hits == 1 and cache.stats.misses == 0
+    assert cache.stats.bytes_saved == len(data)
+    with open(path, 'rb') as fh:
+        assert fh.read() == data
+
+
+def test_evict_lru_keeps_protected(cache):
+    now = time.time()
+    old = add_blob(cache, b'a' * 1000, now - 300)
+    mid = add_blob(cache, b'b' * 1000, now - 200)
+    new = add_blob(cache, b'c' * 1000, now - 100)
+    cache.link(cache.blob_path(old), os.path.join(cache.data_dir, '1.bin'), old)
+
+    freed = cache.evict(protected=[old.hex()], max_size=2000)
+    assert freed == 1000
+    assert os.path.exists(cache.blob_path(old))
+    assert not os.path.exists(cache.blob_path(mid))
+    assert os.path.exists(cache.blob_path(new))
+    assert cache.stats.evictions == 1
+
+
+def test_evict_removes_links(cache):
+    digest = add_blob(cache, b'a' * 1000)
+    path = os.path.join(cache.data_dir, '1.bin')
+    cache.link(cache.blob_path(digest), path, digest)
+
+    assert cache.evict(max_size=0) == 1000
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.downloaded')
+    assert cache.list_blobs() == []
+
+
+def test_evict_unused_and_dry_run(cache):
+    used = add_blob(cache, b'a' * 10)
+    unused = add_blob(cache, b'b' * 20)
+    cache.link(cache.blob_path(used), os.path.join(cache.data_dir, '1.bin'), used)
+
+    assert cache.evict(unused=True, dry_run=True) == 20
+    assert os.path.exists(cache.blob_path(unused))
+    assert cache.evict(unused=True) == 20
+    assert not os.path.exists(cache.blob_path(unused))
+    assert os.path.exists(cache.blob_path(used))
+
+
+def test_remove_blob_locked(cache):
+    digest = add_blob(cache, b'a' * 10)
+    blob = cache.blob_path(digest)
+    locker = rtt_utils.FileLocker(blob + '.lock')
+    assert locker.acquire_try_once()
+    try:
+        assert not cache.remove_blob(blob)
+        assert os.path.exists(blob)
+    finally:
+        locker.release()
+
+    assert cache.remove_blob(blob)
+    assert not os.path.exists(blob)
+
+
+def test_shared_tier_copy(tmp_path):
+    shared = DataCache(str(tmp_path / 'shared'))
+    cache = DataCache(str(tmp_path / 'local'), shared=shared)
+    os.makedirs(cache.data_dir)
+    data = b'shared' * 1000
+    digest = add_blob(shared, data)
+    path = os.path.join(cache.data_dir, '1.bin')
+
+    assert cache.fetch(None, '/data/1.bin', path, digest) == digest
+    assert cache.stats.shared_hits == 1 and cache.stats.bytes_shared == len(data)
+    assert not os.path.samefile(cache.blob_path(digest), shared.blob_path(digest))
+    assert os.path.samefile(path, cache.blob_path(digest))
+
+    assert cache.fetch(None, '/data/1.bin', path, digest) == digest
+    assert cache.stats.hits == 1
+
+
+def test_shared_tier_in_place(tmp_path):
+    shared = DataCache(str(tmp_path / 'shared'))
+    cache = DataCache(str(tmp_path / 'local'), shared=shared, copy_shared=False)
+    os.makedirs(cache.data_dir)
+    digest = add_blob(shared, b'shared' * 1000)
+    path = os.path.join(cache.data_dir, '1.bin')
+
+    assert cache.fetch(None, '/data/1.bin', path, digest) == digest
+    assert os.path.samefile(path, shared.blob_path(digest))
+    assert not os.path.exists(cache.blob_dir)
+
+
+def test_remove_dangling_links(tmp_path):
+    shared = DataCache(str(tmp_path / 'shared'))
+    cache = DataCache(str(tmp_path / 'local'), shared=shared, copy_shared=False)
+    os.makedirs(cache.data_dir)
+    kept, evicted = add_blob(shared, b'kept' * 100), add_blob(shared, b'evicted' * 100)
+    for eid, digest in ((1, kept), (2, evicted)):
+        path = os.path.join(cache.data_dir, '%s.bin' % eid)
+        os.symlink(shared.blob_path(digest), path)  # shared cache on another file system
+        write_download_marker(path, digest)
+
+    assert shared.remove_blob(shared.blob_path(evicted))
+    assert cache.remove_dangling(dry_run=True) == [os.path.join(cache.data_dir, '2.bin')]
+    assert os.path.lexists(os.path.join(cache.data_dir, '2.bin'))
+    assert cache.remove_dangling() == [os.path.join(cache.data_dir, '2.bin')]
+    assert sorted(os.listdir(cache.data_dir)) == ['1.bin', '1.bin.downloaded']
+
+
+def test_copy_blob_hash_mismatch(tmp_path):
+    shared = DataCache(str(tmp_path / 'shared'))
+    cache = DataCache(str(tmp_path / 'local'), shared=shared)
+    digest = add_blob(shared, b'shared' * 1000)
+    os.makedirs(cache.blob_dir)
+    with pytest.raises(DownloadFailedException):
+        cache.copy_blob(shared.blob_path(digest), cache.blob_path(digest), b'\x00' * 32)
+    assert os.listdir(cache.blob_dir) == []
+
+
+def test_save_stats_concurrent(tmp_path):
+    cache = DataCache(str(tmp_path / 'cache'), stats_file=str(tmp_path / 'stats.json'))
+    cache.stats.hits = 3
+    threads = [threading.Thread(target=lambda: [cache.save_stats() for _ in range(20)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(str(tmp_path / 'stats.json')) as fh:
+        assert json.load(fh)['hits'] == 3
+    assert os.listdir(str(tmp_path)) == ['stats.json']
+
+
+def test_stats_repr():
+    stats = CacheStats()
+    stats.hits, stats.shared_hits, stats.misses = 1, 1, 2
+    assert '50.00 % hit rate' in repr(stats)
@@ -0,0 +1,51 @@
+import pytest
+
+MySQLdb = pytest.importorskip('MySQLdb')
+from common import rtt_db_conn  # noqa: E402
+
+
+class FakeCursor(object):
+    def __init__(self, error=None, rows=None):
+        self.error = error
+        self.rows = rows or []
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+        if self.error:
+            raise self.error
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+def test_bump_jobs_generation():
+    cursor = FakeCursor()
+    assert rtt_db_conn.bump_jobs_generation(cursor)
+    sql, params = cursor.executed[0]
+    assert 'ON DUPLICATE KEY UPDATE value=value+1' in sql and params == (rtt_db_conn.JOBS_GENERATION,)
+
+
+def test_bump_jobs_generation_reset():
+    cursor = FakeCursor()
+    assert rtt_db_conn.bump_jobs_generation(cursor, reset=True)
+    sql, params = cursor.executed[0]
+    assert 'VALUES (%s, 1),(%s, 1) ON' in sql
+    assert params == (rtt_db_conn.JOBS_GENERATION, rtt_db_conn.JOBS_RESETS)
+
+
+def test_bump_jobs_generation_missing_table():
+    cursor = FakeCursor(MySQLdb.ProgrammingError(1146, "Table 'rtt.rtt_counters' doesn't exist"))
+    assert rtt_db_conn.bump_jobs_generation(cursor) is False
+
+
+def test_bump_jobs_generation_deadlock_propagates():
+    cursor = FakeCursor(MySQLdb.OperationalError(1213, 'Deadlock found when trying to get lock'))
+    with pytest.raises(MySQLdb.OperationalError):
+        rtt_db_conn.bump_jobs_generation(cursor)
+
+
+def test_get_jobs_generation():
+    assert rtt_db_conn.get_jobs_generation(FakeCursor(rows=[(7,)])) == 7
+    assert rtt_db_conn.get_jobs_generation(FakeCursor()) == 0
+    assert rtt_db_conn.get_jobs_generation(FakeCursor(MySQLdb.ProgrammingError(1146, 'missing'))) is None
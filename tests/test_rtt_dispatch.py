@@ -0,0 +1,210 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from common import rtt_dispatch
+from common.rtt_dispatch import DispatchedJob, JobIndex
+
+
+def make_jobs(spec):
+    """Jobs from [(job_id, experiment_id)]"""
+    return [DispatchedJob(jid, eid, 'battery') for jid, eid in spec]
+
+
+def test_index_any_job_in_id_order():
+    index = JobIndex()
+    index.rebuild(make_jobs([(5, 2), (1, 1), (3, 2), (2, 1), (4, 3)]), [])
+    assert [index.take().id for _ in range(5)] == [1, 2, 3, 4, 5]
+    assert index.take() is None and index.size == 0
+
+
+def test_index_preference_tiers():
+    index = JobIndex()
+    index.rebuild(make_jobs([(1, 1), (2, 2), (3, 3), (4, 4), (5, 4)]), pending_exps=[3])
+    assert index.take(cached=[4], nearby=[2]).id == 4
+    assert index.take(cached=[9], nearby=[2]).id == 2
+    assert index.take().id == 3  # experiment nobody started yet
+    assert index.take().id == 1
+    assert index.take(cached=[4]).id == 5
+    assert index.take() is None
+
+
+def test_index_started_experiment_not_pending():
+    index = JobIndex()
+    index.rebuild(make_jobs([(1, 1), (2, 2), (3, 2)]), pending_exps=[2])
+    assert index.take().id == 2
+    assert index.take().id == 1  # experiment 2 is running now, lower job ID goes first
+    assert index.take().id == 3
+
+
+def test_index_rebuild_drops_state():
+    index = JobIndex()
+    index.rebuild(make_jobs([(1, 1), (2, 1)]), [1])
+    index.take()
+    index.rebuild(make_jobs([(7, 3)]), [])
+    assert index.size == 1
+    assert index.take().id == 7 and index.take() is None
+
+
+def test_index_add_incremental():
+    index = JobIndex()
+    index.rebuild(make_jobs([(1, 1), (3, 1)]), [1])
+    index.add(make_jobs([(3, 1), (5, 2), (2, 1)]), [2])  # 3 already indexed, 2 committed late
+    assert index.size == 4
+    assert index.take().id == 1
+    assert index.take().id == 5  # experiment 2 not started yet
+    assert [index.take().id for _ in range(2)] == [2, 3]
+    assert index.take() is None and not index.ids
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'rtt.sqlite')
+    db = sqlite3.connect(path)
+    db.executescript(rtt_dispatch.SQLITE_SCHEMA)
+    db.executemany("INSERT INTO experiments(id, status) VALUES (?, 'pending')", [(1,), (2,)])
+    db.executemany("INSERT INTO jobs(id, battery, experiment_id) VALUES (?, 'b', ?)", [(1, 1), (2, 1), (3, 2)])
+    db.execute("INSERT INTO cache_registry(cache_id, experiment_id, location) VALUES ('node', 2, 'loc')")
+    db.execute("INSERT INTO rtt_settings(name, value) VALUES ('max-jobs', '4')")
+    db.commit()
+    db.close()
+    return path
+
+
+@pytest.fixture
+def store(db_path):
+    store = rtt_dispatch.DispatchStore(lambda: sqlite3.connect(db_path, check_same_thread=False),
+                                       paramstyle='qmark')
+    yield store
+    store.close()
+
+
+def test_store_load_and_claim(store, db_path):
+    jobs, pending_exps = store.load_pending()
+    assert [x.id for x in jobs] == [1, 2, 3] and pending_exps == {1, 2}
+    assert store.load_location_cache() == {'loc': {2}}
+    assert store.load_settings() == {'max-jobs': '4'}
+
+    assert store.claim(jobs[0], 7, 100)
+    assert not store.claim(jobs[0], 8, 101)
+
+    db = sqlite3.connect(db_path)
+    assert db.execute("SELECT status, worker_id, worker_pid FROM jobs WHERE id=1").fetchone() == ('running', 7, 100)
+    assert db.execute("SELECT status FROM experiments WHERE id=1").fetchone() == ('running',)
+    db.close()
+
+
+def test_dispatcher_claims(store):
+    dispatcher = rtt_dispatch.Dispatcher(store)
+    dispatcher.refresh()
+    try:
+        assert dispatcher.claim(1, 100, location='loc').id == 3  # cached nearby
+        assert dispatcher.claim(1, 100, cached=[1]).id == 1
+        assert dispatcher.claim(2, 101).id == 2
+        assert dispatcher.claim(2, 101) is None
+        stats = dispatcher.get_stats()
+        assert stats['claims'] == 3 and stats['nearby_claims'] == 1 and stats['cached_claims'] == 1
+    finally:
+        dispatcher.shutdown()
+
+
+def test_dispatcher_skips_conflicting_claim(store, db_path):
+    dispatcher = rtt_dispatch.Dispatcher(store)
+    dispatcher.refresh()
+    try:
+        db = sqlite3.connect(db_path)
+        db.execute("UPDATE jobs SET status='running' WHERE id=1")  # claimed directly in the DB
+        db.commit()
+        db.close()
+        assert dispatcher.claim(1, 100).id == 3  # experiment 1 counts as started after the conflict
+        assert dispatcher.stats.conflicts == 1
+        dispatcher.refresh()
+        assert dispatcher.claim(1, 100).id == 2
+    finally:
+        dispatcher.shutdown()
+
+
+def execute(db_path, *statements):
+    db = sqlite3.connect(db_path)
+    for sql in statements:
+        db.execute(sql)
+    db.commit()
+    db.close()
+
+
+def test_dispatcher_incremental_refresh(store, db_path):
+    dispatcher = rtt_dispatch.Dispatcher(store, id_lookback=0)
+    dispatcher.refresh()
+    try:
+        assert dispatcher.stats.full_refreshes == 1 and dispatcher.max_job_id == 3
+        execute(db_path, "INSERT INTO jobs(id, battery, experiment_id) VALUES (4, 'b', 2)")
+        dispatcher.refresh()
+        assert dispatcher.stats.full_refreshes == 1 and dispatcher.index.size == 4
+        assert dispatcher.store.load_pending(3)[0] == [DispatchedJob(4, 2, 'b')]
+
+        # Running job moved back to pending is found by the full reload after the resets counter changed
+        assert dispatcher.claim(1, 100, cached=[2]).id == 3
+        execute(db_path, "UPDATE jobs SET status='pending' WHERE id=3")
+        dispatcher.refresh()
+        assert 3 not in dispatcher.index.ids and dispatcher.stats.full_refreshes == 1
+        execute(db_path, "INSERT INTO rtt_counters(name, value) VALUES ('%s', 1)" % rtt_dispatch.JOBS_RESETS)
+        dispatcher.refresh()
+        assert 3 in dispatcher.index.ids and dispatcher.stats.full_refreshes == 2
+    finally:
+        dispatcher.shutdown()
+
+
+def test_dispatcher_without_counters_reloads_all(store, db_path):
+    execute(db_path, "DROP TABLE rtt_counters")
+    dispatcher = rtt_dispatch.Dispatcher(store)
+    try:
+        dispatcher.refresh()
+        dispatcher.refresh()
+        assert not dispatcher.counters_available and dispatcher.stats.full_refreshes == 2
+    finally:
+        dispatcher.shutdown()
+
+
+def test_long_poll_over_http(store, db_path):
+    dispatcher = rtt_dispatch.Dispatcher(store, refresh_interval=0.2).start()
+    server = rtt_dispatch.create_server(dispatcher, host='127.0.0.1', port=0, token='secret')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s' % server.server_address[1]
+    try:
+        client = rtt_dispatch.DispatcherClient(url, token='secret')
+        assert [client.claim(1, 100).id for _ in range(3)] == [1, 3, 2]  # experiment 2 not started first
+        assert client.settings() == {'max-jobs': '4'}
+
+        def add_job():
+            db = sqlite3.connect(db_path)
+            db.execute("INSERT INTO jobs(id, battery, experiment_id) VALUES (4, 'late', 2)")
+            db.commit()
+            db.close()
+
+        threading.Timer(0.3, add_job).start()
+        tstart = time.time()
+        job = client.claim(1, 100, wait=10)
+        assert job is not None and job.id == 4 and job.battery == 'late'
+        assert time.time() - tstart < 5
+
+        with pytest.raises(Exception):
+            rtt_dispatch.DispatcherClient(url, token='wrong').stats()
+    finally:
+        server.shutdown()
+        server.server_close()
+        dispatcher.shutdown()
+
+
+def test_client_session_per_thread():
+    client = rtt_dispatch.DispatcherClient('http://127.0.0.1:1', token='secret')
+    sessions = []
+    threads = [threading.Thread(target=lambda: sessions.append(client.session)) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(id(x) for x in sessions)) == 3
+    assert client.session is client.session
+    assert all(x.headers['X-RTT-Token'] == 'secret' for x in sessions)
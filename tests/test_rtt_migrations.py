@@ -0,0 +1,46 @@
+import re
+
+import pytest
+
+from common import rtt_migrations
+
+
+def test_parse_sql_statements():
+    text = "-- comment; with semicolon\nCREATE TABLE a (id INT);\n\n  -- other\nALTER TABLE a ADD x INT;\n;\n"
+    assert rtt_migrations.parse_sql_statements(text) == ["CREATE TABLE a (id INT)", "ALTER TABLE a ADD x INT"]
+
+
+def test_load_migrations_order(tmp_path):
+    for fname in ['0010_ten.sql', '0002_two.sql', 'README.md', '0001_one.sql']:
+        (tmp_path / fname).write_text("SELECT 1;")
+    res = rtt_migrations.load_migrations(str(tmp_path))
+    assert [(x.version, x.name) for x in res] == [(1, 'one'), (2, 'two'), (10, 'ten')]
+
+
+def test_load_migrations_duplicate(tmp_path):
+    (tmp_path / '0001_one.sql').write_text("SELECT 1;")
+    (tmp_path / '001_other.sql').write_text("SELECT 1;")
+    with pytest.raises(ValueError):
+        rtt_migrations.load_migrations(str(tmp_path))
+
+
+def test_repository_migrations():
+    res = rtt_migrations.load_migrations()
+    assert [x.version for x in res] == list(range(1, len(res) + 1))
+    for migration in res:
+        assert migration.statements()
+
+
+def test_repository_migrations_rerunnable():
+    """Re-run of a migration fails only with errors in ALREADY_APPLIED_ERRORS, inserts must not duplicate rows"""
+    for migration in rtt_migrations.load_migrations():
+        for stmt in migration.statements():
+            if re.match(r'^\s*INSERT\b', stmt, re.I):
+                assert re.match(r'^\s*INSERT\s+IGNORE\b', stmt, re.I) or 'ON DUPLICATE KEY' in stmt.upper(), \
+                    "%s: %s" % (migration, stmt)
+
+
+def test_already_applied_error():
+    assert rtt_migrations.is_already_applied_error(Exception(1061, "Duplicate key name"))
+    assert not rtt_migrations.is_already_applied_error(Exception(1062, "Duplicate entry"))
+    assert not rtt_migrations.is_already_applied_error(Exception("no code"))
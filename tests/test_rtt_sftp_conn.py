@@ -0,0 +1,460 @@
+import collections
+import hashlib
+import os
+import socket
+import threading
+import time
+
+import paramiko
+import pytest
+
+from common import rtt_sftp_conn, rtt_utils
+from common.rtt_sftp_conn import CODEC_ZSTD, DownloadFailedException, LockedDownloader, ManagedSftp, RemoteLock, \
+    SftpDownloader, SftpUploader, SSHConnectionManager, SSHParams, read_download_marker, write_download_marker
+from common.rtt_utils import hash_file
+
+MB = 1024 * 1024
+FakeStat = collections.namedtuple('FakeStat', 'st_size')
+
+
+class FakeSftp(object):
+    """Remote partial upload of the given size, None if missing"""
+    def __init__(self, size=None):
+        self.size = size
+
+    def stat(self, path):
+        if self.size is None:
+            raise IOError('No such file')
+        return FakeStat(self.size)
+
+
+def resume_offset(remote_size, file_size, block_size=MB):
+    uploader = SftpUploader(FakeSftp(remote_size), block_size=block_size)
+    uploader.file_size = file_size
+    return uploader.resume_offset('/data/.upload.part')
+
+
+def test_resume_missing_file():
+    assert resume_offset(None, 100 * MB) == 0
+
+
+def test_resume_backs_off_inflight_blocks():
+    inflight = SftpUploader.MAX_INFLIGHT
+    assert resume_offset(50 * MB, 100 * MB) == (50 - inflight) * MB
+    assert resume_offset(50 * MB + 123, 100 * MB) == (50 - inflight) * MB
+
+
+def test_resume_block_aligned():
+    offset = resume_offset(77 * MB + 5, 200 * MB, block_size=4 * MB)
+    assert offset % (4 * MB) == 0
+    assert offset == (77 // 4 - SftpUploader.MAX_INFLIGHT) * 4 * MB
+
+
+@pytest.mark.parametrize('remote_size', [0, 1, 5 * MB, SftpUploader.MAX_INFLIGHT * MB])
+def test_resume_small_prefix_starts_over(remote_size):
+    assert resume_offset(remote_size, 100 * MB) == 0
+
+
+def test_resume_longer_remote_starts_over():
+    assert resume_offset(101 * MB, 100 * MB) == 0
+
+
+def test_resume_complete_single_block():
+    assert resume_offset(MB // 2, MB // 2) == 0
+
+
+def test_resume_complete_file():
+    assert resume_offset(100 * MB, 100 * MB) == (100 - SftpUploader.MAX_INFLIGHT) * MB
+
+
+def test_put_resume_reuploads_corrupted_prefix(sshd, tmp_path):
+    from benchmarks.bench_sftp import create_random_file
+    block_size = 64 * 1024
+    src = str(tmp_path / 'data.bin')
+    digest = create_random_file(src, 3 * MB)
+    with open(src, 'rb') as fh:
+        partial = bytearray(fh.read(2 * MB))
+    partial[1000] ^= 0xff
+    with open(os.path.join(sshd.root, 'corrupted.part'), 'wb') as fh:
+        fh.write(partial)
+
+    sftp = sshd.connect()
+    try:
+        uploader = SftpUploader(sftp, block_size=block_size)
+        assert uploader.put(src, '/corrupted.part') == digest
+        assert uploader.offset == 0
+    finally:
+        sftp.close()
+    assert hash_file(os.path.join(sshd.root, 'corrupted.part')) == digest
+
+
+def test_put_resume_keeps_matching_prefix(sshd, tmp_path):
+    from benchmarks.bench_sftp import create_random_file
+    block_size = 64 * 1024
+    src = str(tmp_path / 'data.bin')
+    digest = create_random_file(src, 3 * MB)
+    with open(src, 'rb') as fh, open(os.path.join(sshd.root, 'matching.part'), 'wb') as fo:
+        fo.write(fh.read(2 * MB))
+
+    sftp = sshd.connect()
+    try:
+        uploader = SftpUploader(sftp, block_size=block_size)
+        assert uploader.put(src, '/matching.part') == digest
+        assert uploader.offset > 0
+        assert uploader.bytes_uploaded == 3 * MB - uploader.offset
+    finally:
+        sftp.close()
+    assert hash_file(os.path.join(sshd.root, 'matching.part')) == digest
+
+
+def test_remote_lock_exclusive(sshd):
+    sftp1, sftp2 = sshd.connect(), sshd.connect()
+    try:
+        lock1, lock2 = RemoteLock(sftp1, '/upload.lock'), RemoteLock(sftp2, '/upload.lock')
+        assert lock1.acquire()
+        assert not lock2.acquire()
+        lock1.release()
+        assert lock2.acquire()
+        lock2.release()
+        assert not os.path.exists(os.path.join(sshd.root, 'upload.lock'))
+    finally:
+        sftp1.close()
+        sftp2.close()
+
+
+def test_remote_lock_stale_taken_over(sshd):
+    sftp = sshd.connect()
+    try:
+        lock_path = os.path.join(sshd.root, 'stale.lock')
+        with open(lock_path, 'w') as fh:
+            fh.write('crashed:1')
+        os.utime(lock_path, (time.time() - 3600, time.time() - 3600))
+        lock = RemoteLock(sftp, '/stale.lock', expire=600)
+        assert lock.acquire()
+        assert time.time() - os.stat(lock_path).st_mtime < 60
+        lock.release()
+    finally:
+        sftp.close()
+
+
+def downloaded_file(tmp_path, data=b'data' * 1000):
+    path = str(tmp_path / '1.bin')
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    return path, write_download_marker(path, hashlib.sha256(data).digest())
+
+
+def no_hashing(monkeypatch):
+    def hash_file(path):
+        raise AssertionError('File hashed')
+    monkeypatch.setattr(rtt_utils, 'hash_file', hash_file)
+
+
+def test_check_downloaded_marker_metadata(tmp_path, monkeypatch):
+    path, meta = downloaded_file(tmp_path)
+    assert set(meta) == {'sha256', 'size', 'mtime_ns'}
+    no_hashing(monkeypatch)
+    assert LockedDownloader(None, path).check_downloaded() == bytes.fromhex(meta['sha256'])
+    assert LockedDownloader(None, path).check_downloaded(bytes.fromhex(meta['sha256'])) is not None
+
+
+def test_check_downloaded_expected_hash_mismatch(tmp_path):
+    path, meta = downloaded_file(tmp_path)
+    assert LockedDownloader(None, path).check_downloaded(b'\x00' * 32) is None
+
+
+def test_check_downloaded_modified_file_rehashed(tmp_path):
+    path, meta = downloaded_file(tmp_path)
+    with open(path, 'wb') as fh:
+        fh.write(b'other')
+    digest = hashlib.sha256(b'other').digest()
+    assert LockedDownloader(None, path).check_downloaded() == digest
+    new_meta = read_download_marker(path)
+    assert new_meta['sha256'] == digest.hex() and new_meta['size'] == 5
+    assert LockedDownloader(None, path).check_downloaded(bytes.fromhex(meta['sha256'])) is None
+
+
+def test_check_downloaded_verify_detects_corruption(tmp_path):
+    path, meta = downloaded_file(tmp_path)
+    with open(path, 'r+b') as fh:
+        fh.write(b'X')
+    os.utime(path, ns=(meta['mtime_ns'], meta['mtime_ns']))  # metadata still match the marker
+    assert LockedDownloader(None, path).check_downloaded() is not None
+    assert LockedDownloader(None, path, verify_rate=1.0).check_downloaded() is None
+
+
+def test_check_downloaded_legacy_and_missing_marker(tmp_path):
+    path, meta = downloaded_file(tmp_path)
+    with open(path + '.downloaded', 'w'):
+        pass
+    assert read_download_marker(path) == {}
+    assert LockedDownloader(None, path).check_downloaded() == bytes.fromhex(meta['sha256'])
+    assert read_download_marker(path)['sha256'] == meta['sha256']
+
+    os.remove(path + '.downloaded')
+    assert LockedDownloader(None, path).check_downloaded() is None
+
+
+def test_download_resume_hashes_partial_prefix(sshd, tmp_path):
+    from benchmarks.bench_sftp import create_random_file
+    digest = create_random_file(os.path.join(sshd.root, 'resume.bin'), 3 * MB + 123)
+    dest = str(tmp_path / 'resume.bin')
+    with open(os.path.join(sshd.root, 'resume.bin'), 'rb') as fh, open(dest, 'wb') as fo:
+        fo.write(fh.read(MB + 7))
+
+    sftp = sshd.connect()
+    try:
+        downloader = LockedDownloader(sftp, dest)
+        assert downloader.download('/resume.bin', expected_hash=digest)
+        assert downloader.digest == digest and downloader.downloaded
+    finally:
+        sftp.close()
+    assert hash_file(dest) == digest
+    assert read_download_marker(dest)['sha256'] == digest.hex()
+
+
+def test_downloader_resume_offset(sshd, tmp_path):
+    from benchmarks.bench_sftp import create_random_file
+    digest = create_random_file(os.path.join(sshd.root, 'offset.bin'), 2 * MB)
+    dest = str(tmp_path / 'offset.bin')
+    with open(os.path.join(sshd.root, 'offset.bin'), 'rb') as fh, open(dest, 'wb') as fo:
+        fo.write(fh.read(MB))
+
+    sftp = sshd.connect()
+    try:
+        downloader = SftpDownloader(sftp)
+        downloader.get('/offset.bin', dest)
+        assert downloader.offset == MB and downloader.bytes_downloaded == MB
+        assert downloader.digest == digest
+    finally:
+        sftp.close()
+
+
+def test_download_corrupted_prefix_fails_hash_then_restarts(sshd, tmp_path):
+    from benchmarks.bench_sftp import create_random_file
+    digest = create_random_file(os.path.join(sshd.root, 'corrupted.bin'), MB + 5)
+    dest = str(tmp_path / 'corrupted.bin')
+    with open(dest, 'wb') as fo:
+        fo.write(b'\x00' * 1000)  # partial file not matching the remote one
+
+    sftp = sshd.connect()
+    try:
+        downloader = LockedDownloader(sftp, dest, attempts=2)
+        assert downloader.download('/corrupted.bin', expected_hash=digest)
+        assert downloader.digest == digest
+    finally:
+        sftp.close()
+    assert hash_file(dest) == digest
+
+
+def test_download_truncated_zstd_fails(sshd, tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    data = os.urandom(64 * 1024) * 8
+    compressed = zstandard.ZstdCompressor().compress(data)
+    with open(os.path.join(sshd.root, 'truncated.bin.zst'), 'wb') as fh:
+        fh.write(compressed[:len(compressed) // 2])
+
+    sftp = sshd.connect()
+    try:
+        downloader = SftpDownloader(sftp, codec=CODEC_ZSTD)
+        with pytest.raises(DownloadFailedException, match='truncated'):
+            downloader.get('/truncated.bin.zst', str(tmp_path / 'truncated.bin'))
+        with pytest.raises(DownloadFailedException):
+            LockedDownloader(sftp, str(tmp_path / 'locked.bin'), attempts=1, codec=CODEC_ZSTD) \
+                .download('/truncated.bin.zst', expected_hash=hashlib.sha256(data).digest())
+        assert read_download_marker(str(tmp_path / 'locked.bin')) is None
+    finally:
+        sftp.close()
+
+
+class FakeTime(object):
+    """Replaces the time module of rtt_sftp_conn, sleeps are recorded"""
+    def __init__(self):
+        self.sleeps = []
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+
+
+def test_manager_reconnect_backoff(monkeypatch):
+    fake_time = FakeTime()
+    monkeypatch.setattr(rtt_sftp_conn, 'time', fake_time)
+    manager = SSHConnectionManager(SSHParams(), connect_attempts=5, max_backoff=3)
+    results = [ConnectionRefusedError('refused')] * 4 + [FakeTransport()]
+
+    def connect_transport():
+        res = results.pop(0)
+        if isinstance(res, Exception):
+            raise res
+        return res
+    monkeypatch.setattr(manager, 'connect_transport', connect_transport)
+
+    transport = manager.get_transport()
+    assert transport.is_active() and manager.generation == 1 and manager.reconnects == 0
+    assert [int(x) for x in fake_time.sleeps] == [1, 2, 3, 3]  # exponential, capped by max_backoff
+    assert manager.get_transport() is transport
+
+    transport.close()
+    results.append(FakeTransport())
+    assert manager.get_transport() is not transport
+    assert manager.generation == 2 and manager.reconnects == 1
+
+
+def test_manager_reconnect_gives_up(monkeypatch):
+    fake_time = FakeTime()
+    monkeypatch.setattr(rtt_sftp_conn, 'time', fake_time)
+    manager = SSHConnectionManager(SSHParams(), connect_attempts=3)
+
+    def connect_transport():
+        raise ConnectionRefusedError('refused')
+    monkeypatch.setattr(manager, 'connect_transport', connect_transport)
+    with pytest.raises(ConnectionError):
+        manager.get_transport()
+    assert len(fake_time.sleeps) == 3 and manager.generation == 0
+
+
+class FakeSession(object):
+    """SFTP session failing the first fail_calls calls with the error"""
+    def __init__(self, error, fail_calls=1):
+        self.error = error
+        self.fail_calls = fail_calls
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append(name)
+            if self.fail_calls > 0:
+                self.fail_calls -= 1
+                raise self.error
+            return name
+        return call
+
+
+class FakeManager(object):
+    def __init__(self, session):
+        self.lock = threading.RLock()
+        self.session = session
+        self.generation = 1
+        self.transport = FakeTransport()
+        self.invalidated = []
+
+    def get_session(self):
+        return self.session
+
+    def invalidate(self, generation):
+        self.invalidated.append(generation)
+        self.generation += 1
+
+    def mark_ok(self):
+        pass
+
+
+@pytest.mark.parametrize('name', sorted(ManagedSftp.RETRY_SAFE))
+def test_managed_sftp_retries_safe_calls(name):
+    manager = FakeManager(FakeSession(EOFError('connection lost')))
+    assert ManagedSftp(manager).call(name, '/path') == name
+    assert manager.session.calls == [name, name] and manager.invalidated == [1]
+
+
+@pytest.mark.parametrize('name', ['remove', 'rename', 'posix_rename', 'put', 'mkdir', 'utime', 'truncate'])
+def test_managed_sftp_does_not_retry_unsafe_calls(name):
+    manager = FakeManager(FakeSession(socket.timeout('timed out')))
+    with pytest.raises(socket.timeout):
+        ManagedSftp(manager).call(name, '/path')
+    assert manager.session.calls == [name] and manager.invalidated == [1]
+
+
+def test_managed_sftp_operation_error_keeps_connection():
+    manager = FakeManager(FakeSession(IOError(2, 'No such file')))
+    with pytest.raises(IOError):
+        ManagedSftp(manager).stat('/missing')
+    assert manager.session.calls == ['stat'] and manager.invalidated == []
+
+
+def test_managed_sftp_gives_up_after_one_retry():
+    manager = FakeManager(FakeSession(EOFError('connection lost'), fail_calls=2))
+    with pytest.raises(EOFError):
+        ManagedSftp(manager).listdir('/')
+    assert manager.invalidated == [1, 2]
+
+
+def test_managed_sftp_reconnects_to_server(sshd):
+    manager = SSHConnectionManager(SSHParams(host='127.0.0.1', port=sshd.port, pkey_file=sshd.key_file,
+                                             pkey_pass='x'), num_sessions=2)
+    sftp = ManagedSftp(manager)
+    try:
+        with open(os.path.join(sshd.root, 'managed.txt'), 'w') as fh:
+            fh.write('x')
+        assert sftp.stat('/managed.txt').st_size == 1
+        manager.transport.close()  # broken connection
+        assert sftp.stat('/managed.txt').st_size == 1
+        assert manager.generation == 2 and manager.reconnects == 1
+    finally:
+        sftp.close()
+
+
+class FakeExtSftp(object):
+    """Records extended requests, server_extensions as captured by ExtSFTPClient"""
+    def __init__(self, server_extensions):
+        self.server_extensions = server_extensions
+        self.requests = []
+
+    def _request(self, *args):
+        self.requests.append(args)
+
+    def _adjust_cwd(self, path):
+        return path
+
+
+def test_client_keeps_server_extensions(sshd):
+    sftp = sshd.connect()
+    try:
+        # Stub server is paramiko SFTPServer, advertising check-file only
+        assert isinstance(sftp, rtt_sftp_conn.ExtSFTPClient)
+        assert sftp.server_extensions == {'check-file': 'md5,sha1'}
+    finally:
+        sftp.close()
+
+
+def test_parse_sftp_extensions():
+    msg = paramiko.Message()
+    msg.add_int(3)
+    msg.add('posix-rename@openssh.com', '1', 'hardlink@openssh.com', '1')
+    assert rtt_sftp_conn.parse_sftp_extensions(msg.asbytes()) == {'posix-rename@openssh.com': '1',
+                                                                   'hardlink@openssh.com': '1'}
+
+
+def test_hardlink_not_advertised(sshd):
+    sftp = sshd.connect()
+    try:
+        with pytest.raises(IOError, match='not supported by the server'):
+            rtt_sftp_conn.sftp_hardlink(sftp, '/a', '/b')
+    finally:
+        sftp.close()
+
+
+def test_hardlink_unknown_extensions():
+    sftp = FakeExtSftp(None)
+    with pytest.raises(IOError, match='extensions not known'):
+        rtt_sftp_conn.sftp_hardlink(sftp, '/a', '/b')
+    assert sftp.requests == []
+
+
+def test_hardlink_advertised():
+    sftp = FakeExtSftp({'hardlink@openssh.com': '1'})
+    rtt_sftp_conn.sftp_hardlink(sftp, '/a', '/b')
+    assert sftp.requests == [(rtt_sftp_conn.CMD_EXTENDED, 'hardlink@openssh.com', '/a', '/b')]
@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+
+from common.rtt_utils import Backoff, FileLocker, get_tmp_path
+
+
+def test_backoff_grows_to_max():
+    backoff = Backoff(min_delay=1, max_delay=10, factor=2, jitter=0)
+    assert [backoff.next() for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+
+
+def test_backoff_reset():
+    backoff = Backoff(min_delay=1, max_delay=10, factor=2, jitter=0)
+    backoff.next()
+    backoff.next()
+    backoff.reset()
+    assert backoff.next() == 1
+
+
+def test_backoff_jitter_bounds():
+    backoff = Backoff(min_delay=4, max_delay=4, factor=2, jitter=0.25)
+    delays = [backoff.next() for _ in range(200)]
+    assert all(3 <= x <= 5 for x in delays)
+    assert len(set(delays)) > 1
+
+
+def test_backoff_max_below_min():
+    backoff = Backoff(min_delay=5, max_delay=1, jitter=0)
+    assert [backoff.next() for _ in range(3)] == [5, 5, 5]
+
+
+def test_file_locker_fs_time(tmp_path):
+    locker = FileLocker(str(tmp_path / 'blob.lock'))
+    assert abs(locker.fs_time() - time.time()) < 5
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_file_locker_expiry(tmp_path):
+    locker = FileLocker(str(tmp_path / 'blob.lock'), expire=60)
+    assert locker.acquire_try_once()
+    try:
+        locker.touch()
+        assert not locker.is_expired()
+        old = locker.fs_time() - 120
+        os.utime(locker.mlock_path, (old, old))
+        assert locker.is_expired()
+    finally:
+        locker.release()
+
+
+def test_tmp_path_per_thread():
+    res = []
+    thread = threading.Thread(target=lambda: res.append(get_tmp_path('/data/1.bin')))
+    thread.start()
+    thread.join()
+    assert get_tmp_path('/data/1.bin').startswith('/data/1.bin.')
+    assert get_tmp_path('/data/1.bin') != res[0]
@@ -0,0 +1,228 @@
+import gzip
+import os
+import socket
+import sys
+import threading
+import time
+
+from common.rtt_sftp_conn import SSHParams
+from common.rtt_worker import AsyncRunner, LineSplitter, OutputCapture, SSHForwarderParamiko, set_bounded_capture
+
+
+def test_capture_unbounded():
+    cap = OutputCapture()
+    for i in range(100):
+        cap.append('line %s' % i)
+    assert len(cap) == 100 and cap.dropped == 0
+    assert list(cap)[-1] == 'line 99'
+
+
+def test_capture_head_and_tail():
+    cap = OutputCapture(max_lines=10, head_lines=5)
+    for i in range(100):
+        cap.append('line %s' % i)
+    lines = list(cap)
+    assert lines[:5] == ['line %s' % i for i in range(5)]
+    assert lines[5:] == ['line %s' % i for i in range(90, 100)]
+    assert cap.total == 100 and cap.dropped == 85
+    assert '... 85 lines omitted ...' in cap.text()
+
+
+def test_capture_max_bytes():
+    cap = OutputCapture(max_bytes=100)
+    for i in range(100):
+        cap.append('x' * 30)
+    assert cap.tail_bytes <= 100 and len(cap) == 3
+
+
+def test_capture_keeps_last_long_line():
+    cap = OutputCapture(max_bytes=10)
+    cap.append('x' * 1000)
+    assert list(cap) == ['x' * 1000]
+
+
+def test_capture_spill(tmp_path):
+    spill = str(tmp_path / 'out.log.gz')
+    cap = OutputCapture(max_lines=10, head_lines=2, spill_path=spill)
+    for i in range(1000):
+        cap.append('line %s' % i)
+    assert len(cap) == 12
+    assert 'full output in %s' % spill in cap.text()
+
+    cap.close()
+    assert list(cap.iter_lines()) == ['line %s' % i for i in range(1000)]
+    with gzip.open(spill, 'rt') as fh:
+        assert len(fh.read().splitlines()) == 1000
+
+
+def test_line_splitter():
+    splitter = LineSplitter(max_line=8)
+    assert splitter.feed(b'ab\r\ncd') == ['ab']
+    assert splitter.feed('ž\n'.encode('utf8')[:1]) == []
+    assert splitter.feed('ž\n'.encode('utf8')[1:]) == ['cdž']
+    assert splitter.feed(b'0123456789') == ['0123456789']
+    assert splitter.feed(b'tail', final=True) == ['tail']
+
+
+def test_runner_bounded_capture(tmp_path):
+    script = 'import sys\nfor i in range(5000): print("out %s" % i)\nprint("err", file=sys.stderr)\nsys.exit(3)'
+    runner = AsyncRunner([sys.executable, '-c', script], shell=False)
+    runner.log_out_during = False
+    runner.log_out_after = False
+    set_bounded_capture(runner, max_lines=100, head_lines=10, spill_dir=str(tmp_path))
+    runner.start()
+    assert runner.wait(30)
+
+    assert runner.ret_code == 3
+    assert runner.out_acc.total == 5000 and len(runner.out_acc) == 110
+    assert list(runner.out_acc)[-1] == 'out 4999'
+    assert list(runner.err_acc) == ['err']
+    assert os.path.exists(str(tmp_path / 'stdout.log.gz'))
+    assert len(list(runner.out_acc.iter_lines())) == 5000
+
+
+GROUP_SCRIPT = """
+import signal, subprocess, sys, time
+if sys.argv[1] == 'ignore':
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'], stdout=subprocess.DEVNULL)
+print(child.pid, flush=True)
+time.sleep(60)
+"""
+
+
+def is_alive(pid):
+    try:
+        with open('/proc/%s/stat' % pid) as fh:
+            return fh.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+def start_group_runner(mode):
+    runner = AsyncRunner([sys.executable, '-c', GROUP_SCRIPT, mode], shell=False)
+    runner.log_out_during = False
+    runner.log_out_after = False
+    runner.preexec_setgrp = True
+    runner.term_interval = 0.2
+    runner.kill_timeout = 1.0
+    runner.start()
+    for _ in range(100):
+        if len(runner.out_acc):
+            return runner, int(list(runner.out_acc)[0])
+        time.sleep(0.1)
+    raise AssertionError('Child not started')
+
+
+def wait_dead(pid, timeout=5):
+    deadline = time.time() + timeout
+    while is_alive(pid) and time.time() < deadline:
+        time.sleep(0.05)
+    return not is_alive(pid)
+
+
+def test_runner_shutdown_terminates_group():
+    runner, child_pid = start_group_runner('default')
+    assert runner.shutdown(timeout=10)
+    assert wait_dead(child_pid)
+
+
+def test_runner_shutdown_kills_ignoring_group():
+    runner, child_pid = start_group_runner('ignore')
+    time_started = time.time()
+    assert runner.shutdown(timeout=10)
+    assert runner.kill_timeout <= time.time() - time_started < 10
+    assert wait_dead(child_pid)
+
+
+class EchoManager(object):
+    """Connection manager whose channels are socket pairs served by an echo thread"""
+    def __init__(self, fail_opens=0):
+        self.fail_opens = fail_opens
+        self.channels = []
+        self.closed = False
+
+    def get_transport(self, probe=True):
+        return None
+
+    def open_channel(self, dest, src):
+        if self.fail_opens > 0:
+            self.fail_opens -= 1
+            raise EOFError('transport lost')
+        chan, remote = socket.socketpair()
+        self.channels.append(chan)
+        threading.Thread(target=self.echo, args=(remote,), daemon=True).start()
+        return chan
+
+    def echo(self, remote):
+        with remote:
+            while True:
+                data = remote.recv(65536)
+                if not data:
+                    return
+                remote.sendall(data)
+
+    def close(self):
+        self.closed = True
+
+
+def wait_for(cond, timeout=5):
+    deadline = time.time() + timeout
+    while not cond() and time.time() < deadline:
+        time.sleep(0.02)
+    return cond()
+
+
+def start_forwarder(manager):
+    return SSHForwarderParamiko(SSHParams(), 'db', 3306, manager=manager).start()
+
+
+def test_forwarder_stats():
+    fwd = start_forwarder(EchoManager())
+    try:
+        with socket.create_connection(('127.0.0.1', fwd.local_port), timeout=5) as client:
+            client.sendall(b'hello')
+            assert client.recv(5) == b'hello'
+            assert wait_for(lambda: fwd.get_stats()['bytes_received'] == 5)
+            stats = fwd.get_stats()
+            assert stats['connections'] == 1 and stats['active'] == 1 and stats['bytes_sent'] == 5
+        assert wait_for(lambda: fwd.get_stats()['active'] == 0)
+        assert wait_for(lambda: not fwd.pumps)
+        assert fwd.manager.channels[0].fileno() == -1  # channel closed with the client
+    finally:
+        fwd.shutdown()
+
+
+def test_forwarder_channel_open_retry_and_failure():
+    fwd = start_forwarder(EchoManager(fail_opens=1))
+    try:
+        with socket.create_connection(('127.0.0.1', fwd.local_port), timeout=5) as client:
+            client.sendall(b'x')
+            assert client.recv(1) == b'x'
+        assert fwd.get_stats()['failures'] == 0
+
+        fwd.manager.fail_opens = 2
+        with socket.create_connection(('127.0.0.1', fwd.local_port), timeout=5) as client:
+            assert client.recv(1) == b''  # client dropped, no channel
+        assert wait_for(lambda: fwd.get_stats()['failures'] == 1)
+        assert fwd.get_stats()['connections'] == 1
+    finally:
+        fwd.shutdown()
+
+
+def test_forwarder_shutdown_tears_down_channels():
+    manager = EchoManager()
+    fwd = start_forwarder(manager)
+    client = socket.create_connection(('127.0.0.1', fwd.local_port), timeout=5)
+    try:
+        client.sendall(b'ping')
+        assert client.recv(4) == b'ping'
+        fwd.shutdown()
+        assert not fwd.is_running and not fwd.pumps
+        assert manager.channels[0].fileno() == -1
+        assert client.recv(1) == b''
+        assert fwd.get_stats()['active'] == 0
+        assert not manager.closed  # shared manager is left to its owner
+    finally:
+        client.close()
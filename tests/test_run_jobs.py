@@ -0,0 +1,477 @@
+import argparse
+import collections
+import contextlib
+import os
+
+import pytest
+
+MySQLdb = pytest.importorskip('MySQLdb')
+from common.rtt_db_conn import JOBS_GENERATION, JOBS_RESETS  # noqa: E402
+from common.rtt_sftp_conn import DownloadFailedException  # noqa: E402
+from files import run_jobs  # noqa: E402
+
+
+class FakeHeartbeat(object):
+    def __init__(self):
+        self.registered = []
+
+    def register(self, job_info):
+        self.registered.append(job_info.id)
+
+    def unregister(self, job_info):
+        pass
+
+
+class FakePool(object):
+    @contextlib.contextmanager
+    def connection(self):
+        yield object()
+
+
+class FakeCursor(object):
+    """Records statements, results come from respond(sql, params) -> (rows, rowcount), which can raise"""
+    def __init__(self, respond=None):
+        self.respond = respond or (lambda sql, params: ([], 0))
+        self.executed = []
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, sql, params=None):
+        self.executed.append((' '.join(sql.split()), params))
+        self.rows, self.rowcount = self.respond(sql, params)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        pass
+
+
+def make_job(job_id, experiment_id=1):
+    return run_jobs.JobInfo(job_id, experiment_id, 'nist_sts')
+
+
+@pytest.fixture
+def slot_ctx(tmp_path, monkeypatch):
+    args = argparse.Namespace(prefetch=False, run_time=None, all_time=False)
+    ctx = run_jobs.WorkerContext(args, FakePool(), None, None, str(tmp_path), None)
+    ctx.heartbeat = FakeHeartbeat()
+    monkeypatch.setattr(run_jobs, 'create_worker_exp_dir', lambda *a, **k: str(tmp_path / 'exp'))
+    monkeypatch.setattr(run_jobs, 'get_experiment_data_info', lambda db, eid: (None, None))
+    monkeypatch.setattr(run_jobs, 'try_register_cached', lambda db, eid: None)
+    monkeypatch.setattr(run_jobs, 'idle_backoff_min', 0.01)
+    return ctx
+
+
+def test_slot_survives_failed_job(slot_ctx, monkeypatch):
+    jobs = [make_job(1), make_job(2)]
+    released, executed = [], []
+
+    def prepare_job_data(job_info, *args, **kwargs):
+        if job_info.id == 1:
+            raise DownloadFailedException('hash mismatch')
+        return '/data/%s.bin' % job_info.experiment_id, b'\x00' * 32
+
+    def claim(self):
+        if not jobs:
+            slot_ctx.stop('No jobs')
+            return None
+        return jobs.pop(0)
+
+    monkeypatch.setattr(run_jobs, 'prepare_job_data', prepare_job_data)
+    monkeypatch.setattr(run_jobs, 'release_job',
+                        lambda db, job_info, failed=False: released.append((job_info.id, failed)))
+    monkeypatch.setattr(run_jobs.WorkerSlot, 'claim', claim)
+    monkeypatch.setattr(run_jobs.WorkerSlot, 'execute', lambda self, job_info, *a: executed.append(job_info.id))
+
+    slot = run_jobs.WorkerSlot(0, slot_ctx)
+    slot.run()
+    assert slot.error is None
+    assert released == [(1, True)]
+    assert executed == [2]
+    assert slot_ctx.heartbeat.registered == [1, 2]
+
+
+def test_jobs_heartbeat_owned_running_jobs(monkeypatch):
+    monkeypatch.setattr(run_jobs.backend_data, 'id_key', 7)
+    cursor = FakeCursor()
+    run_jobs.jobs_heartbeat(cursor, [1, 2, 3], chunk=2)
+    assert len(cursor.executed) == 2
+    for sql, params in cursor.executed:
+        assert "status='running' AND worker_id=%s" in sql
+        assert "SET run_heartbeat=NOW(), worker_pid=%s " in sql and "status='running'," not in sql
+    assert [x[1][1:] for x in cursor.executed] == [[1, 2, 7], [3, 7]]
+
+    run_jobs.jobs_heartbeat(cursor, [4], worker_id=9)
+    assert cursor.executed[-1][1][1:] == [4, 9]
+
+
+def test_cached_experiment_ids_skip_dangling_links(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_jobs, 'cache_data_dir', str(tmp_path))
+    (tmp_path / 'blob.bin').write_bytes(b'data')
+    for eid, target in ((1, 'blob.bin'), (2, 'evicted.bin')):
+        os.symlink(str(tmp_path / target), str(tmp_path / ('%s.bin' % eid)))
+        (tmp_path / ('%s.bin.downloaded' % eid)).write_text('{}')
+    (tmp_path / '3.bin').write_bytes(b'partial')
+    assert run_jobs.get_cached_experiment_ids() == [1]
+
+
+def test_explain_check_queries_have_params():
+    explain_check = pytest.importorskip('benchmarks.explain_check')
+    for name, query, params, expected in explain_check.QUERIES:
+        assert query.count('%s') == len(params), name
+    assert run_jobs.sql_claim_select(run_jobs.SQL_CLAIM_ANY) in [x[1] for x in explain_check.QUERIES]
+
+
+class FakeConnection(object):
+    def __init__(self, cursor):
+        self.fake_cursor = cursor
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self.fake_cursor
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_claim_job_skip_locked(monkeypatch):
+    monkeypatch.setattr(run_jobs, 'skip_locked_supported', True)
+    monkeypatch.setattr(run_jobs.backend_data, 'id_key', 7)
+    cursor = FakeCursor(lambda sql, params: ([(5, 2, 'nist')], 1))
+    assert run_jobs.claim_job(cursor, run_jobs.sql_claim_cached(2), (2, 3)) == run_jobs.JobInfo(5, 2, 'nist')
+
+    (select_sql, select_params), (update_sql, update_params) = cursor.executed
+    assert select_sql.endswith('ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED') and select_params == (2, 3)
+    assert "status='running'" in update_sql and update_params == (7, os.getpid(), 5)
+
+
+def test_claim_job_skip_locked_none(monkeypatch):
+    monkeypatch.setattr(run_jobs, 'skip_locked_supported', True)
+    cursor = FakeCursor()
+    assert run_jobs.claim_job(cursor, run_jobs.SQL_CLAIM_ANY) is None
+    assert len(cursor.executed) == 1
+
+
+def test_claim_job_last_insert_id(monkeypatch):
+    monkeypatch.setattr(run_jobs, 'skip_locked_supported', False)
+    monkeypatch.setattr(run_jobs.backend_data, 'id_key', 7)
+
+    def respond(sql, params):
+        return ([], 1) if sql.lstrip().startswith('UPDATE') else ([(9, 4, 'dieharder')], 1)
+
+    cursor = FakeCursor(respond)
+    assert run_jobs.claim_job(cursor, run_jobs.SQL_CLAIM_LOCATION, ('loc', 'node')) == run_jobs.JobInfo(9, 4, 'dieharder')
+    (update_sql, update_params), (select_sql, _) = cursor.executed
+    assert 'id=LAST_INSERT_ID(id)' in update_sql and update_sql.endswith('ORDER BY id LIMIT 1')
+    assert update_params == (7, os.getpid(), 'loc', 'node')
+    assert select_sql.endswith('WHERE id=LAST_INSERT_ID()')
+
+    cursor = FakeCursor(lambda sql, params: ([], 0))
+    assert run_jobs.claim_job(cursor, run_jobs.SQL_CLAIM_ANY) is None
+    assert len(cursor.executed) == 1
+
+
+@pytest.mark.parametrize('version,expected', [('8.0.30', True), ('5.7.40-log', False),
+                                              ('10.6.12-MariaDB', True), ('10.5.9-MariaDB-1:10.5.9', False)])
+def test_db_supports_skip_locked(monkeypatch, version, expected):
+    monkeypatch.setattr(run_jobs, 'skip_locked_supported', None)
+    cursor = FakeCursor(lambda sql, params: ([(version,)], 1))
+    assert run_jobs.db_supports_skip_locked(FakeConnection(cursor)) is expected
+    assert run_jobs.db_supports_skip_locked(FakeConnection(cursor)) is expected
+    assert len(cursor.executed) == 1  # cached for the process
+
+
+def test_db_supports_skip_locked_error(monkeypatch):
+    monkeypatch.setattr(run_jobs, 'skip_locked_supported', None)
+
+    def respond(sql, params):
+        raise RuntimeError('gone away')
+    assert run_jobs.db_supports_skip_locked(FakeConnection(FakeCursor(respond))) is False
+
+
+TIER_CONDS = {
+    'local': 'experiment_id IN (%s,%s)',
+    'location': 'FROM cache_registry',
+    'pending': "FROM experiments WHERE status='pending'",
+    'any': '(1=1)',
+}
+
+
+@pytest.fixture
+def claim_env(monkeypatch):
+    monkeypatch.setattr(run_jobs, 'skip_locked_supported', True)
+    monkeypatch.setattr(run_jobs, 'dispatcher_client', None)
+    monkeypatch.setattr(run_jobs, 'claim_stats', collections.Counter())
+    monkeypatch.setattr(run_jobs, 'cache_registry', argparse.Namespace(cache_id='node:/cache'))
+    monkeypatch.setattr(run_jobs.backend_data, 'location', 'cluster')
+    monkeypatch.setattr(run_jobs, 'get_cached_experiment_ids', lambda limit=None: [1, 2])
+
+
+def claim_with_tiers(available):
+    """Claims with jobs available only in the given tiers, returns (job, connection, cursor)"""
+    def respond(sql, params):
+        if 'SKIP LOCKED' not in sql:
+            return [], 1
+        for tier in available:
+            if TIER_CONDS[tier] in sql:
+                return [(10, 3, tier)], 1
+        return [], 0
+
+    cursor = FakeCursor(respond)
+    connection = FakeConnection(cursor)
+    return run_jobs.get_job_info(connection), connection, cursor
+
+
+@pytest.mark.parametrize('tier', ['local', 'location', 'pending', 'any'])
+def test_get_job_info_preference_tiers(claim_env, tier):
+    tiers = list(TIER_CONDS)
+    job, connection, cursor = claim_with_tiers(tiers[tiers.index(tier):])
+    assert job.battery == tier
+    assert run_jobs.claim_stats == {tier: 1}
+    assert connection.commits == 1 and connection.rollbacks == 0
+
+    selects = [sql for sql, _ in cursor.executed if 'SKIP LOCKED' in sql]
+    assert len(selects) == tiers.index(tier) + 1
+    for select, name in zip(selects, tiers):
+        assert TIER_CONDS[name] in select
+    experiment_updates = [x for x in cursor.executed if x[0].startswith('UPDATE experiments')]
+    assert experiment_updates == ([(experiment_updates[0][0], (3,))] if tier == 'pending' else [])
+
+
+def test_get_job_info_skips_empty_tiers(claim_env, monkeypatch):
+    monkeypatch.setattr(run_jobs, 'get_cached_experiment_ids', lambda limit=None: [])
+    monkeypatch.setattr(run_jobs.backend_data, 'location', None)
+    job, _, cursor = claim_with_tiers(['local', 'location', 'any'])
+    assert job.battery == 'any'
+    assert len([sql for sql, _ in cursor.executed if 'SKIP LOCKED' in sql]) == 2  # pending and any
+
+
+def test_get_job_info_no_jobs(claim_env):
+    with pytest.raises(SystemExit):
+        claim_with_tiers([])
+
+
+def test_get_job_info_rollback_on_error(claim_env):
+    def respond(sql, params):
+        raise RuntimeError('Lock wait timeout')
+    connection = FakeConnection(FakeCursor(respond))
+    with pytest.raises(RuntimeError):
+        run_jobs.get_job_info(connection)
+    assert connection.rollbacks == 1 and connection.commits == 0
+
+
+def test_finalize_experiments_single_statement():
+    cursor = FakeCursor(lambda sql, params: ([], 3))
+    assert run_jobs.finalize_experiments(cursor) == 3
+    assert cursor.executed == [(' '.join(run_jobs.SQL_FINALIZE_EXPERIMENTS.split()), None)]
+    sql = cursor.executed[0][0]
+    assert "HAVING SUM(j.status NOT IN ('finished', 'error'))=0" in sql and "WHERE e.status='running'" in sql
+
+
+def test_finalize_experiment_once():
+    cursor = FakeCursor(lambda sql, params: ([], 1))
+    assert run_jobs.finalize_experiment(cursor, 5)
+    assert cursor.executed[0][1] == (5, 5) and "status!='finished'" in cursor.executed[0][0]
+    cursor.respond = lambda sql, params: ([], 0)  # finalized by another worker meanwhile
+    assert not run_jobs.finalize_experiment(cursor, 5)
+
+
+def test_try_finalize_experiments(monkeypatch):
+    monkeypatch.setattr(run_jobs, 'rand_sleep', lambda *args: None)
+    connection = FakeConnection(FakeCursor(lambda sql, params: ([], 2)))
+    run_jobs.try_finalize_experiments(connection)
+    assert connection.commits == 1
+
+    def respond(sql, params):
+        raise RuntimeError('Deadlock')
+    connection = FakeConnection(FakeCursor(respond))
+    run_jobs.try_finalize_experiments(connection)
+    assert connection.commits == 0 and connection.rollbacks == 1
+
+
+def stale_jobs(num):
+    return [(idx, 100 + idx, 'nist_sts') for idx in range(1, num + 1)]
+
+
+def reset_responder(jobs, num_reset=None):
+    """Stale jobs, one battery result of ID 10 * experiment_id per job, UPDATE resets num_reset of a chunk"""
+    def respond(sql, params):
+        if sql == run_jobs.SQL_STALE_JOBS:
+            return list(jobs), len(jobs)
+        if sql.startswith('SELECT id FROM batteries'):
+            return [(10 * eid,) for eid in params[::2]], len(params) // 2
+        if sql.lstrip().startswith('UPDATE jobs'):
+            return [], len(params) if num_reset is None else num_reset
+        return [], len(params or ())
+    return respond
+
+
+def statements(cursor, prefix):
+    return [x for x in cursor.executed if x[0].startswith(prefix)]
+
+
+def test_reset_job_chunk():
+    jobs = stale_jobs(3)
+    cursor = FakeCursor(reset_responder(jobs))
+    assert run_jobs.reset_job_chunk(cursor, jobs) == 3
+    update_sql, update_params = cursor.executed[0]
+    assert "SET status='pending', retries=retries+1" in update_sql and "status='running'" in update_sql
+    assert update_params == [1, 2, 3]
+    assert statements(cursor, 'DELETE FROM batteries') == [('DELETE FROM batteries WHERE id IN (%s,%s,%s)',
+                                                            [1010, 1020, 1030])]
+    assert statements(cursor, 'INSERT INTO rtt_counters')[0][1] == (JOBS_GENERATION, JOBS_RESETS)
+
+
+def test_reset_job_chunk_nothing_stale():
+    jobs = stale_jobs(2)
+    cursor = FakeCursor(reset_responder(jobs, num_reset=0))  # heart-beaten meanwhile
+    assert run_jobs.reset_job_chunk(cursor, jobs) == 0
+    assert len(cursor.executed) == 1
+
+
+def test_purge_jobs_results_batches():
+    jobs = stale_jobs(5)
+    connection = FakeConnection(FakeCursor(reset_responder(jobs)))
+    assert run_jobs.purge_jobs_results(connection, jobs, batch=2) == 5
+    deletes = statements(connection.fake_cursor, 'DELETE FROM batteries')
+    assert [x[1] for x in deletes] == [[1010, 1020], [1030, 1040], [1050]]
+    assert connection.commits == 4  # lookup and each batch in its own transaction
+
+
+def test_purge_jobs_results_unknown_battery():
+    connection = FakeConnection(FakeCursor(reset_responder([])))
+    assert run_jobs.purge_jobs_results(connection, [(1, 101, 'unknown')]) == 0
+    assert connection.fake_cursor.executed == []
+
+
+def test_reset_jobs_chunks():
+    jobs = stale_jobs(5)
+    connection = FakeConnection(FakeCursor(reset_responder(jobs)))
+    run_jobs.reset_jobs(connection, chunk=2, purge_batch=1)
+    updates = statements(connection.fake_cursor, 'UPDATE jobs')
+    assert [x[1] for x in updates] == [[1, 2], [3, 4], [5]]
+    assert len(statements(connection.fake_cursor, 'INSERT INTO rtt_counters')) == 3
+    # Batches of one battery before each chunk reset, the chunk reset deletes results inserted meanwhile
+    purge_deletes = [x[1] for x in statements(connection.fake_cursor, 'DELETE FROM batteries') if len(x[1]) == 1]
+    assert purge_deletes == [[1010], [1020], [1030], [1040], [1050], [1050]]
+
+
+def test_reset_jobs_none_stale():
+    connection = FakeConnection(FakeCursor(reset_responder([])))
+    run_jobs.reset_jobs(connection)
+    assert len(connection.fake_cursor.executed) == 1 and connection.commits == 2
+
+
+def test_execute_retry_lock_timeout(monkeypatch):
+    monkeypatch.setattr(run_jobs, 'rand_sleep', lambda *args: None)
+    attempts = []
+
+    def fnc(cursor):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise MySQLdb.OperationalError(1205, 'Lock wait timeout exceeded; try restarting transaction')
+        return 'done'
+
+    connection = FakeConnection(FakeCursor())
+    assert run_jobs.execute_retry(connection, fnc) == 'done'
+    assert connection.rollbacks == 2 and connection.commits == 1
+
+    def fail(cursor):
+        raise ValueError('other')
+    with pytest.raises(ValueError):
+        run_jobs.execute_retry(connection, fail)
+    assert connection.rollbacks == 3
+
+
+class FakeSettingsTable(object):
+    """rtt_settings rows name -> (value, updated), stamp=False emulates the schema without the updated column"""
+    def __init__(self, rows, stamp=True):
+        self.rows = dict(rows)
+        self.stamp = stamp
+        self.fail_load = False
+
+    def respond(self, sql, params):
+        if 'MAX(updated)' in sql:
+            if not self.stamp:
+                raise MySQLdb.OperationalError(1054, "Unknown column 'updated'")
+            return [(len(self.rows), max((x[1] for x in self.rows.values()), default=None))], 1
+        if self.fail_load:
+            raise MySQLdb.OperationalError(2013, 'Lost connection')
+        return [(i, name, x[0]) for i, (name, x) in enumerate(sorted(self.rows.items()))], len(self.rows)
+
+
+def settings_db(rows, stamp=True):
+    table = FakeSettingsTable(rows, stamp)
+    return table, FakeConnection(FakeCursor(table.respond))
+
+
+def settings_loads(db):
+    return sum(1 for sql, _ in db.fake_cursor.executed if '`name`' in sql)
+
+
+def test_settings_cache_unchanged_stamp():
+    table, db = settings_db({'max_sec_per_test': ('3600', 1)})
+    cache = run_jobs.SettingsCache()
+    assert cache.get(db) == {'max_sec_per_test': '3600'}
+    assert cache.get(db) == cache.get(db) == {'max_sec_per_test': '3600'}
+    assert settings_loads(db) == 1
+    assert sum(1 for sql, _ in db.fake_cursor.executed if 'COUNT(*)' in sql) == 3
+
+
+def test_settings_cache_detects_changes():
+    table, db = settings_db({'a': ('1', 1), 'b': ('2', 1)})
+    cache = run_jobs.SettingsCache()
+    cache.get(db)
+
+    table.rows['a'] = ('10', 2)  # update bumps MAX(updated)
+    assert cache.get(db) == {'a': '10', 'b': '2'}
+    assert settings_loads(db) == 2
+
+    del table.rows['b']  # delete changes COUNT(*) only
+    assert cache.get(db) == {'a': '10'}
+    assert settings_loads(db) == 3
+
+    table.rows['b'] = ('2', 2)  # insert with the same MAX(updated) changes COUNT(*)
+    assert cache.get(db) == {'a': '10', 'b': '2'}
+    assert settings_loads(db) == 4
+    cache.get(db)
+    assert settings_loads(db) == 4
+
+
+def test_settings_cache_ttl():
+    table, db = settings_db({'a': ('1', 1)})
+    cache = run_jobs.SettingsCache(ttl=60)
+    cache.get(db)
+    cache.time_loaded -= 61
+    cache.get(db)
+    assert settings_loads(db) == 2
+
+
+def test_settings_cache_without_stamp():
+    table, db = settings_db({'a': ('1', 1)}, stamp=False)
+    cache = run_jobs.SettingsCache()
+    cache.get(db)
+    assert cache.get(db) == {'a': '1'}
+    assert settings_loads(db) == 2 and db.rollbacks == 2
+
+
+def test_settings_cache_keeps_settings_on_load_failure(monkeypatch):
+    monkeypatch.setattr(run_jobs, 'rand_sleep', lambda *a, **k: None)
+    table, db = settings_db({'a': ('1', 1)})
+    cache = run_jobs.SettingsCache()
+    cache.get(db)
+
+    table.rows['a'] = ('2', 2)
+    table.fail_load = True
+    assert cache.get(db) == {'a': '1'}
+    table.fail_load = False
+    assert cache.get(db) == {'a': '2'}  # stamp was not stored on failure, retried
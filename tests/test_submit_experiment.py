@@ -0,0 +1,205 @@
+import argparse
+import configparser
+import json
+import os
+import uuid
+
+import pytest
+
+pytest.importorskip('MySQLdb')
+from common.rtt_sftp_conn import CODEC_ZSTD, LockedDownloader, RemoteLock  # noqa: E402
+from common.rtt_utils import hash_file  # noqa: E402
+from files import submit_experiment  # noqa: E402
+
+
+@pytest.fixture
+def storage(sshd, monkeypatch):
+    """SFTP connection to the storage server with empty data and config directories of the test"""
+    base = '/' + uuid.uuid4().hex
+    for name in ('data', 'config'):
+        os.makedirs(sshd.root + base + '/' + name)
+    monkeypatch.setattr(submit_experiment, 'storage_data_dir', base + '/data', raising=False)
+    monkeypatch.setattr(submit_experiment, 'storage_config_dir', base + '/config', raising=False)
+    sftp = sshd.connect()
+    sftp.local_root = sshd.root + base
+    yield sftp
+    sftp.close()
+
+
+@pytest.fixture
+def local_files(tmp_path):
+    data_file, config_file = tmp_path / 'data.bin', tmp_path / 'config.json'
+    data_file.write_bytes(os.urandom(100 * 1024))
+    config_file.write_text('{}')
+    return str(data_file), str(config_file)
+
+
+def test_upload_data_locks_tmp_names(storage, local_files):
+    uploaded = submit_experiment.upload_data(local_files[0], local_files[1], storage)
+    assert uploaded.tmp_data_file == submit_experiment.tmp_data_path(local_files[0])
+    assert uploaded.lock.locked
+    uploaded.lock.release()
+
+
+def test_upload_data_held_lock_gets_unique_names(sshd, storage, local_files):
+    other = sshd.connect()
+    try:
+        held = RemoteLock(other, os.path.join(submit_experiment.storage_data_dir,
+                                              submit_experiment.upload_tmp_name(local_files[0], '.lock')))
+        assert held.acquire()
+        uploaded = submit_experiment.upload_data(local_files[0], local_files[1], storage)
+        assert uploaded.tmp_data_file != submit_experiment.tmp_data_path(local_files[0])
+        assert uploaded.lock.locked and uploaded.lock.path != held.path
+        uploaded.lock.release()
+        held.release()
+    finally:
+        other.close()
+
+
+def write_manifest(tmp_path, items):
+    path = tmp_path / 'manifest.jsonl'
+    path.write_text('# comment\n\n' + ''.join(json.dumps(x) + '\n' for x in items))
+    return str(path)
+
+
+def test_load_manifest(tmp_path):
+    flags = submit_experiment.battery_flags
+    path = write_manifest(tmp_path, [
+        {'name': 'a', 'cfg': 'a.json', 'file': 'a.bin'},
+        {'name': 'b', 'cfg': 'b.json', 'file': 'b.bin', 'email': 'x@y', 'batteries': ['nist_sts', 'dieharder']},
+        {'name': 'c', 'cfg': 'c.json', 'file': 'c.bin', 'batteries': 'all'},
+    ])
+    items = submit_experiment.load_manifest(path, default_batts=flags['nist_sts'])
+    assert [(x.idx, x.name, x.email) for x in items] == [(2, 'a', None), (3, 'b', 'x@y'), (4, 'c', None)]
+    assert items[0].batteries == flags['nist_sts']
+    assert items[1].batteries == flags['nist_sts'] | flags['dieharder']
+    assert items[2].batteries & flags['dieharder'] and not items[2].batteries & flags['tu01_bigcrush']
+
+
+@pytest.mark.parametrize('line', ['{"name": "a", "cfg": "a.json"}', '{"name": "a", "cfg": "c", "file": "f", '
+                                  '"batteries": ["unknown"]}', 'not json'])
+def test_load_manifest_invalid(tmp_path, line):
+    path = tmp_path / 'manifest.jsonl'
+    path.write_text('\n' + line + '\n')
+    with pytest.raises(ValueError, match='line 2'):
+        submit_experiment.load_manifest(str(path), 0)
+
+
+def test_manifest_state_roundtrip(tmp_path):
+    state = str(tmp_path / 'manifest.state')
+    assert submit_experiment.load_manifest_state(state) == {}
+    items = [submit_experiment.ManifestItem(idx, 'n%s' % idx, None, 'c', 'f%s' % idx, 1) for idx in range(3)]
+    submit_experiment.save_manifest_state(state, [(items[0], 10), (items[1], 11)])
+    submit_experiment.save_manifest_state(state, [(items[2], 12)])
+    assert submit_experiment.load_manifest_state(state) == {submit_experiment.item_key(x): 10 + x.idx for x in items}
+
+
+class FakeDb(object):
+    """Experiment inserts get increasing IDs, the insert of an experiment named fail_name raises"""
+    def __init__(self):
+        self.fail_name = None
+        self.next_id = 1
+        self.commits = 0
+        self.rollbacks = 0
+        self.lastrowid = None
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        if sql.startswith('INSERT INTO experiments'):
+            if params[0] == self.fail_name:
+                raise RuntimeError('Insert failed')
+            self.lastrowid, self.next_id = self.next_id, self.next_id + 1
+
+    def executemany(self, sql, params):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def manifest_args(manifest):
+    return argparse.Namespace(manifest=manifest, manifest_state=None, streams=1, dedup=False, compress='none',
+                              parallel=1, chunk=2)
+
+
+def test_submit_manifest_partial_failure_resumed(storage, tmp_path):
+    items = []
+    for name in 'abcd':
+        (tmp_path / (name + '.bin')).write_bytes(os.urandom(10000))
+        (tmp_path / (name + '.json')).write_text('{}')
+        items.append({'name': name, 'cfg': str(tmp_path / (name + '.json')), 'file': str(tmp_path / (name + '.bin'))})
+    manifest = write_manifest(tmp_path, items)
+    args, db = manifest_args(manifest), FakeDb()
+    flags = submit_experiment.battery_flags['nist_sts']
+
+    # Second chunk fails on its second item, after the data of the first one were published
+    db.fail_name = 'd'
+    assert submit_experiment.submit_manifest(args, configparser.ConfigParser(), db, db, storage, flags) == 2
+    assert db.commits == 1 and db.rollbacks == 1
+    state = submit_experiment.load_manifest_state(manifest + '.state')
+    assert sorted(state.values()) == [1, 2]
+    data_dir = os.path.join(storage.local_root, 'data')
+    assert sorted(x for x in os.listdir(data_dir) if not x.startswith('.')) == ['1.bin', '2.bin']
+    loaded = submit_experiment.load_manifest(manifest, flags)
+    for item in loaded[2:]:
+        tmp_data_file = submit_experiment.tmp_data_path(item.file, tag=submit_experiment.item_key(item))
+        assert os.path.exists(storage.local_root + '/data/' + os.path.basename(tmp_data_file))
+    assert not [x for x in os.listdir(data_dir) if x.endswith('.lock.part')]
+
+    # Repeated submission creates only the failed items
+    db.fail_name = None
+    assert submit_experiment.submit_manifest(args, configparser.ConfigParser(), db, db, storage, flags) == 0
+    state = submit_experiment.load_manifest_state(manifest + '.state')
+    assert sorted(state.values()) == [1, 2, 4, 5]  # 3 was rolled back
+    assert sorted(os.listdir(data_dir)) == ['1.bin', '2.bin', '4.bin', '5.bin']
+    assert sorted(os.listdir(os.path.join(storage.local_root, 'config'))) == ['1.json', '2.json', '4.json', '5.json']
+
+
+def test_zstd_round_trip(storage, local_files, tmp_path):
+    pytest.importorskip('zstandard')
+    with open(local_files[0], 'wb') as fh:
+        fh.write(b'compressible data ' * 100000)
+    digest = hash_file(local_files[0])
+
+    uploaded = submit_experiment.upload_data(local_files[0], local_files[1], storage, codec=CODEC_ZSTD)
+    uploaded.lock.release()
+    assert uploaded.data_sha256 == digest.hex() and uploaded.tmp_data_file.endswith('.bin.zst.part')
+    data_file, _ = submit_experiment.publish_data(uploaded.tmp_data_file, uploaded.tmp_config_file, 1, storage,
+                                                  uploaded.codec)
+    assert data_file.endswith('/1.bin.zst')
+    assert storage.stat(data_file).st_size < os.path.getsize(local_files[0]) / 10
+
+    dest = str(tmp_path / 'downloaded.bin')
+    downloader = LockedDownloader(storage, dest, codec=uploaded.codec)
+    downloader.download(data_file, expected_hash=digest)
+    assert downloader.digest == digest and hash_file(dest) == digest
+
+
+def store_experiment_data(storage, experiment_id, local_data_file):
+    with open(local_data_file, 'rb') as src, open(storage.local_root + '/data/%s.bin' % experiment_id, 'wb') as dst:
+        dst.write(src.read())
+
+
+@pytest.mark.parametrize('extensions', [None, {'check-file': 'md5,sha1'}, {'hardlink@openssh.com': '1'}])
+def test_link_existing_data_fallback(storage, local_files, monkeypatch, extensions):
+    # Unknown extensions, hardlink not advertised, advertised but failing (unsupported by the stub server)
+    monkeypatch.setattr(storage, 'server_extensions', extensions)
+    store_experiment_data(storage, 7, local_files[0])
+    assert submit_experiment.link_existing_data(storage, [(7, None)], local_files[0]) is None
+    assert not os.path.exists(storage.local_root + '/data/' + os.path.basename(
+        submit_experiment.tmp_data_path(local_files[0])))
+
+
+def test_upload_data_without_hardlink_uploads(storage, local_files):
+    store_experiment_data(storage, 7, local_files[0])
+    digest = hash_file(local_files[0])
+    uploaded = submit_experiment.upload_data(local_files[0], local_files[1], storage,
+                                             find_fnc=lambda sha256: [(7, None)] if sha256 == digest.hex() else [])
+    uploaded.lock.release()
+    assert uploaded.data_sha256 == digest.hex() and uploaded.codec is None
+    assert hash_file(storage.local_root + '/data/' + os.path.basename(uploaded.tmp_data_file)) == digest